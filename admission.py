@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Control de admisión para los endpoints de análisis (/api/analyze/*)
+
+Sin límites, en un pico de tráfico cada petición de análisis se acepta y
+su fichero se lee a memoria hasta que el proceso se queda sin RAM o las
+llamadas a Google caducan para todos. Este middleware ASGI actúa antes de
+que FastAPI lea el cuerpo:
+
+- Cada tipo de endpoint (texto, audio, imagen, multimodal) tiene su propio
+  límite de peticiones simultáneas y de bytes en curso (según
+  Content-Length; sin él se reserva el máximo por petición).
+- Lo que no cabe espera en una cola corta (FIFO) como mucho
+  ADMISSION_QUEUE_TIMEOUT segundos; con la cola llena o agotada la espera
+  se responde 503 al momento con un Retry-After estimado.
+- Las demás rutas (salud, chatbot, estadísticas) no pasan por aquí, así que
+  el trabajo caro de audio e imagen nunca las deja sin servicio.
+"""
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+
+def _limites(nombre: str, concurrencia: int, presupuesto_mb: int, max_mb: int) -> Dict[str, int]:
+    return {
+        "concurrencia": int(os.getenv(f"ADMISSION_{nombre}_CONCURRENCY", str(concurrencia))),
+        "bytes": int(float(os.getenv(f"ADMISSION_{nombre}_MB", str(presupuesto_mb))) * 1024 * 1024),
+        "max_peticion": int(float(os.getenv(f"ADMISSION_{nombre}_MAX_MB", str(max_mb))) * 1024 * 1024),
+    }
+
+
+# Límites por tipo de endpoint: simultáneas, MB en curso y MB por petición
+ADMISSION_LIMITS = {
+    "/api/analyze/text": _limites("TEXT", 32, 8, 1),
+    "/api/analyze/audio": _limites("AUDIO", 4, 64, 25),
+    "/api/analyze/image": _limites("IMAGE", 8, 160, 25),
+    "/api/analyze/multimodal": _limites("MULTIMODAL", 4, 128, 50),
+}
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "16"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+
+
+class AdmissionRejected(Exception):
+    """La petición no se admite (cola llena, espera agotada o cuerpo demasiado grande)"""
+
+    def __init__(self, status: int, mensaje: str, retry_after: Optional[int] = None):
+        super().__init__(mensaje)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Limitador:
+    """Peticiones y bytes en curso de un tipo de endpoint, con su cola de espera"""
+
+    def __init__(self, concurrencia: int, bytes: int, max_peticion: int,
+                 cola: int = ADMISSION_QUEUE_SIZE, espera: float = ADMISSION_QUEUE_TIMEOUT):
+        self.concurrencia = concurrencia
+        self.bytes = bytes
+        self.max_peticion = max_peticion
+        self.cola_max = cola
+        self.espera = espera
+        self.en_curso = 0
+        self.bytes_en_curso = 0
+        self.cola: deque = deque()
+        # Duración media de las peticiones (EWMA) para estimar el Retry-After
+        self.duracion_media = 1.0
+        self.stats = {"admitidas": 0, "encoladas": 0, "rechazadas": 0, "demasiado_grandes": 0}
+
+    def _cabe(self, n: int) -> bool:
+        # Una petición sola siempre cabe aunque supere el presupuesto de bytes
+        return self.en_curso < self.concurrencia and (
+            self.en_curso == 0 or self.bytes_en_curso + n <= self.bytes)
+
+    def _tomar(self, n: int):
+        self.en_curso += 1
+        self.bytes_en_curso += n
+        self.stats["admitidas"] += 1
+
+    def retry_after(self) -> int:
+        pendientes = len(self.cola) + self.en_curso
+        return max(1, math.ceil(self.duracion_media * pendientes / self.concurrencia))
+
+    async def acquire(self, n: int):
+        if n > self.max_peticion:
+            self.stats["demasiado_grandes"] += 1
+            raise AdmissionRejected(
+                413, f"La petición supera el tamaño máximo de {self.max_peticion // (1024 * 1024)} MB")
+        if not self.cola and self._cabe(n):
+            self._tomar(n)
+            return
+        if len(self.cola) >= self.cola_max:
+            self.stats["rechazadas"] += 1
+            raise AdmissionRejected(503, "Servidor saturado, reintentar más tarde", self.retry_after())
+
+        turno = (asyncio.get_running_loop().create_future(), n)
+        self.cola.append(turno)
+        self.stats["encoladas"] += 1
+        try:
+            await asyncio.wait({turno[0]}, timeout=self.espera)
+        except asyncio.CancelledError:
+            # Cliente desconectado o apagado: devolver el hueco si ya se le
+            # había dado, o salir de la cola si no (sin tocar la duración media)
+            if turno[0].done():
+                self.release(n, self.duracion_media)
+            else:
+                self.cola.remove(turno)
+                turno[0].cancel()
+            raise
+        if turno[0].done():
+            return
+        self.cola.remove(turno)
+        turno[0].cancel()
+        self.stats["rechazadas"] += 1
+        raise AdmissionRejected(503, "Servidor saturado, reintentar más tarde", self.retry_after())
+
+    def release(self, n: int, duracion: float):
+        self.en_curso -= 1
+        self.bytes_en_curso -= n
+        self.duracion_media += 0.2 * (duracion - self.duracion_media)
+        # Dar paso a los siguientes de la cola, en orden, mientras quepan
+        while self.cola and self._cabe(self.cola[0][1]):
+            futuro, siguiente = self.cola.popleft()
+            self._tomar(siguiente)
+            futuro.set_result(None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "en_curso": self.en_curso,
+            "mb_en_curso": round(self.bytes_en_curso / (1024 * 1024), 1),
+            "en_cola": len(self.cola),
+            "concurrencia": self.concurrencia,
+            "mb_presupuesto": round(self.bytes / (1024 * 1024), 1),
+            "duracion_media_s": round(self.duracion_media, 2),
+            **self.stats,
+        }
+
+
+class AdmissionMiddleware:
+    """Middleware ASGI que admite, encola o rechaza las peticiones de análisis"""
+
+    def __init__(self, app, limitadores: Optional[Dict[str, _Limitador]] = None):
+        self.app = app
+        self.limitadores = limitadores if limitadores is not None else _limitadores
+
+    async def __call__(self, scope, receive, send):
+        limitador = None
+        if scope["type"] == "http" and scope["method"] == "POST":
+            limitador = self.limitadores.get(scope["path"].rstrip("/"))
+        if limitador is None:
+            await self.app(scope, receive, send)
+            return
+
+        longitud = None
+        for clave, valor in scope["headers"]:
+            if clave == b"content-length" and valor.isdigit():
+                longitud = int(valor)
+        reservado = longitud if longitud is not None else limitador.max_peticion
+
+        try:
+            await limitador.acquire(reservado)
+        except AdmissionRejected as e:
+            await self._rechazar(send, e)
+            return
+
+        inicio = time.perf_counter()
+        recibido = 0
+        cortado = False
+
+        async def receive_limitado():
+            # Sin Content-Length se corta al pasar el máximo por petición: se
+            # responde 413 aquí y la app ve la conexión como cerrada
+            nonlocal recibido, cortado
+            if cortado:
+                return {"type": "http.disconnect"}
+            mensaje = await receive()
+            recibido += len(mensaje.get("body", b""))
+            if recibido > limitador.max_peticion:
+                cortado = True
+                limitador.stats["demasiado_grandes"] += 1
+                await self._rechazar(send, AdmissionRejected(
+                    413, f"La petición supera el tamaño máximo de "
+                         f"{limitador.max_peticion // (1024 * 1024)} MB"))
+                return {"type": "http.disconnect"}
+            return mensaje
+
+        async def send_app(mensaje):
+            if not cortado:
+                await send(mensaje)
+
+        try:
+            await self.app(scope, receive_limitado, send_app)
+        except Exception:
+            if not cortado:
+                raise
+        finally:
+            limitador.release(reservado, time.perf_counter() - inicio)
+
+    @staticmethod
+    async def _rechazar(send, error: AdmissionRejected):
+        cuerpo = json.dumps({"detail": str(error)}, ensure_ascii=False).encode("utf-8")
+        cabeceras = [(b"content-type", b"application/json; charset=utf-8"),
+                     (b"content-length", str(len(cuerpo)).encode())]
+        if error.retry_after is not None:
+            cabeceras.append((b"retry-after", str(error.retry_after).encode()))
+        await send({"type": "http.response.start", "status": error.status, "headers": cabeceras})
+        await send({"type": "http.response.body", "body": cuerpo})
+
+
+
+# Limitadores del proceso (compartidos por el middleware y /api/admission)
+_limitadores = {ruta: _Limitador(**config) for ruta, config in ADMISSION_LIMITS.items()}
+
+
+def stats() -> Dict[str, Any]:
+    """Estado de cada tipo de endpoint"""
+    return {ruta: limitador.snapshot() for ruta, limitador in _limitadores.items()}
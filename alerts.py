@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Ventanas deslizantes en tiempo real y alertas de picos de feedback negativo
+
+get_statistics y get_daily_trends dan, como mucho, granularidad diaria. Este
+agregador en memoria es un listener de FeedbackDatabase y mantiene, por
+categoría, por canal (tipo: texto/audio/imagen) y en total:
+
+- Ventanas deslizantes de 1, 15 y 60 minutos (total, negativos y score
+  medio) sobre cubetas de un minuto en un anillo de 60. Cada feedback
+  actualiza sus cubetas y las sumas de las tres ventanas en O(1); al
+  avanzar el minuto se restan las cubetas que salen de cada ventana.
+- Una línea base por minuto (EWMA de negativos/minuto, de su varianza y del
+  total/minuto) que se actualiza al cerrar cada minuto.
+- Una alerta cuando en alguna ventana los negativos superan lo esperado en
+  ALERT_ZSCORE desviaciones (z-score sobre la EWMA, calculado sobre la raíz
+  de los conteos para que sea fiable con pocos negativos), son al menos
+  ALERT_MIN_NEGATIVES y además ha subido la proporción de negativos (un
+  aumento de tráfico general no es un pico).
+
+Al arrancar las ventanas y las líneas base se reconstruyen desde la base de
+datos con el feedback de las últimas ALERT_HISTORY_HOURS horas.
+"""
+import math
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+ALERT_ZSCORE = float(os.getenv("ALERT_ZSCORE", "3"))
+ALERT_MIN_NEGATIVES = int(os.getenv("ALERT_MIN_NEGATIVES", "5"))
+ALERT_BASELINE_MINUTES = int(os.getenv("ALERT_BASELINE_MINUTES", "240"))
+ALERT_WARMUP_MINUTES = int(os.getenv("ALERT_WARMUP_MINUTES", "30"))
+ALERT_HISTORY_HOURS = float(os.getenv("ALERT_HISTORY_HOURS", "24"))
+
+# Ventanas en minutos y cubetas del anillo (la mayor de las ventanas)
+VENTANAS = (1, 15, 60)
+_MINUTOS = max(VENTANAS)
+DIMENSIONES = ("categoria", "tipo")
+
+# Alertas cerradas que se conservan para /api/alerts
+_HISTORIAL = 100
+# Varianza mínima de la línea base (evita dividir por ~0 con series sin negativos)
+_VARIANZA_MINIMA = 0.25
+
+
+def _minuto(timestamp: str) -> int:
+    """Minuto (desde epoch, hora local) de un timestamp ISO"""
+    return int(datetime.fromisoformat(timestamp[:19]).timestamp() // 60)
+
+
+class _Serie:
+    """Ventanas deslizantes y línea base de una clave (p. ej. categoria=Producto)"""
+
+    __slots__ = ("minuto", "cubetas", "sumas", "media_neg", "var_neg", "media_total", "minutos_base")
+
+    def __init__(self):
+        self.minuto: Optional[int] = None
+        # Anillo de cubetas [minuto, total, negativos, score_suma]
+        self.cubetas = [[-1, 0, 0, 0.0] for _ in range(_MINUTOS)]
+        # Sumas de cada ventana: [total, negativos, score_suma]
+        self.sumas = {w: [0, 0, 0.0] for w in VENTANAS}
+        self.media_neg = 0.0
+        self.var_neg = 0.0
+        self.media_total = 0.0
+        self.minutos_base = 0
+
+    def _cubeta(self, minuto: int) -> Optional[List]:
+        cubeta = self.cubetas[minuto % _MINUTOS]
+        return cubeta if cubeta[0] == minuto else None
+
+    def _cerrar(self, total: int, negativos: int, alfa: float):
+        """Incorporar un minuto completo a la línea base (EWMA)"""
+        # Mientras hay pocos minutos se usa la media acumulada para que el
+        # primer minuto no domine la línea base
+        self.minutos_base += 1
+        alfa = max(alfa, 1.0 / self.minutos_base)
+        delta = negativos - self.media_neg
+        self.media_neg += alfa * delta
+        self.var_neg = (1 - alfa) * (self.var_neg + alfa * delta * delta)
+        self.media_total += alfa * (total - self.media_total)
+
+    def advance(self, minuto: int, alfa: float):
+        """Mover el minuto actual: cerrar los minutos pasados y sacar cubetas de las ventanas"""
+        if self.minuto is None:
+            self.minuto = minuto
+            return
+        if minuto <= self.minuto:
+            return
+
+        # Línea base: el minuto que estaba abierto y los vacíos intermedios
+        # (pasadas ~4 constantes de tiempo la EWMA ya es prácticamente 0)
+        cubeta = self._cubeta(self.minuto)
+        self._cerrar(cubeta[1] if cubeta else 0, cubeta[2] if cubeta else 0, alfa)
+        vacios = minuto - self.minuto - 1
+        for _ in range(min(vacios, 4 * ALERT_BASELINE_MINUTES)):
+            self._cerrar(0, 0, alfa)
+        if vacios > 4 * ALERT_BASELINE_MINUTES:
+            self.media_neg = self.var_neg = self.media_total = 0.0
+            self.minutos_base += vacios - 4 * ALERT_BASELINE_MINUTES
+
+        for w, suma in self.sumas.items():
+            if minuto - self.minuto >= w:
+                suma[0], suma[1], suma[2] = 0, 0, 0.0
+                continue
+            for saliente in range(self.minuto - w + 1, minuto - w + 1):
+                cubeta = self._cubeta(saliente)
+                if cubeta:
+                    suma[0] -= cubeta[1]
+                    suma[1] -= cubeta[2]
+                    suma[2] -= cubeta[3]
+        self.minuto = minuto
+
+    def add(self, minuto: int, negativo: bool, score: float):
+        """Contar un feedback (los de hace más de una hora se ignoran)"""
+        if minuto <= self.minuto - _MINUTOS:
+            return
+        cubeta = self.cubetas[minuto % _MINUTOS]
+        if cubeta[0] != minuto:
+            cubeta[0], cubeta[1], cubeta[2], cubeta[3] = minuto, 0, 0, 0.0
+        cubeta[1] += 1
+        cubeta[2] += negativo
+        cubeta[3] += score
+        for w, suma in self.sumas.items():
+            if minuto > self.minuto - w:
+                suma[0] += 1
+                suma[1] += negativo
+                suma[2] += score
+
+    def spike(self) -> Optional[Dict[str, Any]]:
+        """Ventana con el pico de negativos más significativo (None si no hay pico)"""
+        if self.minutos_base < ALERT_WARMUP_MINUTES:
+            return None
+        proporcion_base = self.media_neg / self.media_total if self.media_total > 0 else 0.0
+        mejor = None
+        for w, (total, negativos, _) in self.sumas.items():
+            if negativos < ALERT_MIN_NEGATIVES:
+                continue
+            esperado = self.media_neg * w
+            # z-score sobre la raíz de los conteos (estable con pocos negativos,
+            # donde la normal subestima las colas de Poisson), escalado si la
+            # varianza observada es mayor que la de Poisson
+            dispersion = math.sqrt(max(esperado, _VARIANZA_MINIMA) / max(self.var_neg * w, esperado, _VARIANZA_MINIMA))
+            z = 2 * (math.sqrt(negativos) - math.sqrt(esperado)) * dispersion
+            if z >= ALERT_ZSCORE and negativos / total > proporcion_base and (mejor is None or z > mejor["zscore"]):
+                mejor = {
+                    "ventana_min": w,
+                    "negativos": negativos,
+                    "total": total,
+                    "esperado": round(esperado, 2),
+                    "zscore": round(z, 2),
+                    "proporcion_negativa": round(negativos / total, 3),
+                    "proporcion_base": round(proporcion_base, 3),
+                }
+        return mejor
+
+    def snapshot(self) -> Dict[str, Any]:
+        ventanas = {}
+        for w, (total, negativos, score_suma) in self.sumas.items():
+            ventanas[f"{w}m"] = {
+                "total": total,
+                "negativos": negativos,
+                "proporcion_negativa": round(negativos / total, 3) if total else 0.0,
+                "score_promedio": round(score_suma / total, 2) if total else 0.0,
+            }
+        ventanas["base"] = {
+            "negativos_min": round(self.media_neg, 3),
+            "desviacion_min": round(math.sqrt(self.var_neg), 3),
+            "total_min": round(self.media_total, 3),
+            "minutos": self.minutos_base,
+        }
+        return ventanas
+
+
+class SpikeMonitor:
+    """Agregados por ventanas deslizantes y alertas de picos de negativos"""
+
+    def __init__(self, baseline_minutes: int = ALERT_BASELINE_MINUTES):
+        self.alfa = 2.0 / (baseline_minutes + 1)
+        self.series: Dict[Tuple[str, str], _Serie] = {}
+        self.activas: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.historial: deque = deque(maxlen=_HISTORIAL)
+        self._cargando = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _claves(resumen: Dict[str, Any]) -> List[Tuple[str, str]]:
+        claves = [("total", "todos")]
+        for dimension in DIMENSIONES:
+            if resumen.get(dimension):
+                claves.append((dimension, resumen[dimension]))
+        return claves
+
+    def _add(self, resumen: Dict[str, Any]):
+        minuto = _minuto(resumen["timestamp"])
+        negativo = resumen["sentimiento"] == "negativo"
+        score = resumen.get("score") or 0.0
+        for clave in self._claves(resumen):
+            serie = self.series.get(clave)
+            if serie is None:
+                serie = self.series[clave] = _Serie()
+            serie.advance(minuto, self.alfa)
+            serie.add(minuto, negativo, score)
+            if negativo:
+                self._evaluate(clave, serie, resumen["timestamp"])
+
+    def _evaluate(self, clave: Tuple[str, str], serie: _Serie, instante: str):
+        """Abrir, actualizar o cerrar la alerta de una clave"""
+        pico = serie.spike()
+        activa = self.activas.get(clave)
+        if pico is not None:
+            if activa is None:
+                activa = self.activas[clave] = {
+                    "dimension": clave[0], "valor": clave[1], "inicio": instante, "zscore_max": 0.0,
+                }
+                if not self._cargando:
+                    logger.warning(f"🚨 Pico de feedback negativo en {clave[0]}={clave[1]}: "
+                                   f"{pico['negativos']} en {pico['ventana_min']} min (z={pico['zscore']})",
+                                   extra={"evento": "pico_negativo", "dimension": clave[0], "valor": clave[1]})
+            activa.update(pico, actualizado=instante, zscore_max=max(activa["zscore_max"], pico["zscore"]))
+        elif activa is not None:
+            del self.activas[clave]
+            self.historial.appendleft({**activa, "fin": instante})
+
+    def on_feedback(self, resumen: Dict[str, Any]):
+        """Listener de FeedbackDatabase"""
+        with self._lock:
+            self._add(resumen)
+
+    def _advance_all(self):
+        """Llevar todas las series al minuto actual y cerrar las alertas que ya no aplican"""
+        minuto = int(time.time() // 60)
+        ahora = datetime.now().isoformat()
+        for clave, serie in self.series.items():
+            serie.advance(minuto, self.alfa)
+            if clave in self.activas:
+                self._evaluate(clave, serie, ahora)
+
+    def load(self, db):
+        """Reconstruir ventanas y líneas base con el feedback reciente de la base de datos"""
+        desde = (datetime.now() - timedelta(hours=ALERT_HISTORY_HOURS)).isoformat()
+        with self._lock:
+            self._cargando = True
+            try:
+                for ruta in db.partitions(desde=desde):
+                    with db.get_connection(ruta) as conn:
+                        cursor = conn.cursor()
+                        columnas, decode = db.column_map(conn, ruta)
+                        cursor.execute(f"""
+                            SELECT timestamp, score, {columnas['tipo']} AS tipo,
+                                   {columnas['sentimiento']} AS sentimiento,
+                                   {columnas['categoria']} AS categoria
+                            FROM feedback
+                            WHERE timestamp >= ?
+                            ORDER BY timestamp
+                        """, (desde,))
+                        for fila in cursor:
+                            resumen = dict(fila)
+                            if columnas["tipo"] != "tipo":
+                                for campo in ("tipo", "sentimiento", "categoria"):
+                                    resumen[campo] = decode(resumen[campo])
+                            self._add(resumen)
+                self._advance_all()
+            finally:
+                self._cargando = False
+
+    def reload(self, db):
+        """Descartar el estado en memoria y reconstruirlo desde la base de datos"""
+        with self._lock:
+            self.series, self.activas = {}, {}
+            self.historial.clear()
+        self.load(db)
+
+    def windows(self) -> Dict[str, Any]:
+        """Agregados de 1, 15 y 60 minutos por dimensión y valor"""
+        with self._lock:
+            self._advance_all()
+            resultado: Dict[str, Any] = {dimension: {} for dimension in ("total",) + DIMENSIONES}
+            for (dimension, valor), serie in sorted(self.series.items()):
+                resultado[dimension][valor] = serie.snapshot()
+            resultado["total"] = resultado["total"].get("todos", _Serie().snapshot())
+            return resultado
+
+    def alerts(self) -> Dict[str, Any]:
+        """Alertas activas (de mayor a menor z-score) y las últimas cerradas"""
+        with self._lock:
+            self._advance_all()
+            return {
+                "activas": sorted((dict(a) for a in self.activas.values()),
+                                  key=lambda a: a["zscore"], reverse=True),
+                "recientes": list(self.historial),
+                "config": {
+                    "zscore": ALERT_ZSCORE,
+                    "min_negativos": ALERT_MIN_NEGATIVES,
+                    "linea_base_min": ALERT_BASELINE_MINUTES,
+                    "ventanas_min": list(VENTANAS),
+                },
+            }
@@ -0,0 +1,559 @@
+# -*- coding: utf-8 -*-
+"""
+Motor de analítica en memoria (columnar) sobre la tabla feedback
+
+Mantiene una instantánea compacta del feedback en arrays de NumPy, una
+columna por campo, con tipo/sentimiento/categoría codificados como enteros
+pequeños (diccionario). Se carga una vez desde SQLite y se amplía con cada
+feedback nuevo (listener de FeedbackDatabase). Sobre ella se calculan
+histogramas, percentiles y agrupaciones con filtros arbitrarios mediante
+operaciones vectorizadas, sin tocar la base de datos.
+
+Para que las consultas sigan en pocos milisegundos con millones de filas:
+
+- Junto a las columnas se mantiene un cubo pre-agregado por
+  (día, duplicado, tipo, sentimiento, categoría) con count y sumas. Las
+  agrupaciones y filtros sobre esas dimensiones (con rangos de días
+  completos) se resuelven sobre el cubo, cuyo tamaño no depende del número
+  de filas.
+- El score se guarda también cuantizado a centésimas (uint8): histogramas y
+  percentiles de score son un bincount sobre 1 byte por fila.
+- Mientras los timestamps lleguen en orden, los filtros de fechas son
+  cortes (searchsorted) en lugar de máscaras.
+
+El resto de combinaciones (agrupar por hora, rangos con horas, magnitude)
+recorre las columnas con máscaras vectorizadas.
+
+Memoria:
+
+- Columnas: 22 bytes por fila (timestamp 8, score 4, magnitude 4, score
+  cuantizado 1, tipo 1, sentimiento 1, categoría 2, duplicado 1).
+- Cubo: denso, 24 bytes por celda (días × 2 × tipos × sentimientos ×
+  categorías) más el histograma de score (1,6 KB por día), así que crece
+  con los días de historia y con el producto de las dimensiones. Para
+  acotarlo, el eje de categorías guarda solo las primeras
+  ANALYTICS_CUBE_CATEGORIES - 1 y suma el resto en una celda "otras". Con
+  4 tipos, 3 sentimientos y 64 categorías son ~37 KB por día (~13 MB por
+  año). Las consultas que agrupan o filtran por una categoría plegada
+  recorren las columnas.
+"""
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# Categorías con celda propia en el cubo (la última celda suma las demás)
+ANALYTICS_CUBE_CATEGORIES = max(2, int(os.getenv("ANALYTICS_CUBE_CATEGORIES", "64")))
+
+_CAPACIDAD_INICIAL = 1024
+_LOTE_CARGA = 100_000
+
+COLUMNAS_AGRUPABLES = ("tipo", "sentimiento", "categoria", "fecha", "hora")
+COLUMNAS_NUMERICAS = ("score", "magnitude")
+
+_COLUMNAS = ("timestamp", "score", "magnitude", "score_bin", "tipo", "sentimiento",
+             "categoria", "es_duplicado")
+
+# Score cuantizado: 201 valores (-1.00 ... 1.00)
+_SCORE_BINS = 201
+_DIA = 86400
+
+# Por encima de este tamaño de lote el cubo se actualiza con bincount
+_LOTE_BINCOUNT = 4096
+
+
+class Dictionary:
+    """Codificación diccionario: texto <-> entero pequeño"""
+
+    def __init__(self):
+        self.codigos: Dict[str, int] = {}
+        self.valores: List[str] = []
+
+    def encode(self, valor: Optional[str]) -> int:
+        valor = valor if valor is not None else ""
+        codigo = self.codigos.get(valor)
+        if codigo is None:
+            codigo = len(self.valores)
+            self.codigos[valor] = codigo
+            self.valores.append(valor)
+        return codigo
+
+    def lookup(self, valor: str) -> int:
+        """Código de un valor existente (-1 si no existe)"""
+        return self.codigos.get(valor, -1)
+
+    def __len__(self):
+        return len(self.valores)
+
+
+def _to_epoch(timestamps: Sequence[str]) -> np.ndarray:
+    """Convertir timestamps ISO (YYYY-MM-DDTHH:MM:SS...) a segundos"""
+    return np.array([t[:19] for t in timestamps], dtype="datetime64[s]").astype(np.int64)
+
+
+class AnalyticsEngine:
+    """Instantánea columnar del feedback con agregaciones vectorizadas"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.n = 0
+        self._ordenado = True
+        self.tipos = Dictionary()
+        self.sentimientos = Dictionary()
+        self.categorias = Dictionary()
+        self._alloc(_CAPACIDAD_INICIAL)
+
+        # Cubo (día, duplicado, tipo, sentimiento, categoría)
+        self._dia_base = None
+        self._cubo_forma = (0, 2, 0, 0, 0)
+        self._cubo = {}
+        # Histograma fino de score por (día, duplicado)
+        self._hist_dia = np.zeros((0, 2, _SCORE_BINS), dtype=np.int32)
+
+    # ---------- Almacenamiento ----------
+
+    def _alloc(self, capacidad: int):
+        """Reservar (o ampliar) los arrays conservando las filas existentes"""
+        nuevas = {
+            "timestamp": np.zeros(capacidad, dtype=np.int64),
+            "score": np.zeros(capacidad, dtype=np.float32),
+            "magnitude": np.full(capacidad, np.nan, dtype=np.float32),
+            "score_bin": np.zeros(capacidad, dtype=np.uint8),
+            "tipo": np.zeros(capacidad, dtype=np.uint8),
+            "sentimiento": np.zeros(capacidad, dtype=np.uint8),
+            "categoria": np.zeros(capacidad, dtype=np.uint16),
+            "es_duplicado": np.zeros(capacidad, dtype=np.bool_),
+        }
+        for nombre, array in nuevas.items():
+            antiguo = getattr(self, "_" + nombre, None)
+            if antiguo is not None:
+                array[:self.n] = antiguo[:self.n]
+            setattr(self, "_" + nombre, array)
+        self.capacidad = capacidad
+
+    def _reserve(self, extra: int):
+        if self.n + extra > self.capacidad:
+            capacidad = self.capacidad
+            while capacidad < self.n + extra:
+                capacidad *= 2
+            self._alloc(capacidad)
+
+    def _grow_cube(self, dia_min: int, dia_max: int, t: int, s: int, c: int):
+        """Ampliar el cubo para que quepan esos días y códigos"""
+        if self._dia_base is None:
+            self._dia_base = dia_min
+        dias, _, tipos, sents, cats = self._cubo_forma
+        base = min(self._dia_base, dia_min)
+        necesario = (max(self._dia_base + dias, dia_max + 1) - base, 2,
+                     max(tipos, t), max(sents, s), max(cats, c))
+        if base == self._dia_base and all(a <= b for a, b in zip(necesario, self._cubo_forma)):
+            return
+
+        # Crecer con holgura para no reasignar en cada día o categoría nueva
+        forma = tuple(
+            actual if requerido <= actual and (i > 0 or base == self._dia_base)
+            else max(requerido, 2 * actual)
+            for i, (requerido, actual) in enumerate(zip(necesario, self._cubo_forma))
+        )
+        forma = forma[:4] + (min(forma[4], ANALYTICS_CUBE_CATEGORIES),)
+        desplazamiento = self._dia_base - base
+        nuevo = {}
+        for nombre, dtype in (("count", np.int32), ("suma", np.float64),
+                              ("count_mag", np.int32), ("suma_mag", np.float64)):
+            array = np.zeros(forma, dtype=dtype)
+            antiguo = self._cubo.get(nombre)
+            if antiguo is not None:
+                d, _, ti, se, ca = antiguo.shape
+                array[desplazamiento:desplazamiento + d, :, :ti, :se, :ca] = antiguo
+            nuevo[nombre] = array
+        hist = np.zeros((forma[0], 2, _SCORE_BINS), dtype=np.int32)
+        hist[desplazamiento:desplazamiento + len(self._hist_dia)] = self._hist_dia
+        self._hist_dia = hist
+        self._cubo = nuevo
+        self._cubo_forma = forma
+        self._dia_base = base
+
+    def append_many(self, filas: List[Dict[str, Any]]):
+        """Añadir un lote de filas (dicts con los campos de feedback)"""
+        if not filas:
+            return
+        with self._lock:
+            self._reserve(len(filas))
+            i, j = self.n, self.n + len(filas)
+
+            ts = _to_epoch([f["timestamp"] for f in filas])
+            score = np.array([f["score"] or 0 for f in filas], dtype=np.float32)
+            magnitude = np.array([np.nan if f.get("magnitude") is None else f["magnitude"]
+                                  for f in filas], dtype=np.float32)
+            tipo = np.array([self.tipos.encode(f["tipo"]) for f in filas], dtype=np.int64)
+            sent = np.array([self.sentimientos.encode(f["sentimiento"]) for f in filas], dtype=np.int64)
+            cat = np.array([self.categorias.encode(f.get("categoria")) for f in filas], dtype=np.int64)
+            dup = np.array([bool(f.get("es_duplicado")) for f in filas], dtype=np.bool_)
+
+            ultimo = self._timestamp[i - 1] if i else ts[0]
+            if ts[0] < ultimo or np.any(np.diff(ts) < 0):
+                self._ordenado = False
+
+            self._timestamp[i:j] = ts
+            self._score[i:j] = score
+            self._magnitude[i:j] = magnitude
+            self._score_bin[i:j] = np.clip(np.rint((score + 1) * 100), 0, _SCORE_BINS - 1)
+            self._tipo[i:j] = tipo
+            self._sentimiento[i:j] = sent
+            self._categoria[i:j] = cat
+            self._es_duplicado[i:j] = dup
+
+            # Cubo pre-agregado
+            dias = ts // _DIA
+            self._grow_cube(int(dias.min()), int(dias.max()), len(self.tipos),
+                            len(self.sentimientos), min(len(self.categorias), ANALYTICS_CUBE_CATEGORIES))
+            # Las categorías sin celda propia van a la última ("otras")
+            cat_cubo = np.minimum(cat, ANALYTICS_CUBE_CATEGORIES - 1)
+            indice = np.ravel_multi_index((dias - self._dia_base, dup.astype(np.int64), tipo, sent, cat_cubo),
+                                          self._cubo_forma)
+            con_mag = ~np.isnan(magnitude)
+            indice_hist = np.ravel_multi_index((dias - self._dia_base, dup.astype(np.int64),
+                                                self._score_bin[i:j].astype(np.int64)),
+                                               self._hist_dia.shape)
+            self._cube_add("hist", indice_hist, None)
+            self._cube_add("count", indice, None)
+            self._cube_add("suma", indice, score.astype(np.float64))
+            self._cube_add("count_mag", indice[con_mag], None)
+            self._cube_add("suma_mag", indice[con_mag], magnitude[con_mag].astype(np.float64))
+
+            self.n = j
+
+    def _cube_add(self, nombre: str, indice: np.ndarray, pesos: Optional[np.ndarray]):
+        plano = (self._hist_dia if nombre == "hist" else self._cubo[nombre]).reshape(-1)
+        if len(indice) >= _LOTE_BINCOUNT:
+            plano += np.bincount(indice, weights=pesos, minlength=plano.size).astype(plano.dtype)
+        else:
+            np.add.at(plano, indice, 1 if pesos is None else pesos)
+
+    def on_feedback(self, resumen: Dict[str, Any]):
+        """Listener de FeedbackDatabase"""
+        self.append_many([resumen])
+
+    def load(self, db):
+        """Cargar todo el histórico desde SQLite por lotes"""
+        # Las particiones mensuales se recorren en orden cronológico
+        for ruta in db.partitions():
+            with db.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                columnas, decode = db.column_map(conn, ruta)
+                cursor.execute(f"""
+                    SELECT timestamp, score, magnitude, {columnas['tipo']} AS tipo,
+                           {columnas['sentimiento']} AS sentimiento,
+                           {columnas['categoria']} AS categoria, es_duplicado
+                    FROM feedback
+                    ORDER BY timestamp
+                """)
+                while True:
+                    filas = cursor.fetchmany(_LOTE_CARGA)
+                    if not filas:
+                        break
+                    lote = [dict(f) for f in filas]
+                    if columnas["tipo"] != "tipo":
+                        for fila in lote:
+                            fila["tipo"] = decode(fila["tipo"])
+                            fila["sentimiento"] = decode(fila["sentimiento"])
+                            fila["categoria"] = decode(fila["categoria"])
+                    self.append_many(lote)
+
+    def reload(self, db):
+        """Recargar el histórico completo y sustituir el contenido de golpe"""
+        nuevo = AnalyticsEngine()
+        nuevo.load(db)
+        with self._lock:
+            for atributo, valor in vars(nuevo).items():
+                if atributo != "_lock":
+                    setattr(self, atributo, valor)
+
+    def memory_bytes(self) -> int:
+        """Memoria ocupada por las columnas y el cubo (capacidad reservada)"""
+        columnas = sum(getattr(self, "_" + c).nbytes for c in _COLUMNAS)
+        return columnas + sum(a.nbytes for a in self._cubo.values()) + self._hist_dia.nbytes
+
+    # ---------- Selección de filas ----------
+
+    def _columns(self) -> Dict[str, np.ndarray]:
+        """Vistas de las columnas hasta la última fila (instantánea consistente)"""
+        with self._lock:
+            n = self.n
+            return {c: getattr(self, "_" + c)[:n] for c in _COLUMNAS}
+
+    def _codes(self, diccionario: Dictionary, valores) -> np.ndarray:
+        if isinstance(valores, str):
+            valores = [valores]
+        codigos = [diccionario.lookup(v) for v in valores]
+        return np.array([c for c in codigos if c >= 0], dtype=np.int64)
+
+    def _in(self, columna: np.ndarray, diccionario: Dictionary, valores) -> np.ndarray:
+        """Pertenencia a un conjunto de valores con una tabla de búsqueda (más rápido que isin)"""
+        tabla = np.zeros(max(len(diccionario), 1), dtype=np.bool_)
+        tabla[self._codes(diccionario, valores)] = True
+        return tabla[columna]
+
+    def _select(self, cols: Dict[str, np.ndarray], necesarias: Sequence[str],
+                desde: Optional[str] = None, hasta: Optional[str] = None, tipo=None,
+                sentimiento=None, categoria=None,
+                excluir_duplicados: bool = False) -> Dict[str, np.ndarray]:
+        """Columnas necesarias restringidas a las filas que cumplen los filtros"""
+        desde_ts = _to_epoch([desde])[0] if desde else None
+        hasta_ts = _to_epoch([hasta])[0] if hasta else None
+
+        # Con timestamps ordenados el rango de fechas es un simple corte
+        if self._ordenado and (desde_ts is not None or hasta_ts is not None):
+            i = np.searchsorted(cols["timestamp"], desde_ts, "left") if desde_ts is not None else 0
+            j = np.searchsorted(cols["timestamp"], hasta_ts, "left") if hasta_ts is not None else len(cols["timestamp"])
+            cols = {c: a[i:j] for c, a in cols.items()}
+            desde_ts = hasta_ts = None
+
+        mask = None
+
+        def _and(condicion):
+            nonlocal mask
+            mask = condicion if mask is None else mask & condicion
+
+        if desde_ts is not None:
+            _and(cols["timestamp"] >= desde_ts)
+        if hasta_ts is not None:
+            _and(cols["timestamp"] < hasta_ts)
+        if tipo:
+            _and(self._in(cols["tipo"], self.tipos, tipo))
+        if sentimiento:
+            _and(self._in(cols["sentimiento"], self.sentimientos, sentimiento))
+        if categoria:
+            _and(self._in(cols["categoria"], self.categorias, categoria))
+        if excluir_duplicados:
+            _and(~cols["es_duplicado"])
+
+        if mask is None:
+            return {c: cols[c] for c in necesarias}
+        return {c: cols[c][mask] for c in necesarias}
+
+    # ---------- Cubo ----------
+
+    def _cube_days(self, desde: Optional[str], hasta: Optional[str]) -> Optional[Tuple[int, int]]:
+        """Rango de índices de día del cubo; None si las fechas no son días completos"""
+        dias = self._cubo_forma[0]
+        rango = [0, dias]
+        for k, valor in enumerate((desde, hasta)):
+            if not valor:
+                continue
+            ts = int(_to_epoch([valor])[0])
+            if ts % _DIA:
+                return None
+            rango[k] = min(max(ts // _DIA - self._dia_base, 0), dias)
+        return rango[0], max(rango[0], rango[1])
+
+    def _cube_reduce(self, claves: Sequence[str], desde=None, hasta=None, tipo=None,
+                     sentimiento=None, categoria=None,
+                     excluir_duplicados: bool = False):
+        """
+        Agregar el cubo sobre las claves pedidas (en ese orden)
+
+        Devuelve (agregados, etiquetas de cada clave) o None si la consulta no
+        se puede resolver con el cubo. Las etiquetas se toman con el mismo
+        bloqueo que el cubo para que coincidan con sus ejes.
+        """
+        if any(c not in ("fecha", "tipo", "sentimiento", "categoria") for c in claves):
+            return None
+        with self._lock:
+            if self._dia_base is None:
+                return None
+            dias = self._cube_days(desde, hasta)
+            if dias is None:
+                return None
+            n_categorias = len(self.categorias)
+            if n_categorias > ANALYTICS_CUBE_CATEGORIES and (
+                    "categoria" in claves or (categoria and np.any(
+                        self._codes(self.categorias, categoria) >= ANALYTICS_CUBE_CATEGORIES - 1))):
+                # Categorías plegadas en "otras": hay que recorrer las columnas
+                return None
+            ejes = {"fecha": 0, "dup": 1, "tipo": 2, "sentimiento": 3, "categoria": 4}
+            selecciones = [slice(dias[0], dias[1]), slice(0, 1) if excluir_duplicados else slice(None),
+                           slice(0, len(self.tipos)), slice(0, len(self.sentimientos)),
+                           slice(0, min(n_categorias, ANALYTICS_CUBE_CATEGORIES))]
+            cubo = {nombre: array[tuple(selecciones)] for nombre, array in self._cubo.items()}
+            filtros = [(eje, self._codes(diccionario, valores))
+                       for eje, diccionario, valores in ((2, self.tipos, tipo), (3, self.sentimientos, sentimiento),
+                                                         (4, self.categorias, categoria))
+                       if valores]
+            etiquetas = []
+            for clave in claves:
+                if clave == "fecha":
+                    inicio = self._dia_base + dias[0]
+                    etiquetas.append([str(np.datetime64(inicio + d, "D")) for d in range(dias[1] - dias[0])])
+                else:
+                    etiquetas.append(self._labels(clave, {"tipo": tipo, "sentimiento": sentimiento,
+                                                          "categoria": categoria}[clave]))
+
+        for eje, codigos in filtros:
+            cubo = {nombre: np.take(array, codigos, axis=eje) for nombre, array in cubo.items()}
+
+        conservar = [ejes[c] for c in claves]
+        sumar = tuple(e for e in range(5) if e not in conservar)
+        resultado = {}
+        for nombre, array in cubo.items():
+            reducido = array.sum(axis=sumar)
+            # Tras sumar, los ejes conservados quedan en orden creciente
+            orden = np.argsort(np.argsort(conservar))
+            resultado[nombre] = np.transpose(reducido, orden) if len(conservar) > 1 else reducido
+        return resultado, etiquetas
+
+    def _score_counts(self, desde=None, hasta=None, tipo=None, sentimiento=None,
+                      categoria=None, excluir_duplicados: bool = False) -> np.ndarray:
+        """Número de filas por centésima de score (201 valores) con los filtros"""
+        if not (tipo or sentimiento or categoria):
+            with self._lock:
+                dias = self._cube_days(desde, hasta) if self._dia_base is not None else (0, 0)
+                if dias is not None:
+                    hist = self._hist_dia[dias[0]:dias[1], :1 if excluir_duplicados else 2]
+                    return hist.sum(axis=(0, 1), dtype=np.int64)
+
+        cols = self._select(self._columns(), ["score_bin"], desde=desde, hasta=hasta, tipo=tipo,
+                            sentimiento=sentimiento, categoria=categoria,
+                            excluir_duplicados=excluir_duplicados)
+        return np.bincount(cols["score_bin"], minlength=_SCORE_BINS)
+
+    # ---------- Consultas ----------
+
+    def histogram(self, columna: str = "score", bins: int = 20, rango=(-1.0, 1.0),
+                  **filtros) -> Dict[str, Any]:
+        """Histograma de score o magnitude"""
+        if columna not in COLUMNAS_NUMERICAS:
+            raise ValueError(f"Columna no numérica: {columna}")
+        if columna == "score":
+            # Reagrupar el histograma fino (centésimas) en los bins pedidos
+            finos = self._score_counts(**filtros)
+            centros = np.arange(_SCORE_BINS) / 100 - 1
+            cuentas, bordes = np.histogram(centros, bins=bins, range=rango, weights=finos)
+            total = int(finos.sum())
+        else:
+            cols = self._select(self._columns(), ["magnitude"], **filtros)
+            valores = cols["magnitude"][~np.isnan(cols["magnitude"])]
+            if rango == (-1.0, 1.0):
+                rango = (0.0, float(valores.max()) if len(valores) else 1.0)
+            cuentas, bordes = np.histogram(valores, bins=bins, range=rango)
+            total = int(len(valores))
+
+        return {
+            "columna": columna,
+            "total": total,
+            "bordes": [round(float(b), 4) for b in bordes],
+            "cuentas": cuentas.astype(np.int64).tolist(),
+        }
+
+    def percentiles(self, columna: str = "score", percentiles: Iterable[float] = (50, 90, 99),
+                    **filtros) -> Dict[str, Any]:
+        """Percentiles de score (a la centésima) o magnitude"""
+        if columna not in COLUMNAS_NUMERICAS:
+            raise ValueError(f"Columna no numérica: {columna}")
+        percentiles = list(percentiles)
+
+        if columna == "score":
+            # Percentil por rango más cercano sobre el histograma fino
+            acumulado = np.cumsum(self._score_counts(**filtros))
+            total = int(acumulado[-1])
+            if total:
+                rangos = np.maximum(np.ceil(np.array(percentiles) / 100 * total), 1)
+                resultado = np.searchsorted(acumulado, rangos) / 100 - 1
+            else:
+                resultado = [None] * len(percentiles)
+        else:
+            cols = self._select(self._columns(), ["magnitude"], **filtros)
+            valores = cols["magnitude"][~np.isnan(cols["magnitude"])]
+            total = int(len(valores))
+            resultado = np.percentile(valores, percentiles) if total else [None] * len(percentiles)
+
+        return {
+            "columna": columna,
+            "total": total,
+            "percentiles": {
+                f"{p:g}": (round(float(v), 4) if v is not None else None)
+                for p, v in zip(percentiles, resultado)
+            },
+        }
+
+    def group_by(self, claves: Sequence[str], **filtros) -> List[Dict[str, Any]]:
+        """
+        Agrupar por cualquier combinación de tipo, sentimiento, categoria,
+        fecha (día) y hora; devuelve count, score_promedio y magnitude_promedio
+        """
+        claves = list(claves)
+        for clave in claves:
+            if clave not in COLUMNAS_AGRUPABLES:
+                raise ValueError(f"No se puede agrupar por {clave}")
+
+        cubo = self._cube_reduce(claves, **filtros)
+        if cubo is not None:
+            agregado, etiquetas = cubo
+            return self._rows(claves, etiquetas, agregado["count"].reshape(-1),
+                              agregado["suma"].reshape(-1), agregado["count_mag"].reshape(-1),
+                              agregado["suma_mag"].reshape(-1))
+
+        return self._group_by_scan(claves, **filtros)
+
+    def _labels(self, clave: str, filtro) -> List[str]:
+        """Etiquetas de una dimensión del cubo tras aplicar su filtro"""
+        diccionario = {"tipo": self.tipos, "sentimiento": self.sentimientos,
+                       "categoria": self.categorias}[clave]
+        if filtro:
+            return [diccionario.valores[c] for c in self._codes(diccionario, filtro)]
+        return list(diccionario.valores)
+
+    def _group_by_scan(self, claves: List[str], **filtros) -> List[Dict[str, Any]]:
+        """Agrupación recorriendo las columnas (hora, rangos con horas...)"""
+        necesarias = ["score", "magnitude", "timestamp"] + [c for c in claves if c not in ("fecha", "hora")]
+        cols = self._select(self._columns(), necesarias, **filtros)
+        score = cols["score"].astype(np.float64)
+        magnitude = cols["magnitude"].astype(np.float64)
+
+        # Codificar cada clave como entero y combinarlas en una sola clave mixta
+        codigos, etiquetas = [], []
+        for clave in claves:
+            if clave in ("fecha", "hora"):
+                unidad = _DIA if clave == "fecha" else 3600
+                valores, inversos = np.unique(cols["timestamp"] // unidad, return_inverse=True)
+                formato = "datetime64[D]" if clave == "fecha" else "datetime64[h]"
+                etiquetas.append([str((v * unidad).astype("datetime64[s]").astype(formato)) for v in valores])
+                codigos.append(inversos.astype(np.int64))
+            else:
+                etiquetas.append(self._labels(clave, None))
+                codigos.append(cols[clave].astype(np.int64))
+
+        tamanos = [max(1, len(e)) for e in etiquetas]
+        clave_mixta = np.zeros(len(score), dtype=np.int64)
+        for codigo, tamano in zip(codigos, tamanos):
+            clave_mixta = clave_mixta * tamano + codigo
+        total_grupos = int(np.prod(tamanos)) if tamanos else 1
+
+        con_magnitud = ~np.isnan(magnitude)
+        return self._rows(
+            claves, etiquetas,
+            np.bincount(clave_mixta, minlength=total_grupos),
+            np.bincount(clave_mixta, weights=score, minlength=total_grupos),
+            np.bincount(clave_mixta[con_magnitud], minlength=total_grupos),
+            np.bincount(clave_mixta[con_magnitud], weights=magnitude[con_magnitud], minlength=total_grupos),
+        )
+
+    @staticmethod
+    def _rows(claves, etiquetas, cuentas, sumas, cuentas_mag, sumas_mag) -> List[Dict[str, Any]]:
+        """Convertir los agregados (índice mixto en orden C) en filas de resultado"""
+        tamanos = [max(1, len(e)) for e in etiquetas]
+        resultado = []
+        for grupo in np.flatnonzero(cuentas):
+            fila = {}
+            indices = np.unravel_index(int(grupo), tamanos) if claves else ()
+            for clave, etiqueta, indice in zip(claves, etiquetas, indices):
+                fila[clave] = etiqueta[indice] or None
+            fila["count"] = int(cuentas[grupo])
+            fila["score_promedio"] = round(float(sumas[grupo] / cuentas[grupo]), 3)
+            fila["magnitude_promedio"] = (
+                round(float(sumas_mag[grupo] / cuentas_mag[grupo]), 3) if cuentas_mag[grupo] else None
+            )
+            resultado.append(fila)
+        return resultado
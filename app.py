@@ -1,41 +1,114 @@
 # -*- coding: utf-8 -*-
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+import time
+_IMPORT_INICIO = time.perf_counter()
+
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from database import FeedbackDatabase
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from dotenv import load_dotenv
+
+# Cargar variables de entorno antes de importar los módulos del proyecto,
+# que leen su configuración (os.getenv) al importarse
+load_dotenv()
+
+from database import FeedbackDatabase, SCHEMA_AUTO_MIGRATE
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from starlette.requests import Request
+from starlette.concurrency import run_in_threadpool
 import os
-from dotenv import load_dotenv
 from typing import Optional, Dict, Any, List
 from datetime import datetime
 import json
+import logging
+import math
 import uuid
-
-# Google Cloud APIs
-from google.cloud import language_v1
-from google.cloud import speech_v1
-from google.cloud import vision
+import asyncio
+from contextlib import asynccontextmanager
+
+# Google Cloud APIs (los SDK se importan bajo demanda)
+import google_clients
+import admission
+import alerts
+import chatbot
+import http_cache
+import logs
+import profiling
+import quota
+import static_assets
+from events import FeedbackBroker
+from analytics import AnalyticsEngine
+from writer import WriterBusyError, WriterError, get_writer
+import image_processing
+import audio_processing
+
+# Logging estructurado en JSON lines (la escritura va en su propio hilo)
+logs.setup()
+logger = logging.getLogger(__name__)
 
 # Dialogflow (opcional - el chatbot funciona sin él)
-try:
-    from google.cloud import dialogflow
-    DIALOGFLOW_AVAILABLE = True
-except ImportError:
-    DIALOGFLOW_AVAILABLE = False
-    print("⚠️  Dialogflow no disponible - Chatbot funcionará en modo simple")
-
-# Cargar variables de entorno
-load_dotenv()
+DIALOGFLOW_AVAILABLE = google_clients.dialogflow_available()
+if not DIALOGFLOW_AVAILABLE:
+    logger.warning("⚠️  Dialogflow no disponible - Chatbot funcionará en modo simple")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Arranque y parada de la aplicación"""
+    logger.info(f"⏱️ app importada en {APP_IMPORT_MS} ms")
+    if analytics is not None:
+        # Se carga antes de aceptar tráfico y luego se amplía con cada insert
+        inicio = time.perf_counter()
+        await run_in_threadpool(analytics.load, db)
+        db.add_listener(analytics.on_feedback)
+        db.add_resync_hook(lambda: analytics.reload(db))
+        logger.info(f"📈 Analítica en memoria: {analytics.n} filas, "
+                    f"{analytics.memory_bytes() // 1024} KB, {round((time.perf_counter() - inicio) * 1000)} ms")
+    # Ventanas deslizantes y alertas: se reconstruyen con el feedback reciente
+    inicio = time.perf_counter()
+    await run_in_threadpool(monitor.load, db)
+    logger.info(f"🚨 Ventanas en tiempo real: {len(monitor.series)} series, "
+                f"{round((time.perf_counter() - inicio) * 1000)} ms")
+    db.add_listener(monitor.on_feedback)
+    db.add_resync_hook(lambda: monitor.reload(db))
+    # Respuestas del chatbot listas antes de aceptar tráfico; se recalculan
+    # en segundo plano con cada cambio
+    await run_in_threadpool(bot.refresh)
+    db.add_listener(bot.on_feedback)
+    db.add_resync_hook(bot.invalidate)
+    bot.start()
+    if db.writer is not None:
+        # Modo multi-worker: recibir las escrituras confirmadas por el escritor.
+        # Se suscribe con los listeners ya registrados; al conectar se hace un
+        # resync que recoge lo escrito por otros workers durante la carga
+        if await run_in_threadpool(db.writer.start_subscription, db):
+            logger.info(f"✍️ Escrituras delegadas al proceso escritor ({db.writer.address})")
+        else:
+            logger.warning(f"⚠️ Proceso escritor no disponible en {db.writer.address}, reintentando en segundo plano")
+    if db.writer is None and SCHEMA_AUTO_MIGRATE:
+        # Migración en línea al esquema codificado (la hace quien escribe)
+        asyncio.get_running_loop().run_in_executor(None, migrar_esquema)
+    warmup_task = None
+    if google_clients.warmup_enabled():
+        # Se lanza en segundo plano: el servidor empieza a aceptar tráfico
+        # mientras se abren los canales de Google
+        warmup_task = asyncio.get_running_loop().run_in_executor(None, google_clients.warmup)
+    yield
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+
 
 # Inicializar FastAPI
 app = FastAPI(
     title="Sistema de Análisis de Feedback",
     description="Análisis multimodal con Google Cloud + Chatbot",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
+# Control de admisión de /api/analyze/* (dentro de CORS para que los 503
+# lleven sus cabeceras)
+app.add_middleware(admission.AdmissionMiddleware)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -45,26 +118,98 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compresión de las respuestas JSON/HTML grandes
+app.add_middleware(static_assets.CompressionMiddleware)
+
+# Perfilado bajo demanda (solo se instala si PROFILE_TOKEN o PROFILE_SAMPLE_RATE)
+if profiling.enabled():
+    app.add_middleware(profiling.ProfilingMiddleware)
+
+# request_id de cada petición en los logs (y en la cabecera X-Request-ID);
+# es el más externo para que lo vean todos los demás
+app.add_middleware(logs.RequestIdMiddleware)
+
 # Archivos estáticos y templates
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# (con huella de contenido, caché inmutable y variantes gzip/brotli)
+assets = static_assets.StaticAssets("static")
+app.mount("/static", assets, name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["asset_url"] = assets.url
 
 # Configurar encoding UTF-8 para respuestas
 from starlette.responses import Response
 Response.charset = "utf-8"
 
-# Inicializar clientes de Google Cloud
-language_client = language_v1.LanguageServiceClient()
-speech_client = speech_v1.SpeechClient()
-vision_client = vision.ImageAnnotatorClient()
-
 # Cliente de Dialogflow
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT_ID")
 LANGUAGE_CODE = "es"
 
+# Motor de analítica columnar en memoria (opcional)
+ANALYTICS_ENGINE = os.getenv("ANALYTICS_ENGINE", "1").lower() in ("1", "true", "yes")
+
+# Reutilizar el análisis de un feedback casi idéntico en vez de llamar a Google
+DEDUP_REUSE_ANALYSIS = os.getenv("DEDUP_REUSE_ANALYSIS", "1").lower() in ("1", "true", "yes")
+
 # Instanciar base de datos
 db = FeedbackDatabase("feedback_analytics.db")
 
+# Con varios workers, las escrituras van al proceso escritor (writer.py)
+db.writer = get_writer()
+
+# Feed en vivo (SSE) alimentado desde add_feedback
+broker = FeedbackBroker(db)
+db.add_listener(broker.on_feedback)
+db.add_resync_hook(broker.reset)
+
+analytics = AnalyticsEngine() if ANALYTICS_ENGINE else None
+
+# Agregados de 1/15/60 minutos y alertas de picos de negativos
+monitor = alerts.SpikeMonitor()
+
+# Chatbot con contexto por sesión y respuestas precalculadas
+bot = chatbot.ChatbotEngine(db)
+
+if profiling.enabled():
+    profiling.install(db)
+
+# Tiempo de importación del módulo (informe de arranque)
+APP_IMPORT_MS = round((time.perf_counter() - _IMPORT_INICIO) * 1000, 1)
+
+
+def migrar_esquema():
+    """Migrar la base de datos al esquema codificado sin detener el servicio"""
+    try:
+        db.migrate_schema()
+    except Exception:
+        logger.exception("⚠️ Error al migrar el esquema")
+
+
+async def guardar_feedback(datos: Dict[str, Any]) -> bool:
+    """Guardar un feedback; 503 si el escritor no lo confirma y 500 si falla la base de datos"""
+    # Los registros de la petición (y de la base de datos) llevan el feedback_id
+    logs.bind(feedback_id=datos.get("id"))
+    try:
+        guardado = await run_in_threadpool(db.add_feedback, datos)
+        if not guardado:
+            logger.warning("⚠️ Feedback analizado pero no guardado", extra={"evento": "feedback_no_guardado"})
+        return guardado
+    except WriterBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except WriterError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except Exception:
+        # El análisis no se devuelve como éxito si no ha quedado guardado
+        raise HTTPException(status_code=500, detail="No se pudo guardar el feedback")
+
+
+async def llamar_google(api: str, fn, *args, **kwargs):
+    """Llamada a una API de Google a través del planificador de cuotas (carril interactivo)"""
+    try:
+        return await run_in_threadpool(quota.call, api, fn, *args, **kwargs)
+    except quota.QuotaExceededError as e:
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": str(math.ceil(e.retry_after))})
+
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
@@ -83,22 +228,50 @@ async def health():
         "status": "ok",
         "apis": apis,
         "chatbot": "enabled",
-        "chatbot_mode": "advanced" if DIALOGFLOW_AVAILABLE else "simple"
+        "chatbot_mode": "advanced" if DIALOGFLOW_AVAILABLE else "simple",
+        "chatbot_respuestas": bot.snapshot(),
+        "arranque": {
+            "app_import_ms": APP_IMPORT_MS,
+            "clientes": google_clients.startup_report()
+        }
     }
 
 
+@app.get("/api/quota")
+async def quota_stats():
+    """Cuotas de las APIs de Google: tasa actual y espera por carril"""
+    return {"success": True, "apis": quota.scheduler.stats()}
+
+
+@app.get("/api/admission")
+async def admission_stats():
+    """Peticiones de análisis en curso, en cola y rechazadas por tipo"""
+    return {"success": True, "endpoints": admission.stats()}
+
+
 @app.post("/api/analyze/text")
 async def analyze_text(text: str = Form(...)):
     """Analiza texto con Google Natural Language API"""
     try:
+        # Feedback casi duplicado: se reutiliza el análisis anterior (las
+        # consultas a SQLite, fuera del event loop)
+        duplicado = await run_in_threadpool(db.find_duplicate, text)
+        if duplicado and DEDUP_REUSE_ANALYSIS:
+            original = await run_in_threadpool(db.get_feedback, duplicado["feedback_id"])
+            if original:
+                return await reutilizar_analisis_texto(text, original, duplicado)
+        
+        language_v1 = google_clients.language_module()
+        language_client = google_clients.get_language_client()
+        
         document = language_v1.Document(
             content=text,
             type_=language_v1.Document.Type.PLAIN_TEXT,
             language="es"
         )
         
-        sentiment_response = language_client.analyze_sentiment(
-            request={"document": document}
+        sentiment_response = await llamar_google(
+            "language", language_client.analyze_sentiment, request={"document": document}
         )
         
         sentiment = sentiment_response.document_sentiment
@@ -115,8 +288,8 @@ async def analyze_text(text: str = Form(...)):
             label = "neutral"
             emoji = "😐"
         
-        entities_response = language_client.analyze_entities(
-            request={"document": document}
+        entities_response = await llamar_google(
+            "language", language_client.analyze_entities, request={"document": document}
         )
         
         entities = []
@@ -140,8 +313,8 @@ async def analyze_text(text: str = Form(...)):
             })
         
         try:
-            classification_response = language_client.classify_text(
-                request={"document": document}
+            classification_response = await llamar_google(
+                "language", language_client.classify_text, request={"document": document}
             )
             
             if classification_response.categories:
@@ -160,7 +333,7 @@ async def analyze_text(text: str = Form(...)):
             recomendacion = "Feedback neutral, hacer seguimiento"
         
         # Guardar en base de datos
-        db.add_feedback({
+        await guardar_feedback({
             "id": str(uuid.uuid4()),
             "tipo": "texto",
             "sentimiento": label,
@@ -168,7 +341,8 @@ async def analyze_text(text: str = Form(...)):
             "magnitude": round(magnitude, 2),
             "categoria": categoria,
             "texto": text,
-            "entidades": entities
+            "entidades": entities,
+            "duplicado_de": duplicado["feedback_id"] if duplicado else None
         })
 
         
@@ -185,6 +359,8 @@ async def analyze_text(text: str = Form(...)):
             "recomendacion": recomendacion
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
@@ -193,17 +369,31 @@ async def analyze_text(text: str = Form(...)):
 async def analyze_audio(file: UploadFile = File(...)):
     """Transcribe audio con Speech-to-Text y analiza el contenido"""
     try:
+        speech_v1 = google_clients.speech_module()
+        language_v1 = google_clients.language_module()
+        
         audio_content = await file.read()
-        audio = speech_v1.RecognitionAudio(content=audio_content)
+        
+        # Normalización: mono, 16 kHz y sin silencios al principio/final
+        pcm, info = await run_in_threadpool(audio_processing.normalize_wav, audio_content)
+        del audio_content
+        logger.info(f"🎤 Audio {info['canales_originales']}ch {info['sample_rate_original']} Hz "
+                    f"{info['duracion_original']}s -> 1ch {info['sample_rate']} Hz {info['duracion']}s: "
+                    f"{info['bytes_ahorrados']} bytes ahorrados", extra={"evento": "audio_normalizado"})
+        
+        audio = speech_v1.RecognitionAudio(content=pcm)
         
         config = speech_v1.RecognitionConfig(
             encoding=speech_v1.RecognitionConfig.AudioEncoding.LINEAR16,
-            audio_channel_count=2,
+            sample_rate_hertz=info["sample_rate"],
+            audio_channel_count=1,
             language_code="es-ES",
             enable_automatic_punctuation=True
         )
         
-        response = speech_client.recognize(config=config, audio=audio)
+        response = await llamar_google(
+            "speech", google_clients.get_speech_client().recognize, config=config, audio=audio
+        )
         
         if not response.results:
             raise HTTPException(
@@ -221,32 +411,43 @@ async def analyze_audio(file: UploadFile = File(...)):
         transcripcion = transcripcion.strip()
         confianza_promedio = sum(confidencias) / len(confidencias)
         
-        document = language_v1.Document(
-            content=transcripcion,
-            type_=language_v1.Document.Type.PLAIN_TEXT,
-            language="es"
-        )
+        # Transcripción casi duplicada: se reutiliza el sentimiento anterior
+        duplicado = await run_in_threadpool(db.find_duplicate, transcripcion)
+        original = None
+        if duplicado and DEDUP_REUSE_ANALYSIS:
+            original = await run_in_threadpool(db.get_feedback, duplicado["feedback_id"])
         
-        sentiment_response = language_client.analyze_sentiment(
-            request={"document": document}
-        )
-        sentiment = sentiment_response.document_sentiment
+        if original:
+            score = original["score"]
+        else:
+            document = language_v1.Document(
+                content=transcripcion,
+                type_=language_v1.Document.Type.PLAIN_TEXT,
+                language="es"
+            )
+            
+            sentiment_response = await llamar_google(
+                "language", google_clients.get_language_client().analyze_sentiment,
+                request={"document": document}
+            )
+            score = sentiment_response.document_sentiment.score
         
-        if sentiment.score > 0.25:
+        if score > 0.25:
             label = "positivo"
-        elif sentiment.score < -0.25:
+        elif score < -0.25:
             label = "negativo"
         else:
             label = "neutral"
         
         # Guardar en base de datos
-        db.add_feedback({
+        await guardar_feedback({
             "id": str(uuid.uuid4()),
             "tipo": "audio",
             "sentimiento": label,
-            "score": round(sentiment.score, 2),
+            "score": round(score, 2),
             "texto": transcripcion,
-            "audio_confianza": round(confianza_promedio, 2)
+            "audio_confianza": round(confianza_promedio, 2),
+            "duplicado_de": duplicado["feedback_id"] if duplicado else None
         })
         
         return {
@@ -255,12 +456,14 @@ async def analyze_audio(file: UploadFile = File(...)):
             "confianza_audio": round(confianza_promedio, 2),
             "sentimiento": {
                 "clasificacion": label,
-                "score": round(sentiment.score, 2)
+                "score": round(score, 2)
             }
         }
         
     except HTTPException:
         raise
+    except audio_processing.InvalidAudioError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
@@ -269,80 +472,55 @@ async def analyze_audio(file: UploadFile = File(...)):
 async def analyze_image(file: UploadFile = File(...)):
     """Analiza imágenes con Vision API"""
     try:
-        image_content = await file.read()
+        # Preprocesado: volcado a disco, validación, reducción y sin EXIF
+        spool, _ = await image_processing.spool_upload(file)
+        try:
+            image_content, info = await run_in_threadpool(image_processing.prepare_image, spool)
+        finally:
+            spool.close()
+        logger.info(f"🖼️ Imagen {info['formato_original']} {info['dimensiones_originales']} -> "
+                    f"{info['dimensiones']}: {info['bytes_originales']} -> {info['bytes_enviados']} bytes",
+                    extra={"evento": "imagen_preparada"})
+        
+        vision = google_clients.vision_module()
+        vision_client = google_clients.get_vision_client()
         image = vision.Image(content=image_content)
         
-        face_response = vision_client.face_detection(image=image)
-        faces = face_response.face_annotations
-        
-        likelihood_map = {
-            vision.Likelihood.VERY_UNLIKELY: 0.1,
-            vision.Likelihood.UNLIKELY: 0.3,
-            vision.Likelihood.POSSIBLE: 0.5,
-            vision.Likelihood.LIKELY: 0.7,
-            vision.Likelihood.VERY_LIKELY: 0.9
-        }
-        
-        caras_info = []
-        if faces:
-            for face in faces[:3]:
-                emociones = {
-                    "alegria": likelihood_map.get(face.joy_likelihood, 0),
-                    "tristeza": likelihood_map.get(face.sorrow_likelihood, 0),
-                    "enojo": likelihood_map.get(face.anger_likelihood, 0),
-                    "sorpresa": likelihood_map.get(face.surprise_likelihood, 0)
-                }
-                
-                emocion_dominante = max(emociones.items(), key=lambda x: x[1])
-                
-                caras_info.append({
-                    "emociones": emociones,
-                    "emocion_principal": emocion_dominante[0]
-                })
-        
-        labels_response = vision_client.label_detection(image=image, max_results=10)
-        labels = labels_response.label_annotations
-        
-        objetos = []
-        for label in labels:
-            objetos.append({
-                "nombre": label.description,
-                "confianza": round(label.score, 2)
-            })
-        
-        text_response = vision_client.text_detection(image=image)
-        texts = text_response.text_annotations
-        
-        texto_detectado = texts[0].description if texts else ""
+        # Una sola petición con las tres detecciones (la imagen se sube una vez)
+        annotation = await llamar_google("vision", vision_client.annotate_image, {
+            "image": image,
+            "features": image_processing.vision_features(vision)
+        })
+        if annotation.error.message:
+            raise Exception(annotation.error.message)
         
-        sentimiento_imagen = "neutral"
-        if caras_info:
-            if caras_info[0]["emocion_principal"] == "alegria":
-                sentimiento_imagen = "positivo"
-            elif caras_info[0]["emocion_principal"] in ["tristeza", "enojo"]:
-                sentimiento_imagen = "negativo"
+        analisis = image_processing.summarize_annotation(annotation, vision)
         
         # Guardar en base de datos
-        db.add_feedback({
+        await guardar_feedback({
             "id": str(uuid.uuid4()),
             "tipo": "imagen",
-            "sentimiento": sentimiento_imagen,
+            "sentimiento": analisis["sentimiento"],
             "score": 0,
-            "rostros": len(faces),
-            "objetos": objetos
+            "rostros": analisis["rostros"],
+            "objetos": analisis["objetos"]
         })
         
         return {
             "success": True,
             "caras": {
-                "cantidad": len(faces),
-                "detalles": caras_info
+                "cantidad": analisis["rostros"],
+                "detalles": analisis["caras"]
             },
-            "objetos": objetos,
-            "texto": texto_detectado[:200] if texto_detectado else "",
-            "sentimiento_visual": sentimiento_imagen
+            "objetos": analisis["objetos"],
+            "texto": analisis["texto"][:200],
+            "sentimiento_visual": analisis["sentimiento"]
         }
         
+    except HTTPException:
+        raise
+    except image_processing.InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
@@ -428,10 +606,14 @@ async def dialogflow_webhook(request: Request):
     try:
         req = await request.json()
         
-        intent_name = req.get("queryResult", {}).get("intent", {}).get("displayName", "")
-        parameters = req.get("queryResult", {}).get("parameters", {})
+        query_result = req.get("queryResult", {})
+        intent_name = query_result.get("intent", {}).get("displayName", "")
+        parameters = query_result.get("parameters", {})
         
-        response_text = handle_intent(intent_name, parameters)
+        # Sin consultas a la base de datos: respuestas precalculadas
+        response_text = bot.reply_dialogflow(intent_name, parameters,
+                                             query_text=query_result.get("queryText", ""),
+                                             session_id=req.get("session", "default"))
         
         return JSONResponse(content={
             "fulfillmentText": response_text
@@ -447,12 +629,13 @@ async def dialogflow_webhook(request: Request):
 async def chatbot_message(message: str = Form(...), session_id: str = Form(default="default")):
     """Endpoint directo para el chatbot (sin Dialogflow configurado)"""
     try:
-        # Si no hay Dialogflow configurado, usar respuestas predefinidas
-        response = generate_simple_response(message)
+        # Respuestas precalculadas, con el contexto de la sesión
+        respuesta = bot.reply(message, session_id)
         
         return {
             "success": True,
-            "response": response,
+            "response": respuesta["response"],
+            "intent": respuesta["intent"],
             "timestamp": datetime.now().isoformat()
         }
         
@@ -461,209 +644,244 @@ async def chatbot_message(message: str = Form(...), session_id: str = Form(defau
 
 
 @app.get("/api/chatbot/stats")
-async def get_stats():
-    """Obtener estadísticas para el chatbot"""
+async def get_stats(request: Request, excluir_duplicados: bool = False,
+                    desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Obtener estadísticas para el chatbot (opcionalmente de un rango [desde, hasta))"""
     try:
-        stats = db.get_statistics()
-        categories = db.get_categories()
-        recent = db.get_recent_feedback(limit=5)
+        def build():
+            return {
+                "success": True,
+                "statistics": db.get_statistics(excluir_duplicados=excluir_duplicados,
+                                                desde=desde, hasta=hasta),
+                "categories": db.get_categories(excluir_duplicados=excluir_duplicados,
+                                                desde=desde, hasta=hasta),
+                "recent_feedback": db.get_recent_feedback(limit=5)
+            }
         
-        return {
-            "success": True,
-            "statistics": stats,
-            "categories": categories,
-            "recent_feedback": recent
-        }
+        return http_cache.conditional_json(request, db.data_version(), build)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
-def handle_intent(intent_name: str, parameters: Dict[str, Any]) -> str:
-    """Maneja diferentes intents de Dialogflow"""
-    
-    if "estadisticas" in intent_name.lower() or "stats" in intent_name.lower():
-        stats = db.get_statistics()
-        return f"""📊 Estadísticas actuales:
-        
-• Total de feedback: {stats['total']}
-• Positivos: {stats['positivos']} ({stats['porcentaje_positivos']}%)
-• Negativos: {stats['negativos']} ({stats['porcentaje_negativos']}%)
-• Neutrales: {stats['neutrales']}
-• Score promedio: {stats['score_promedio']}
-
-¿Necesitas más información?"""
-    
-    elif "categorias" in intent_name.lower() or "categories" in intent_name.lower():
-        categories = db.get_categories()
-        if not categories:
-            return "No hay categorías registradas aún. Analiza más feedback para ver las categorías."
-        
-        cat_text = "📁 Distribución de categorías:\n\n"
-        for cat, count in categories.items():
-            cat_text += f"• {cat}: {count} feedback\n"
-        return cat_text
-    
-    elif "reciente" in intent_name.lower() or "recent" in intent_name.lower():
-        recent = db.get_recent_feedback(limit=3)
-        if not recent:
-            return "No hay feedback reciente registrado."
-        
-        text = "📝 Últimos 3 feedback:\n\n"
-        for idx, f in enumerate(recent, 1):
-            text += f"{idx}. {f.get('sentimiento', 'N/A').upper()} - {f.get('tipo', 'N/A')}\n"
-        return text
-    
-    elif "ayuda" in intent_name.lower() or "help" in intent_name.lower():
-        return """🤖 Puedo ayudarte con:
-
-• Ver estadísticas generales
-• Consultar categorías de feedback
-• Mostrar feedback reciente
-• Explicar cómo funcionan las APIs
-• Dar recomendaciones
-
-¿Qué te gustaría saber?"""
-    
-    elif "apis" in intent_name.lower():
-        return """☁️ Usamos estas APIs de Google Cloud:
-
-1. **Natural Language API**: Analiza sentimiento y entidades en texto
-2. **Speech-to-Text API**: Convierte audio a texto
-3. **Vision API**: Detecta rostros, emociones y objetos en imágenes
-4. **Dialogflow**: Yo! El chatbot inteligente 🤖
-
-¿Quieres saber más sobre alguna?"""
-    
-    else:
-        return "Entiendo tu pregunta. ¿Podrías reformularla? Puedo ayudarte con estadísticas, categorías, feedback reciente y más."
+@app.get("/api/stats/trends")
+async def get_trends(request: Request, days: int = 7):
+    """Tendencias diarias de los últimos N días"""
+    try:
+        return http_cache.conditional_json(request, db.data_version(), lambda: {
+            "success": True,
+            "trends": db.get_daily_trends(days=days)
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
-def generate_simple_response(message: str) -> str:
-    """Genera respuestas simples sin Dialogflow configurado"""
-    message = message.lower()
-    
-    # ESTADÍSTICAS - con y sin tildes
-    if any(word in message for word in ["estadística", "estadisticas", "estadística", "estadísticas", "stats", "números", "numeros", "cuántos", "cuantos", "datos", "total"]):
-        stats = db.get_statistics()
-        
-        if stats['total'] == 0:
-            return """📊 Estadísticas actuales:
+@app.get("/api/stats/categories")
+async def get_categories_stats(request: Request, excluir_duplicados: bool = False,
+                               desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Distribución de categorías y de sentimiento por categoría"""
+    try:
+        return http_cache.conditional_json(request, db.data_version(), lambda: {
+            "success": True,
+            "categories": db.get_categories(excluir_duplicados=excluir_duplicados,
+                                            desde=desde, hasta=hasta),
+            "sentiment_by_category": db.get_sentiment_by_category(excluir_duplicados=excluir_duplicados,
+                                                                  desde=desde, hasta=hasta)
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-Aún no hay feedback analizado. 
 
-¡Comienza analizando texto, audio o imágenes en las pestañas superiores!"""
-        
-        return f"""📊 Estadísticas actuales:
+@app.get("/api/stats/labels")
+async def get_labels_stats(request: Request, sentimiento: Optional[str] = None, limit: int = 10,
+                           desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Etiquetas de imagen más frecuentes por sentimiento"""
+    try:
+        limit = max(1, min(limit, 100))
+        return http_cache.conditional_json(request, db.data_version(), lambda: {
+            "success": True,
+            "labels": db.get_top_labels(sentimiento=sentimiento, limit=limit,
+                                        desde=desde, hasta=hasta)
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-• Total de feedback: {stats['total']} 
-• Positivos: {stats['positivos']} ({stats['porcentaje_positivos']}%)
-• Negativos: {stats['negativos']} ({stats['porcentaje_negativos']}%)
-• Neutrales: {stats['neutrales']}
-• Score promedio: {stats['score_promedio']}
 
-💡 Tip: Analiza más feedback para obtener mejores insights!"""
-    
-    # CATEGORÍAS - con y sin tildes
-    elif any(word in message for word in ["categoría", "categorias", "categoría", "categorías", "category", "tipo", "tipos", "clasificación", "clasificacion"]):
-        categories = db.get_categories()
-        
-        if not categories:
-            return """📁 Categorías:
+@app.get("/api/stats/realtime")
+async def get_realtime_stats():
+    """Feedback de los últimos 1, 15 y 60 minutos, en total, por categoría y por canal"""
+    try:
+        return {"success": True, "windows": monitor.windows()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-Aún no hay categorías detectadas. 
 
-Analiza más feedback para que el sistema identifique automáticamente las categorías de productos o servicios mencionados."""
-        
-        text = "📁 Categorías detectadas:\n\n"
-        for cat, count in sorted(categories.items(), key=lambda x: x[1], reverse=True):
-            text += f"• {cat}: {count} feedback\n"
-        
-        text += f"\n📈 Total de categorías: {len(categories)}"
-        return text
-    
-    # FEEDBACK RECIENTE - con y sin tildes
-    elif any(word in message for word in ["reciente", "recientes", "último", "ultimos", "últimos", "ultimo", "recent", "nuevo", "nuevos"]):
-        recent = db.get_recent_feedback(limit=5)
-        
-        if not recent:
-            return """📝 Feedback reciente:
+@app.get("/api/alerts")
+async def get_alerts():
+    """Picos de feedback negativo activos y recientes"""
+    try:
+        return {"success": True, **monitor.alerts()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-No hay feedback registrado todavía.
 
-¡Usa las pestañas superiores para analizar texto, audio o imágenes!"""
-        
-        text = f"📝 Últimos {len(recent)} feedback analizados:\n\n"
-        for idx, f in enumerate(recent, 1):
-            sentimiento = f.get('sentimiento', 'N/A').upper()
-            tipo = f.get('tipo', 'N/A').capitalize()
-            emoji = "😊" if sentimiento == "POSITIVO" else "😞" if sentimiento == "NEGATIVO" else "😐"
-            text += f"{idx}. {emoji} {sentimiento} - Tipo: {tipo}\n"
-        
-        return text
-    
-    # AYUDA / HOLA
-    elif any(word in message for word in ["hola", "ayuda", "help", "qué puedes", "que puedes", "hola", "buenas", "buenos", "hey"]):
-        return """👋 ¡Hola! Soy tu asistente de feedback.
+@app.get("/api/feedback/recent")
+async def list_recent_feedback(request: Request, limit: int = 20):
+    """Listado del feedback más reciente"""
+    try:
+        limit = max(1, min(limit, 100))
+        return http_cache.conditional_json(request, db.data_version(), lambda: {
+            "success": True,
+            "feedback": db.get_recent_feedback(limit=limit)
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-Puedo ayudarte con:
-• 📊 Estadísticas generales del feedback
-• 📁 Ver categorías detectadas
-• 📝 Consultar feedback reciente
-• ☁️ Información sobre las APIs de Google Cloud
 
-💬 Escribe tu pregunta o usa los botones de abajo."""
+@app.get("/api/stream/feedback")
+async def stream_feedback(request: Request):
+    """Feed en vivo (Server-Sent Events) de feedback nuevo y deltas de estadísticas"""
+    sub = broker.subscribe()
+    if sub is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiados clientes conectados al feed",
+            headers={"Retry-After": "30"}
+        )
     
-    # APIs / TECNOLOGÍA
-    elif any(word in message for word in ["api", "apis", "google", "cloud", "tecnología", "tecnologia", "cómo funciona", "como funciona"]):
-        return """☁️ Google Cloud AI - Tecnología utilizada:
+    return StreamingResponse(
+        broker.stream(sub, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-1. **Natural Language API**
-   📝 Analiza sentimiento y extrae entidades del texto
 
-2. **Speech-to-Text API**
-   🎤 Convierte grabaciones de voz a texto
+# =====================================================
+# ANALÍTICA EN MEMORIA
+# =====================================================
 
-3. **Vision API**
-   👁️ Detecta rostros, emociones y objetos en imágenes
+def _analytics_filters(desde: Optional[str], hasta: Optional[str], tipo: Optional[List[str]],
+                       sentimiento: Optional[List[str]], categoria: Optional[List[str]],
+                       excluir_duplicados: bool) -> Dict[str, Any]:
+    """Filtros comunes de los endpoints de analítica"""
+    if analytics is None:
+        raise HTTPException(status_code=503, detail="Motor de analítica desactivado (ANALYTICS_ENGINE=0)")
+    return {
+        "desde": desde, "hasta": hasta, "tipo": tipo, "sentimiento": sentimiento,
+        "categoria": categoria, "excluir_duplicados": excluir_duplicados
+    }
 
-4. **Chatbot (yo)**
-   🤖 ¡Tu asistente inteligente!
 
-🔗 Todo integrado con FastAPI + Python"""
+@app.get("/api/analytics/histogram")
+async def analytics_histogram(
+    request: Request,
+    columna: str = "score",
+    bins: int = Query(20, ge=1, le=200),
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    tipo: Optional[List[str]] = Query(None),
+    sentimiento: Optional[List[str]] = Query(None),
+    categoria: Optional[List[str]] = Query(None),
+    excluir_duplicados: bool = False
+):
+    """Histograma de score o magnitude con filtros"""
+    filtros = _analytics_filters(desde, hasta, tipo, sentimiento, categoria, excluir_duplicados)
+    try:
+        return http_cache.conditional_json(request, db.data_version(), lambda: {
+            "success": True,
+            **analytics.histogram(columna=columna, bins=bins, **filtros)
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/analytics/percentiles")
+async def analytics_percentiles(
+    request: Request,
+    columna: str = "score",
+    p: List[float] = Query([50, 90, 99]),
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    tipo: Optional[List[str]] = Query(None),
+    sentimiento: Optional[List[str]] = Query(None),
+    categoria: Optional[List[str]] = Query(None),
+    excluir_duplicados: bool = False
+):
+    """Percentiles de score o magnitude con filtros"""
+    filtros = _analytics_filters(desde, hasta, tipo, sentimiento, categoria, excluir_duplicados)
+    if any(x < 0 or x > 100 for x in p):
+        raise HTTPException(status_code=400, detail="Los percentiles deben estar entre 0 y 100")
+    try:
+        return http_cache.conditional_json(request, db.data_version(), lambda: {
+            "success": True,
+            **analytics.percentiles(columna=columna, percentiles=p, **filtros)
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/analytics/groupby")
+async def analytics_group_by(
+    request: Request,
+    por: List[str] = Query(["categoria"]),
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    tipo: Optional[List[str]] = Query(None),
+    sentimiento: Optional[List[str]] = Query(None),
+    categoria: Optional[List[str]] = Query(None),
+    excluir_duplicados: bool = False
+):
+    """Agrupar por tipo, sentimiento, categoria, fecha u hora con filtros"""
+    filtros = _analytics_filters(desde, hasta, tipo, sentimiento, categoria, excluir_duplicados)
+    try:
+        return http_cache.conditional_json(request, db.data_version(), lambda: {
+            "success": True,
+            "grupos": analytics.group_by(por, **filtros)
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def reutilizar_analisis_texto(text: str, original: Dict[str, Any],
+                              duplicado: Dict[str, Any]) -> Dict[str, Any]:
+    """Construir la respuesta de analyze_text a partir de un feedback casi idéntico"""
+    label = original["sentimiento"]
+    emoji = {"positivo": "😊", "negativo": "😞"}.get(label, "😐")
+    recomendacion = {
+        "positivo": "Cliente satisfecho! Considerar para testimonios",
+        "negativo": "URGENTE: Cliente insatisfecho, contactar inmediatamente"
+    }.get(label, "Feedback neutral, hacer seguimiento")
     
-    # SENTIMIENTO
-    elif any(word in message for word in ["sentimiento", "positivo", "negativo", "neutral", "cómo van", "como van"]):
-        stats = db.get_statistics()
-        
-        if stats['total'] == 0:
-            return "Aún no hay análisis de sentimiento. ¡Analiza feedback primero!"
-        
-        if stats['porcentaje_positivos'] > 60:
-            resumen = "¡Excelente! La mayoría del feedback es positivo 😊"
-        elif stats['porcentaje_negativos'] > 40:
-            resumen = "⚠️ Atención: Hay bastante feedback negativo"
-        else:
-            resumen = "El feedback está balanceado"
-        
-        return f"""😊 Análisis de Sentimiento:
-
-{resumen}
-
-• Positivos: {stats['porcentaje_positivos']}%
-• Negativos: {stats['porcentaje_negativos']}%
-• Score promedio: {stats['score_promedio']}"""
+    entities = [
+        {"nombre": e["nombre"], "tipo": e["tipo"], "relevancia": e["relevancia"]}
+        for e in original["entidades"]
+    ]
     
-    # NO ENTENDIDO
-    else:
-        return """🤔 No estoy seguro de entender tu pregunta.
-
-Intenta preguntar sobre:
-• 📊 "Muéstrame las estadísticas"
-• 📁 "¿Qué categorías tengo?"
-• 📝 "Feedback reciente"
-• ☁️ "¿Qué APIs usas?"
-
-O usa los botones de sugerencias abajo 👇"""
+    # Se guarda igualmente, marcado como duplicado
+    await guardar_feedback({
+        "id": str(uuid.uuid4()),
+        "tipo": "texto",
+        "sentimiento": label,
+        "score": original["score"],
+        "magnitude": original["magnitude"],
+        "categoria": original["categoria"],
+        "texto": text,
+        "entidades": entities,
+        "duplicado_de": duplicado["feedback_id"]
+    })
+    
+    return {
+        "success": True,
+        "sentimiento": {
+            "clasificacion": label,
+            "emoji": emoji,
+            "score": original["score"],
+            "intensidad": original["magnitude"] or 0
+        },
+        "entidades": entities,
+        "categoria": original["categoria"],
+        "recomendacion": recomendacion,
+        "duplicado": duplicado
+    }
 
 
 def categorizar_manual(text):
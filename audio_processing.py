@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Normalización de audio antes de enviarlo a Speech-to-Text
+
+Decodifica el PCM del WAV con NumPy, lo mezcla a mono, lo remuestrea a
+16 kHz (si viene a más) y recorta el silencio inicial y final.
+Speech-to-Text no gana precisión con estéreo ni con frecuencias de
+muestreo mayores, así que se envían muchos menos bytes con la misma
+calidad de transcripción.
+"""
+import os
+import struct
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+
+# Configuración (variables de entorno)
+AUDIO_TARGET_RATE = int(os.getenv("AUDIO_TARGET_RATE", "16000"))
+AUDIO_SILENCE_DB = float(os.getenv("AUDIO_SILENCE_DB", "-40"))  # respecto al pico
+AUDIO_SILENCE_MARGIN_MS = int(os.getenv("AUDIO_SILENCE_MARGIN_MS", "200"))
+
+# Duración de las ventanas usadas para medir la energía
+_FRAME_MS = 20
+
+# Códigos de formato WAV soportados
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class InvalidAudioError(ValueError):
+    """El audio no es un WAV PCM que se pueda decodificar"""
+
+
+def _parse_wav(contenido: bytes) -> Tuple[Dict[str, int], memoryview]:
+    """Leer la cabecera fmt y localizar el bloque de datos de un RIFF/WAVE"""
+    if len(contenido) < 12 or contenido[:4] != b"RIFF" or contenido[8:12] != b"WAVE":
+        raise InvalidAudioError("El audio debe estar en formato WAV")
+
+    fmt = None
+    datos = None
+    pos = 12
+    vista = memoryview(contenido)
+    while pos + 8 <= len(contenido):
+        chunk_id = contenido[pos:pos + 4]
+        chunk_size = struct.unpack("<I", contenido[pos + 4:pos + 8])[0]
+        inicio = pos + 8
+        if chunk_id == b"fmt ":
+            if chunk_size < 16 or inicio + 16 > len(contenido):
+                raise InvalidAudioError("WAV con cabecera fmt incompleta")
+            formato, canales, rate, _, _, bits = struct.unpack("<HHIIHH", contenido[inicio:inicio + 16])
+            if formato == _WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # El subformato (GUID) empieza por el código de formato real
+                formato = struct.unpack("<H", contenido[inicio + 24:inicio + 26])[0]
+            fmt = {"formato": formato, "canales": canales, "rate": rate, "bits": bits}
+        elif chunk_id == b"data":
+            # Algunos grabadores dejan el tamaño a 0 o mayor que el fichero
+            fin = min(inicio + chunk_size, len(contenido)) if chunk_size else len(contenido)
+            datos = vista[inicio:fin]
+            break
+        pos = inicio + chunk_size + (chunk_size & 1)
+
+    if fmt is None or datos is None:
+        raise InvalidAudioError("WAV incompleto: faltan los bloques fmt o data")
+    if fmt["canales"] < 1:
+        raise InvalidAudioError("WAV sin canales")
+    if fmt["rate"] < 1:
+        raise InvalidAudioError("WAV con frecuencia de muestreo 0")
+    if fmt["bits"] < 8 or fmt["bits"] % 8:
+        raise InvalidAudioError(f"WAV con {fmt['bits']} bits por muestra no soportado")
+    return fmt, datos
+
+
+def _decode_pcm(fmt: Dict[str, int], datos: memoryview) -> np.ndarray:
+    """Convertir las muestras a float32 en [-1, 1] con forma (frames, canales)"""
+    formato, canales, bits = fmt["formato"], fmt["canales"], fmt["bits"]
+    ancho = bits // 8
+    util = len(datos) - len(datos) % (ancho * canales)
+    datos = datos[:util]
+
+    if formato == _WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+        muestras = np.frombuffer(datos, dtype="<f4" if bits == 32 else "<f8").astype(np.float32)
+    elif formato == _WAVE_FORMAT_PCM and bits == 8:
+        muestras = (np.frombuffer(datos, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif formato == _WAVE_FORMAT_PCM and bits == 16:
+        muestras = np.frombuffer(datos, dtype="<i2").astype(np.float32) / 32768.0
+    elif formato == _WAVE_FORMAT_PCM and bits == 24:
+        crudo = np.frombuffer(datos, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        enteros = crudo[:, 0] | (crudo[:, 1] << 8) | (crudo[:, 2] << 16)
+        enteros = np.where(enteros & 0x800000, enteros - 0x1000000, enteros)
+        muestras = enteros.astype(np.float32) / 8388608.0
+    elif formato == _WAVE_FORMAT_PCM and bits == 32:
+        muestras = np.frombuffer(datos, dtype="<i4").astype(np.float32) / 2147483648.0
+    else:
+        raise InvalidAudioError(f"Formato WAV no soportado (código {formato}, {bits} bits)")
+
+    return muestras.reshape(-1, canales)
+
+
+def _lowpass(senal: np.ndarray, corte: float, taps: int = 63) -> np.ndarray:
+    """Filtro paso bajo FIR (sinc con ventana de Hamming); corte en fracción de fs"""
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * corte * np.sinc(2 * corte * n) * np.hamming(taps)
+    kernel /= kernel.sum()
+    return np.convolve(senal, kernel.astype(np.float32), mode="same")
+
+
+def _resample(senal: np.ndarray, rate: int, destino: int) -> np.ndarray:
+    """Remuestrear a la frecuencia destino (filtro antialiasing + interpolación lineal)"""
+    if rate == destino or len(senal) == 0:
+        return senal
+    if destino < rate:
+        # Cortar un poco por debajo de la nueva frecuencia de Nyquist
+        senal = _lowpass(senal, 0.45 * destino / rate)
+    n_destino = int(round(len(senal) * destino / rate))
+    t_origen = np.arange(len(senal), dtype=np.float64) / rate
+    t_destino = np.arange(n_destino, dtype=np.float64) / destino
+    return np.interp(t_destino, t_origen, senal).astype(np.float32)
+
+
+def _trim_silence(senal: np.ndarray, rate: int) -> np.ndarray:
+    """Recortar el silencio al principio y al final según la energía por ventana"""
+    frame = max(1, rate * _FRAME_MS // 1000)
+    n_frames = len(senal) // frame
+    if n_frames == 0:
+        return senal
+
+    energia = np.sqrt(np.mean(senal[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    pico = energia.max()
+    if pico <= 0:
+        return senal[:0]
+
+    umbral = pico * (10 ** (AUDIO_SILENCE_DB / 20))
+    activos = np.flatnonzero(energia > umbral)
+    margen = rate * AUDIO_SILENCE_MARGIN_MS // 1000
+    inicio = max(0, activos[0] * frame - margen)
+    fin = min(len(senal), (activos[-1] + 1) * frame + margen)
+    return senal[inicio:fin]
+
+
+def normalize_wav(contenido: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Normalizar un WAV para Speech-to-Text
+
+    Devuelve PCM LINEAR16 mono sin cabecera a AUDIO_TARGET_RATE Hz (o a su
+    frecuencia original si es menor: subirla solo añade bytes) y un
+    diccionario con la información del procesado (bytes ahorrados, etc.).
+    """
+    fmt, datos = _parse_wav(contenido)
+    muestras = _decode_pcm(fmt, datos)
+    destino = min(fmt["rate"], AUDIO_TARGET_RATE)
+
+    mono = muestras.mean(axis=1) if muestras.shape[1] > 1 else muestras[:, 0]
+    mono = _resample(mono, fmt["rate"], destino)
+    mono = _trim_silence(mono, destino)
+
+    pcm = (np.clip(mono, -1.0, 1.0) * 32767.0).astype("<i2").tobytes()
+
+    return pcm, {
+        "canales_originales": fmt["canales"],
+        "sample_rate_original": fmt["rate"],
+        "sample_rate": destino,
+        "duracion_original": round(muestras.shape[0] / fmt["rate"], 2),
+        "duracion": round(len(mono) / destino, 2),
+        "bytes_originales": len(contenido),
+        "bytes_enviados": len(pcm),
+        "bytes_ahorrados": len(contenido) - len(pcm),
+    }
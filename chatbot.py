@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""
+Motor del chatbot: contexto por sesión y respuestas precalculadas
+
+Dialogflow da un plazo corto al webhook de fulfillment, así que las
+respuestas no pueden depender de consultas a SQLite en el momento:
+
+- Las respuestas de los intents estándar (estadísticas, categorías,
+  feedback reciente, sentimiento...), también filtradas por sentimiento, se
+  renderizan de antemano. Cada feedback nuevo marca los datos como
+  cambiados y un hilo en segundo plano las vuelve a calcular (como mucho
+  una vez cada CHATBOT_REFRESH_SECONDS). Responder es buscar en un dict.
+- Cada sesión recuerda su último intent en un almacén acotado
+  (CHATBOT_MAX_SESSIONS, se expulsa la menos usada) con caducidad
+  (CHATBOT_SESSION_TTL), de modo que "¿y los negativos?" después de
+  "¿qué categorías tengo?" responde con las categorías del feedback
+  negativo.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+CHATBOT_SESSION_TTL = float(os.getenv("CHATBOT_SESSION_TTL", "1800"))
+CHATBOT_MAX_SESSIONS = int(os.getenv("CHATBOT_MAX_SESSIONS", "10000"))
+CHATBOT_REFRESH_SECONDS = float(os.getenv("CHATBOT_REFRESH_SECONDS", "1"))
+
+CANALES = ("web", "dialogflow")
+INTENTS = ("estadisticas", "categorias", "reciente", "ayuda", "apis", "sentimiento", "desconocido")
+SENTIMIENTOS = ("positivo", "negativo", "neutral")
+
+# Palabras clave de cada intent, en orden de prioridad (con y sin tildes)
+_PALABRAS_INTENT = (
+    ("estadisticas", ("estadística", "estadisticas", "estadísticas", "stats", "números", "numeros",
+                      "cuántos", "cuantos", "datos", "total")),
+    ("categorias", ("categoría", "categorias", "categorías", "category", "tipo", "tipos",
+                    "clasificación", "clasificacion")),
+    ("reciente", ("reciente", "recientes", "último", "ultimos", "últimos", "ultimo", "recent",
+                  "nuevo", "nuevos")),
+    ("ayuda", ("hola", "ayuda", "help", "qué puedes", "que puedes", "buenas", "buenos", "hey")),
+    ("apis", ("api", "apis", "google", "cloud", "tecnología", "tecnologia", "cómo funciona",
+              "como funciona")),
+    ("sentimiento", ("sentimiento", "cómo van", "como van")),
+)
+_PALABRAS_SENTIMIENTO = (
+    ("negativo", ("negativ", "quejas", "malos", "malas")),
+    ("positivo", ("positiv",)),
+    ("neutral", ("neutr",)),
+)
+# Nombres de intent de Dialogflow (displayName) que se reconocen
+_NOMBRES_DIALOGFLOW = (
+    ("estadisticas", ("estadisticas", "stats")),
+    ("categorias", ("categorias", "categories")),
+    ("reciente", ("reciente", "recent")),
+    ("ayuda", ("ayuda", "help")),
+    ("apis", ("apis",)),
+    ("sentimiento", ("sentimiento", "sentiment")),
+)
+# Los intents que admiten un filtro de sentimiento
+_FILTRABLES = ("estadisticas", "categorias", "reciente", "sentimiento")
+# Feedback reciente que se lee para poder filtrarlo por sentimiento
+_RECIENTES = 50
+
+# Respuesta mientras el hilo de fondo aún no ha calculado ninguna
+_SIN_DATOS = "⏳ Los datos aún no están disponibles. Inténtalo de nuevo en unos segundos."
+
+_EMOJI = {"positivo": "😊", "negativo": "😞", "neutral": "😐"}
+_PLURAL = {"positivo": "positivos", "negativo": "negativos", "neutral": "neutrales"}
+
+
+def detect_sentiment(mensaje: str) -> Optional[str]:
+    """Sentimiento mencionado en el mensaje ("¿y los negativos?" -> "negativo")"""
+    mensaje = mensaje.lower()
+    for sentimiento, palabras in _PALABRAS_SENTIMIENTO:
+        if any(palabra in mensaje for palabra in palabras):
+            return sentimiento
+    return None
+
+
+def detect_intent(mensaje: str) -> Optional[str]:
+    """Intent por palabras clave (None si el mensaje no menciona ningún tema)"""
+    mensaje = mensaje.lower()
+    for intent, palabras in _PALABRAS_INTENT:
+        if any(palabra in mensaje for palabra in palabras):
+            return intent
+    return None
+
+
+def _intent_dialogflow(nombre: str) -> Optional[str]:
+    nombre = nombre.lower()
+    for intent, claves in _NOMBRES_DIALOGFLOW:
+        if any(clave in nombre for clave in claves):
+            return intent
+    return None
+
+
+# =====================================================
+# SESIONES
+# =====================================================
+
+class SessionStore:
+    """Estado de conversación por sesión, acotado (LRU) y con caducidad"""
+
+    def __init__(self, max_sesiones: int = CHATBOT_MAX_SESSIONS, ttl: float = CHATBOT_SESSION_TTL):
+        self.max_sesiones = max_sesiones
+        self.ttl = ttl
+        self._sesiones: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.expulsadas = 0
+
+    def _purgar(self, ahora: float):
+        # Ordenadas por último uso: las caducadas están al principio
+        while self._sesiones:
+            sesion = next(iter(self._sesiones.values()))
+            if ahora - sesion["actualizado"] < self.ttl:
+                break
+            self._sesiones.popitem(last=False)
+
+    def get(self, session_id: str) -> Dict[str, Any]:
+        """Estado de la sesión (vacío si no existe o ha caducado)"""
+        with self._lock:
+            self._purgar(time.monotonic())
+            sesion = self._sesiones.get(session_id)
+            return dict(sesion) if sesion else {}
+
+    def update(self, session_id: str, **campos):
+        """Guardar el estado de la sesión y marcarla como la más reciente"""
+        ahora = time.monotonic()
+        with self._lock:
+            sesion = self._sesiones.pop(session_id, None) or {"turnos": 0}
+            sesion.update(campos, actualizado=ahora, turnos=sesion["turnos"] + 1)
+            self._sesiones[session_id] = sesion
+            while len(self._sesiones) > self.max_sesiones:
+                self._sesiones.popitem(last=False)
+                self.expulsadas += 1
+            self._purgar(ahora)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sesiones)
+
+
+# =====================================================
+# RESPUESTAS
+# =====================================================
+
+def _load_data(db) -> Dict[str, Any]:
+    """Datos de los que salen todas las respuestas (las únicas consultas a SQLite)"""
+    return {
+        "stats": db.get_statistics(),
+        "categorias": db.get_categories(),
+        "por_categoria": db.get_sentiment_by_category(),
+        "recientes": db.get_recent_feedback(limit=_RECIENTES),
+    }
+
+
+def _lineas_recientes(recientes: List[Dict[str, Any]]) -> str:
+    texto = ""
+    for idx, f in enumerate(recientes, 1):
+        sentimiento = f.get('sentimiento', 'N/A').upper()
+        tipo = f.get('tipo', 'N/A').capitalize()
+        emoji = "😊" if sentimiento == "POSITIVO" else "😞" if sentimiento == "NEGATIVO" else "😐"
+        texto += f"{idx}. {emoji} {sentimiento} - Tipo: {tipo}\n"
+    return texto
+
+
+def _render_filtered(intent: str, sentimiento: str, datos: Dict[str, Any]) -> str:
+    """Respuesta de un intent restringida a un sentimiento (igual en los dos canales)"""
+    stats = datos["stats"]
+    plural = _PLURAL[sentimiento]
+    emoji = _EMOJI[sentimiento]
+    categorias = sorted(((cat, conteo.get(sentimiento, 0)) for cat, conteo in datos["por_categoria"].items()),
+                        key=lambda x: x[1], reverse=True)
+    categorias = [(cat, n) for cat, n in categorias if n]
+
+    if intent == "reciente":
+        recientes = [f for f in datos["recientes"] if f.get("sentimiento") == sentimiento][:5]
+        if not recientes:
+            return f"📝 No hay feedback {sentimiento} entre los {_RECIENTES} más recientes."
+        return f"📝 Últimos {len(recientes)} feedback {plural}:\n\n" + _lineas_recientes(recientes)
+
+    if intent == "categorias":
+        if not categorias:
+            return f"📁 Aún no hay feedback {sentimiento} en ninguna categoría."
+        texto = f"📁 Categorías con feedback {sentimiento}:\n\n"
+        for cat, n in categorias:
+            total_cat = sum(datos["por_categoria"][cat].values())
+            texto += f"• {cat}: {n} de {total_cat} feedback\n"
+        return texto
+
+    # estadisticas / sentimiento
+    total = stats[plural]
+    if total == 0:
+        return f"{emoji} Aún no hay feedback {sentimiento}."
+    texto = f"""{emoji} Feedback {plural}:
+
+• Total: {total} de {stats['total']} ({stats['porcentaje_' + plural]}%)"""
+    if categorias:
+        texto += "\n• Categorías con más feedback " + plural + ": " + ", ".join(
+            f"{cat} ({n})" for cat, n in categorias[:3])
+    return texto
+
+
+def _render_web(intent: str, datos: Dict[str, Any]) -> str:
+    """Respuestas del chat de la web (sin Dialogflow)"""
+    stats = datos["stats"]
+
+    if intent == "estadisticas":
+        if stats['total'] == 0:
+            return """📊 Estadísticas actuales:
+
+Aún no hay feedback analizado.
+
+¡Comienza analizando texto, audio o imágenes en las pestañas superiores!"""
+
+        return f"""📊 Estadísticas actuales:
+
+• Total de feedback: {stats['total']}
+• Positivos: {stats['positivos']} ({stats['porcentaje_positivos']}%)
+• Negativos: {stats['negativos']} ({stats['porcentaje_negativos']}%)
+• Neutrales: {stats['neutrales']}
+• Score promedio: {stats['score_promedio']}
+
+💡 Tip: Analiza más feedback para obtener mejores insights!"""
+
+    if intent == "categorias":
+        categories = datos["categorias"]
+        if not categories:
+            return """📁 Categorías:
+
+Aún no hay categorías detectadas.
+
+Analiza más feedback para que el sistema identifique automáticamente las categorías de productos o servicios mencionados."""
+
+        text = "📁 Categorías detectadas:\n\n"
+        for cat, count in sorted(categories.items(), key=lambda x: x[1], reverse=True):
+            text += f"• {cat}: {count} feedback\n"
+
+        text += f"\n📈 Total de categorías: {len(categories)}"
+        return text
+
+    if intent == "reciente":
+        recent = datos["recientes"][:5]
+        if not recent:
+            return """📝 Feedback reciente:
+
+No hay feedback registrado todavía.
+
+¡Usa las pestañas superiores para analizar texto, audio o imágenes!"""
+
+        return f"📝 Últimos {len(recent)} feedback analizados:\n\n" + _lineas_recientes(recent)
+
+    if intent == "ayuda":
+        return """👋 ¡Hola! Soy tu asistente de feedback.
+
+Puedo ayudarte con:
+• 📊 Estadísticas generales del feedback
+• 📁 Ver categorías detectadas
+• 📝 Consultar feedback reciente
+• ☁️ Información sobre las APIs de Google Cloud
+
+💬 Escribe tu pregunta o usa los botones de abajo.
+🔎 Después puedes preguntar "¿y los negativos?" para filtrar."""
+
+    if intent == "apis":
+        return """☁️ Google Cloud AI - Tecnología utilizada:
+
+1. **Natural Language API**
+   📝 Analiza sentimiento y extrae entidades del texto
+
+2. **Speech-to-Text API**
+   🎤 Convierte grabaciones de voz a texto
+
+3. **Vision API**
+   👁️ Detecta rostros, emociones y objetos en imágenes
+
+4. **Chatbot (yo)**
+   🤖 ¡Tu asistente inteligente!
+
+🔗 Todo integrado con FastAPI + Python"""
+
+    if intent == "sentimiento":
+        if stats['total'] == 0:
+            return "Aún no hay análisis de sentimiento. ¡Analiza feedback primero!"
+
+        if stats['porcentaje_positivos'] > 60:
+            resumen = "¡Excelente! La mayoría del feedback es positivo 😊"
+        elif stats['porcentaje_negativos'] > 40:
+            resumen = "⚠️ Atención: Hay bastante feedback negativo"
+        else:
+            resumen = "El feedback está balanceado"
+
+        return f"""😊 Análisis de Sentimiento:
+
+{resumen}
+
+• Positivos: {stats['porcentaje_positivos']}%
+• Negativos: {stats['porcentaje_negativos']}%
+• Score promedio: {stats['score_promedio']}"""
+
+    return """🤔 No estoy seguro de entender tu pregunta.
+
+Intenta preguntar sobre:
+• 📊 "Muéstrame las estadísticas"
+• 📁 "¿Qué categorías tengo?"
+• 📝 "Feedback reciente"
+• ☁️ "¿Qué APIs usas?"
+
+O usa los botones de sugerencias abajo 👇"""
+
+
+def _render_dialogflow(intent: str, datos: Dict[str, Any]) -> str:
+    """Respuestas del fulfillment de Dialogflow"""
+    stats = datos["stats"]
+
+    if intent in ("estadisticas", "sentimiento"):
+        return f"""📊 Estadísticas actuales:
+
+• Total de feedback: {stats['total']}
+• Positivos: {stats['positivos']} ({stats['porcentaje_positivos']}%)
+• Negativos: {stats['negativos']} ({stats['porcentaje_negativos']}%)
+• Neutrales: {stats['neutrales']}
+• Score promedio: {stats['score_promedio']}
+
+¿Necesitas más información?"""
+
+    if intent == "categorias":
+        categories = datos["categorias"]
+        if not categories:
+            return "No hay categorías registradas aún. Analiza más feedback para ver las categorías."
+
+        cat_text = "📁 Distribución de categorías:\n\n"
+        for cat, count in categories.items():
+            cat_text += f"• {cat}: {count} feedback\n"
+        return cat_text
+
+    if intent == "reciente":
+        recent = datos["recientes"][:3]
+        if not recent:
+            return "No hay feedback reciente registrado."
+
+        text = "📝 Últimos 3 feedback:\n\n"
+        for idx, f in enumerate(recent, 1):
+            text += f"{idx}. {f.get('sentimiento', 'N/A').upper()} - {f.get('tipo', 'N/A')}\n"
+        return text
+
+    if intent == "ayuda":
+        return """🤖 Puedo ayudarte con:
+
+• Ver estadísticas generales
+• Consultar categorías de feedback
+• Mostrar feedback reciente
+• Explicar cómo funcionan las APIs
+• Dar recomendaciones
+
+¿Qué te gustaría saber?"""
+
+    if intent == "apis":
+        return """☁️ Usamos estas APIs de Google Cloud:
+
+1. **Natural Language API**: Analiza sentimiento y entidades en texto
+2. **Speech-to-Text API**: Convierte audio a texto
+3. **Vision API**: Detecta rostros, emociones y objetos en imágenes
+4. **Dialogflow**: Yo! El chatbot inteligente 🤖
+
+¿Quieres saber más sobre alguna?"""
+
+    return "Entiendo tu pregunta. ¿Podrías reformularla? Puedo ayudarte con estadísticas, categorías, feedback reciente y más."
+
+
+def render_all(datos: Dict[str, Any]) -> Dict[Tuple[str, str, Optional[str]], str]:
+    """Todas las respuestas: (canal, intent, sentimiento o None) -> texto"""
+    respuestas = {}
+    for intent in INTENTS:
+        respuestas[("web", intent, None)] = _render_web(intent, datos)
+        respuestas[("dialogflow", intent, None)] = _render_dialogflow(intent, datos)
+        if intent in _FILTRABLES:
+            for sentimiento in SENTIMIENTOS:
+                texto = _render_filtered(intent, sentimiento, datos)
+                for canal in CANALES:
+                    respuestas[(canal, intent, sentimiento)] = texto
+    return respuestas
+
+
+# =====================================================
+# MOTOR
+# =====================================================
+
+class ChatbotEngine:
+    """Responde con el contexto de la sesión desde las respuestas precalculadas"""
+
+    def __init__(self, db, sesiones: Optional[SessionStore] = None,
+                 intervalo: float = CHATBOT_REFRESH_SECONDS):
+        self.db = db
+        self.sesiones = sesiones if sesiones is not None else SessionStore()
+        self.intervalo = intervalo
+        self._respuestas: Dict[Tuple[str, str, Optional[str]], str] = {}
+        self._cambios = threading.Event()
+        self._refresco_lock = threading.Lock()
+        self._hilo: Optional[threading.Thread] = None
+        self.stats = {"refrescos": 0, "refresco_ms": 0.0, "actualizado": None}
+
+    # ---------- Precálculo ----------
+
+    def refresh(self):
+        """Recalcular todas las respuestas y sustituirlas de golpe"""
+        with self._refresco_lock:
+            inicio = time.perf_counter()
+            respuestas = render_all(_load_data(self.db))
+            self._respuestas = respuestas
+            self.stats["refrescos"] += 1
+            self.stats["refresco_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+            self.stats["actualizado"] = time.time()
+
+    def on_feedback(self, resumen: Dict[str, Any]):
+        """Listener de FeedbackDatabase: los datos han cambiado"""
+        self._cambios.set()
+
+    def invalidate(self):
+        """Hook de resync: recalcular en cuanto sea posible"""
+        self._cambios.set()
+
+    def start(self):
+        """Arrancar el hilo que recalcula las respuestas tras cada cambio"""
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._bucle, daemon=True)
+            self._hilo.start()
+
+    def _bucle(self):
+        while True:
+            self._cambios.wait()
+            # Agrupar las escrituras seguidas en un solo recálculo
+            time.sleep(self.intervalo)
+            self._cambios.clear()
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("⚠️ Error al recalcular las respuestas del chatbot")
+
+    def _answer(self, canal: str, intent: str, sentimiento: Optional[str]) -> str:
+        # Nunca se consulta SQLite al responder: si aún no hay respuestas,
+        # se pide el cálculo al hilo de fondo y se avisa al usuario
+        if intent not in _FILTRABLES:
+            sentimiento = None
+        respuesta = self._respuestas.get((canal, intent, sentimiento))
+        if respuesta is None:
+            self._cambios.set()
+            return _SIN_DATOS
+        return respuesta
+
+    # ---------- Conversación ----------
+
+    def _resolve(self, session_id: str, intent: Optional[str], sentimiento: Optional[str]) -> Tuple[str, Optional[str]]:
+        """Completar el intent con el contexto de la sesión ("¿y los negativos?")"""
+        sesion = self.sesiones.get(session_id)
+        if intent is None and sentimiento is not None:
+            # Solo un filtro: se aplica al tema anterior (o al resumen de sentimiento)
+            anterior = sesion.get("intent")
+            intent = anterior if anterior in _FILTRABLES else "sentimiento"
+        elif intent is None:
+            intent = "desconocido"
+        # Se guarda siempre el último tema: tras "ayuda", "¿y los negativos?"
+        # no debe aplicarse a una pregunta anterior
+        self.sesiones.update(session_id, intent=intent, sentimiento=sentimiento)
+        return intent, sentimiento
+
+    def reply(self, mensaje: str, session_id: str = "default") -> Dict[str, Any]:
+        """Respuesta del chat de la web"""
+        intent, sentimiento = self._resolve(session_id, detect_intent(mensaje), detect_sentiment(mensaje))
+        return {"response": self._answer("web", intent, sentimiento), "intent": intent, "sentimiento": sentimiento}
+
+    def reply_dialogflow(self, intent_name: str, parameters: Dict[str, Any], query_text: str = "",
+                         session_id: str = "default") -> str:
+        """Respuesta del webhook de fulfillment de Dialogflow"""
+        intent = _intent_dialogflow(intent_name) or detect_intent(query_text)
+        sentimiento = detect_sentiment(str(parameters.get("sentimiento") or "")) or detect_sentiment(query_text)
+        intent, sentimiento = self._resolve(session_id, intent, sentimiento)
+        return self._answer("dialogflow", intent, sentimiento)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "sesiones": len(self.sesiones),
+            "sesiones_expulsadas": self.sesiones.expulsadas,
+            "respuestas": len(self._respuestas),
+            **self.stats,
+        }
@@ -3,23 +3,115 @@
 Base de datos SQLite para almacenar feedback histórico
 """
 import sqlite3
-from datetime import datetime
-from typing import Dict, Any, List, Optional
+import os
+import re
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Callable
 import json
+import logging
 from contextlib import contextmanager
 
+import numpy as np
+from dotenv import load_dotenv
+
+if __name__ == "__main__":
+    # Punto de entrada: el .env se carga antes de leer la configuración
+    load_dotenv()
+
+from dedup import MinHashIndex, minhash
+
+logger = logging.getLogger(__name__)
+
+
+# Particionado temporal opcional: un fichero SQLite por mes
+FEEDBACK_PARTITIONING = os.getenv("FEEDBACK_PARTITIONING", "").lower() == "monthly"
+
+_RE_PARTICION = re.compile(r"feedback_(\d{4})_(\d{2})\.db")
+
+# Versión del esquema (PRAGMA user_version):
+#   0 -> tipo, sentimiento, categoría y entidades como texto repetido
+#   1 -> migración en curso: se copian a las tablas *_v2 codificadas
+#   2 -> ids enteros que apuntan a la tabla valores
+#   3 -> etiquetas de imagen en su propia tabla; rostros y confianza del
+#        audio como columnas (antes dentro del JSON de metadata)
+SCHEMA_VERSION = 3
+
+# Migrar automáticamente (en segundo plano) las bases de datos anteriores
+SCHEMA_AUTO_MIGRATE = os.getenv("SCHEMA_AUTO_MIGRATE", "1").lower() in ("1", "true", "yes")
+
+# Tamaño máximo de un registro al restaurar un array JSON (uno mal formado
+# no hace leer el resto del fichero en memoria)
+IMPORT_JSON_MAX_RECORD_MB = float(os.getenv("IMPORT_JSON_MAX_RECORD_MB", "16"))
+
+# Columnas físicas de cada campo según la versión del esquema
+_COLUMNAS_TEXTO = {"tipo": "tipo", "sentimiento": "sentimiento", "categoria": "categoria",
+                   "nombre": "nombre", "entidad_tipo": "tipo"}
+_COLUMNAS_IDS = {"tipo": "tipo_id", "sentimiento": "sentimiento_id", "categoria": "categoria_id",
+                 "nombre": "nombre_id", "entidad_tipo": "tipo_id"}
+
+
+class PartialWriteError(RuntimeError):
+    """
+    Un lote repartido en varias particiones falló después de confirmar alguna
+
+    resultados indica qué elementos quedaron guardados y eventos son los de
+    esas escrituras ya confirmadas (pendientes de apply_committed).
+    """
+
+    def __init__(self, mensaje: str, resultados: List[bool], eventos: List[Dict[str, Any]]):
+        super().__init__(mensaje)
+        self.resultados = resultados
+        self.eventos = eventos
+
+
+def _wal_index_header(ruta: str) -> str:
+    """
+    Cabecera del wal-index (fichero -shm) de una base de datos en modo WAL
+
+    Incluye el contador iChange, que SQLite incrementa con cada transacción,
+    el número de frames válidos y las sales del WAL. Es la misma para todos
+    los procesos que comparten el fichero.
+    """
+    try:
+        with open(ruta + "-shm", "rb") as f:
+            return f.read(48).hex()
+    except OSError:
+        return "-"
+
 
 class FeedbackDatabase:
     """Base de datos persistente para almacenar análisis de feedback"""
     
-    def __init__(self, db_path: str = "feedback_analytics.db"):
+    def __init__(self, db_path: str = "feedback_analytics.db", partitioned: Optional[bool] = None):
         self.db_path = db_path
+        # Modo particionado: feedback, entidades, firmas y estadísticas diarias
+        # de cada mes en <base>_particiones/feedback_AAAA_MM.db
+        self.partitioned = FEEDBACK_PARTITIONING if partitioned is None else partitioned
+        self.partition_dir = os.path.splitext(db_path)[0] + "_particiones"
+        self.archive_dir = os.path.join(self.partition_dir, "archivo")
+        self._preparadas = set()
+        # Caché de la tabla valores por fichero: (dominio, valor) -> id y id -> valor
+        self._ids: Dict[str, Dict[tuple, int]] = {}
+        self._valores: Dict[str, Dict[int, str]] = {}
+        self.dedup_index = MinHashIndex()
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+        self._resync_hooks: List[Callable[[], None]] = []
+        # Cliente del proceso escritor (modo multi-worker, ver writer.py)
+        self.writer = None
         self.init_database()
+        self._load_dedup_index()
     
     @contextmanager
-    def get_connection(self):
-        """Context manager para conexiones a la base de datos"""
-        conn = sqlite3.connect(self.db_path)
+    def get_connection(self, ruta: Optional[str] = None):
+        """Context manager para conexiones a la base de datos (o a una partición)"""
+        ruta = ruta or self.db_path
+        if os.path.dirname(ruta) == self.archive_dir:
+            # Particiones archivadas: de solo lectura y sin bloqueos
+            conn = sqlite3.connect(f"file:{ruta}?immutable=1", uri=True)
+        else:
+            conn = sqlite3.connect(ruta)
         conn.row_factory = sqlite3.Row  # Para acceder por nombre de columna
         try:
             yield conn
@@ -32,124 +124,988 @@ class FeedbackDatabase:
     
     def init_database(self):
         """Inicializar tablas de la base de datos"""
-        with self.get_connection() as conn:
+        if self.partitioned:
+            os.makedirs(self.partition_dir, exist_ok=True)
+            for ruta in self.partitions():
+                if os.path.dirname(ruta) == self.partition_dir:
+                    self._prepare_partition(ruta)
+        else:
+            with self.get_connection() as conn:
+                self._create_schema(conn.cursor())
+        
+        logger.info("✅ Base de datos inicializada correctamente", extra={"db": self.db_path})
+    
+    def _create_schema(self, cursor):
+        """Crear (o migrar) las tablas en una base de datos o partición"""
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'feedback'")
+        if cursor.fetchone() is None:
+            # Base de datos nueva: directamente con el esquema codificado
+            self._create_encoded_tables(cursor)
+            self._create_label_table(cursor)
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        
+        # Tabla de estadísticas agregadas (para optimizar consultas)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS estadisticas_diarias (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fecha TEXT UNIQUE NOT NULL,
+                total_feedback INTEGER DEFAULT 0,
+                positivos INTEGER DEFAULT 0,
+                negativos INTEGER DEFAULT 0,
+                neutrales INTEGER DEFAULT 0,
+                score_promedio REAL DEFAULT 0,
+                last_updated TEXT NOT NULL
+            )
+        """)
+        
+        # Firmas MinHash para detectar feedback casi duplicado
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS feedback_minhash (
+                feedback_id TEXT PRIMARY KEY,
+                firma BLOB NOT NULL,
+                FOREIGN KEY (feedback_id) REFERENCES feedback(feedback_id)
+            )
+        """)
+        
+        # WAL: los workers pueden leer mientras el escritor escribe
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
+        if self._schema_version(cursor) >= 2:
+            # Bases de datos codificadas antes de existir este índice
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_entidades_cod_feedback ON entidades(feedback_id)")
+            return
+        
+        # Esquema de texto anterior (hasta ejecutar migrate_schema)
+        # Migración: marca de duplicado en bases de datos anteriores
+        self._ensure_column(cursor, "feedback", "es_duplicado",
+                            "INTEGER NOT NULL DEFAULT 0")
+        
+        # Índices para mejorar rendimiento
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_feedback_timestamp 
+            ON feedback(timestamp)
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_feedback_sentimiento 
+            ON feedback(sentimiento)
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_feedback_categoria 
+            ON feedback(categoria)
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_entidades_feedback 
+            ON entidades(feedback_id)
+        """)
+    
+    def _create_encoded_tables(self, cursor, sufijo: str = ""):
+        """Tablas del esquema codificado (sufijo "_v2" mientras dura la migración)"""
+        # Valores de texto repetidos: tipo, sentimiento, categoría y entidades
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS valores (
+                id INTEGER PRIMARY KEY,
+                dominio TEXT NOT NULL,
+                valor TEXT NOT NULL,
+                UNIQUE (dominio, valor)
+            )
+        """)
+        
+        # Tabla principal de feedback
+        cursor.execute(f"""
+            CREATE TABLE feedback{sufijo} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                feedback_id TEXT UNIQUE NOT NULL,
+                tipo_id INTEGER NOT NULL,
+                sentimiento_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                magnitude REAL,
+                categoria_id INTEGER,
+                texto_muestra TEXT,
+                timestamp TEXT NOT NULL,
+                metadata TEXT,
+                es_duplicado INTEGER NOT NULL DEFAULT 0,
+                rostros INTEGER,
+                audio_confianza REAL
+            )
+        """)
+        
+        # Tabla de entidades detectadas
+        cursor.execute(f"""
+            CREATE TABLE entidades{sufijo} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                feedback_id TEXT NOT NULL,
+                nombre_id INTEGER NOT NULL,
+                tipo_id INTEGER NOT NULL,
+                relevancia REAL,
+                FOREIGN KEY (feedback_id) REFERENCES feedback(feedback_id)
+            )
+        """)
+        
+        # Índices (con nombres propios: los del esquema de texto siguen
+        # existiendo mientras dura la migración). Con ids enteros los índices
+        # cubrientes son pequeños y los GROUP BY no tocan la tabla.
+        cursor.execute(f"CREATE INDEX idx_feedback_cod_timestamp ON feedback{sufijo}(timestamp)")
+        cursor.execute(f"CREATE INDEX idx_feedback_cod_sentimiento ON feedback{sufijo}(sentimiento_id)")
+        cursor.execute(f"""
+            CREATE INDEX idx_feedback_cod_categoria
+            ON feedback{sufijo}(categoria_id, sentimiento_id)
+        """)
+        cursor.execute(f"""
+            CREATE INDEX idx_entidades_cod_nombre
+            ON entidades{sufijo}(nombre_id, tipo_id, relevancia)
+        """)
+        cursor.execute(f"CREATE INDEX idx_entidades_cod_feedback ON entidades{sufijo}(feedback_id)")
+    
+    # ---------- Particiones mensuales ----------
+    
+    def partitions(self, desde: Optional[str] = None, hasta: Optional[str] = None,
+                   recientes_primero: bool = False) -> List[str]:
+        """
+        Ficheros que pueden contener feedback entre desde y hasta (ISO 8601)
+        
+        Sin particionado es solo la base de datos principal. Con particionado,
+        las particiones se descartan por su mes sin abrirlas.
+        """
+        if not self.partitioned:
+            return [self.db_path]
+        
+        mes_desde = desde[:7] if desde else None
+        mes_hasta = hasta[:7] if hasta else None
+        encontradas = []
+        for carpeta in (self.partition_dir, self.archive_dir):
+            if not os.path.isdir(carpeta):
+                continue
+            for nombre in os.listdir(carpeta):
+                mes = self._mes(nombre)
+                if mes is None:
+                    continue
+                if (mes_desde and mes < mes_desde) or (mes_hasta and mes > mes_hasta):
+                    continue
+                encontradas.append((mes, os.path.join(carpeta, nombre)))
+        
+        encontradas.sort(reverse=recientes_primero)
+        return [ruta for _, ruta in encontradas]
+    
+    @staticmethod
+    def _mes(ruta: str) -> Optional[str]:
+        """Mes (AAAA-MM) de un fichero de partición; None si no lo es"""
+        m = _RE_PARTICION.fullmatch(os.path.basename(ruta))
+        return f"{m.group(1)}-{m.group(2)}" if m else None
+    
+    def _recent_partitions(self, suficiente: Callable[[], bool]):
+        """Recorrer las particiones de la más reciente a la más antigua hasta que suficiente()"""
+        mes_anterior = None
+        for ruta in self.partitions(recientes_primero=True):
+            mes = self._mes(ruta)
+            # Un mismo mes puede tener partición activa y archivada
+            if mes != mes_anterior and suficiente():
+                return
+            mes_anterior = mes
+            yield ruta
+    
+    def _partition_for(self, timestamp: str) -> str:
+        """Fichero en el que se escribe un feedback según su timestamp"""
+        if not self.partitioned:
+            return self.db_path
+        ruta = os.path.join(self.partition_dir, f"feedback_{timestamp[:4]}_{timestamp[5:7]}.db")
+        if ruta not in self._preparadas:
+            self._prepare_partition(ruta)
+        return ruta
+    
+    def _prepare_partition(self, ruta: str):
+        with self.get_connection(ruta) as conn:
+            self._create_schema(conn.cursor())
+        self._preparadas.add(ruta)
+    
+    def _drop_partition(self, ruta: str):
+        """Borrar una partición completa (retención sin DELETE fila a fila)"""
+        for sufijo in ("", "-wal", "-shm"):
+            if os.path.exists(ruta + sufijo):
+                os.remove(ruta + sufijo)
+        self._preparadas.discard(ruta)
+        self._forget_values(ruta)
+    
+    def compact_partition(self, mes: str):
+        """Compactar (VACUUM) la partición activa de un mes AAAA-MM"""
+        if self.writer is not None:
+            return self.writer.run("compact_partition", mes)
+        ruta = os.path.join(self.partition_dir, f"feedback_{mes[:4]}_{mes[5:7]}.db")
+        if not os.path.exists(ruta):
+            raise ValueError(f"No existe la partición {mes}")
+        with self.get_connection(ruta) as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn = sqlite3.connect(ruta, isolation_level=None)
+        try:
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+        logger.info(f"🗜️ Partición {mes} compactada")
+    
+    def archive_partition(self, mes: str) -> str:
+        """
+        Archivar la partición de un mes cerrado como fichero compacto de solo lectura
+        
+        Se sigue consultando igual; si llega feedback atrasado de ese mes se
+        crea de nuevo una partición activa junto a la archivada.
+        """
+        if self.writer is not None:
+            return self.writer.run("archive_partition", mes)
+        if mes >= datetime.now().strftime("%Y-%m"):
+            raise ValueError("Solo se pueden archivar meses cerrados")
+        nombre = f"feedback_{mes[:4]}_{mes[5:7]}.db"
+        ruta = os.path.join(self.partition_dir, nombre)
+        destino = os.path.join(self.archive_dir, nombre)
+        if not os.path.exists(ruta):
+            raise ValueError(f"No existe la partición {mes}")
+        if os.path.exists(destino):
+            raise ValueError(f"La partición {mes} ya está archivada")
+        
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with self.get_connection(ruta) as conn:
+            conn.execute("VACUUM INTO ?", (destino,))
+        conn = sqlite3.connect(destino)
+        try:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            conn.close()
+        os.chmod(destino, 0o444)
+        self._drop_partition(ruta)
+        self.resync()
+        logger.info(f"📦 Partición {mes} archivada en {destino}")
+        return destino
+    
+    def migrate_to_partitions(self, origen: Optional[str] = None, lote: int = 1000) -> int:
+        """Repartir por meses el histórico de una base de datos sin particionar"""
+        if self.writer is not None:
+            return self.writer.run("migrate_to_partitions", origen and os.path.abspath(origen), lote)
+        if not self.partitioned:
+            raise ValueError("La base de datos no está en modo particionado")
+        
+        copiados = 0
+        for items in self._iter_items(origen or self.db_path, lote):
+            resultados, _ = self.write_many(items, verbose=False)
+            copiados += sum(resultados)
+        
+        self.resync()
+        logger.info(f"🗂️ {copiados} feedback repartidos en {len(self.partitions())} particiones mensuales")
+        return copiados
+    
+    def _iter_items(self, ruta: str, lote: int = 1000):
+        """Leer un fichero por lotes como diccionarios aceptados por add_feedback"""
+        with self.get_connection(ruta) as conn:
             cursor = conn.cursor()
+            columnas, decode = self.column_map(conn, ruta)
+            cursor.execute("SELECT * FROM feedback ORDER BY timestamp")
+            while True:
+                filas = cursor.fetchmany(lote)
+                if not filas:
+                    break
+                
+                consulta = conn.cursor()
+                ids = [f['feedback_id'] for f in filas]
+                entidades = self._entities_by_feedback(consulta, ids, columnas, decode)
+                etiquetas = self._labels_of(consulta, ids, decode)
+                
+                items = []
+                for fila in filas:
+                    fila = self._decode_row(dict(fila), columnas, decode)
+                    item = json.loads(fila['metadata']) if fila['metadata'] else {}
+                    self._merge_image_metadata(item, fila, etiquetas.get(fila['feedback_id']))
+                    item.update({
+                        "id": fila['feedback_id'],
+                        "tipo": fila['tipo'],
+                        "sentimiento": fila['sentimiento'],
+                        "score": fila['score'],
+                        "magnitude": fila['magnitude'],
+                        "categoria": fila['categoria'],
+                        "texto": fila['texto_muestra'] or "",
+                        "timestamp": fila['timestamp'],
+                        "entidades": entidades.get(fila['feedback_id'], [])
+                    })
+                    items.append(item)
+                yield items
+    
+    def add_listener(self, callback: Callable[[Dict[str, Any]], None]):
+        """Registrar una función a la que se avisa tras guardar cada feedback"""
+        self._listeners.append(callback)
+    
+    def add_resync_hook(self, callback: Callable[[], None]):
+        """Registrar una función para reconstruir estado derivado tras resync()"""
+        self._resync_hooks.append(callback)
+    
+    def _notify(self, resumen: Dict[str, Any]):
+        """Avisar a los listeners (sus errores no afectan al guardado)"""
+        for callback in self._listeners:
+            try:
+                callback(resumen)
+            except Exception:
+                logger.exception("⚠️ Error en listener de feedback", extra={"feedback_id": resumen.get("id")})
+    
+    def data_version(self) -> str:
+        """
+        Versión actual de los datos, sin ejecutar SQL
+
+        Solo usa estado compartido por todos los procesos, así que cada
+        worker calcula la misma versión para los mismos datos: tamaño y fecha
+        de modificación de los ficheros de la base de datos y la cabecera del
+        wal-index (-shm), cuyo contador de transacciones cambia con cada
+        commit aunque el WAL se reutilice con el mismo tamaño.
+        """
+        partes = []
+        rutas = self.partitions()
+        if self.partitioned:
+            # Particiones creadas o borradas por otro proceso
+            rutas = [self.partition_dir] + rutas
+        for ruta in rutas:
+            for fichero in (ruta, ruta + "-wal"):
+                try:
+                    st = os.stat(fichero)
+                    partes.append(f"{st.st_mtime_ns}:{st.st_size}")
+                except OSError:
+                    partes.append("-")
+            partes.append(_wal_index_header(ruta))
+        return "-".join(partes)
+    
+    def _ensure_column(self, cursor, tabla: str, columna: str, definicion: str):
+        """Añadir una columna si la tabla aún no la tiene"""
+        cursor.execute(f"PRAGMA table_info({tabla})")
+        if columna not in [row['name'] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+    
+    # ---------- Esquema codificado (tabla valores) ----------
+    
+    @staticmethod
+    def _schema_version(cursor) -> int:
+        cursor.execute("PRAGMA user_version")
+        return cursor.fetchone()[0]
+    
+    def _columns(self, cursor) -> Dict[str, str]:
+        """Columnas que se leen para tipo, sentimiento, categoría y entidades"""
+        return _COLUMNAS_IDS if self._schema_version(cursor) >= 2 else _COLUMNAS_TEXTO
+    
+    def column_map(self, conn, ruta: Optional[str] = None):
+        """
+        Columnas físicas de un fichero y función para decodificar sus valores
+        
+        Con el esquema codificado las consultas agrupan por id entero y los
+        nombres se recuperan después desde la caché de la tabla valores.
+        """
+        ruta = ruta or self.db_path
+        cursor = conn.cursor()
+        columnas = self._columns(cursor)
+        if columnas is _COLUMNAS_TEXTO:
+            return columnas, lambda valor: valor
+        return columnas, lambda valor: self._decode(cursor, ruta, valor)
+    
+    def _decode(self, cursor, ruta: str, valor_id: Optional[int]) -> Optional[str]:
+        if valor_id is None:
+            return None
+        valores = self._valores.get(ruta)
+        if valores is None or valor_id not in valores:
+            # Valor nuevo (quizá escrito por otro proceso): recargar la tabla
+            cursor.execute("SELECT id, valor FROM valores")
+            valores = self._valores[ruta] = {row[0]: row[1] for row in cursor.fetchall()}
+        return valores[valor_id]
+    
+    def _intern(self, cursor, ruta: str, dominio: str, valor: Optional[str]) -> Optional[int]:
+        """Id de un valor en la tabla valores (creándolo si no existe), con caché en memoria"""
+        if valor is None:
+            return None
+        ids = self._ids.setdefault(ruta, {})
+        clave = (dominio, valor)
+        valor_id = ids.get(clave)
+        if valor_id is None:
+            cursor.execute("INSERT OR IGNORE INTO valores (dominio, valor) VALUES (?, ?)", clave)
+            cursor.execute("SELECT id FROM valores WHERE dominio = ? AND valor = ?", clave)
+            valor_id = ids[clave] = cursor.fetchone()[0]
+        return valor_id
+    
+    def _forget_values(self, ruta: str):
+        """Vaciar la caché de valores de un fichero (tras un rollback o al borrarlo)"""
+        self._ids.pop(ruta, None)
+        self._valores.pop(ruta, None)
+    
+    def migrate_schema(self, lote: int = 5000, pausa: float = 0.1, compactar: bool = False) -> int:
+        """
+        Migrar en línea al esquema actual (SCHEMA_VERSION)
+        
+        Hasta la versión 2:
+        1. Crea las tablas codificadas junto a las actuales (transacción corta).
+        2. Copia las filas por lotes de ids, cada lote en su propia
+           transacción: lecturas y escrituras siguen sirviéndose de las
+           tablas de texto mientras tanto.
+        3. Copia lo escrito durante la copia e intercambia las tablas por
+           nombre en una transacción corta (no reescribe nada).
+        4. Vacía y borra las tablas de texto antiguas, también por lotes.
+        
+        Hasta la versión 3, extrae del JSON de metadata las etiquetas, los
+        rostros y la confianza del audio, también por lotes.
+        
+        Entre lote y lote se espera pausa segundos para que las escrituras en
+        espera consigan el bloqueo. VACUUM (compactar=True) devuelve al disco
+        el espacio liberado, pero bloquea las escrituras mientras dura.
+        Devuelve los ficheros migrados.
+        """
+        migrados = 0
+        for ruta in self.partitions():
+            if os.path.dirname(ruta) == self.archive_dir:
+                continue
+            with self.get_connection(ruta) as conn:
+                version = self._schema_version(conn.cursor())
+                pendiente = conn.execute("""
+                    SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'feedback_texto'
+                """).fetchone()
+            if pendiente and version >= 2:
+                # Migración interrumpida tras el intercambio
+                self._migrate_drop_old(ruta, lote, pausa)
+            if version >= SCHEMA_VERSION:
+                continue
             
-            # Tabla principal de feedback
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS feedback (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    feedback_id TEXT UNIQUE NOT NULL,
-                    tipo TEXT NOT NULL,
-                    sentimiento TEXT NOT NULL,
-                    score REAL NOT NULL,
-                    magnitude REAL,
-                    categoria TEXT,
-                    texto_muestra TEXT,
-                    timestamp TEXT NOT NULL,
-                    metadata TEXT
-                )
-            """)
-            
-            # Tabla de entidades detectadas
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS entidades (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    feedback_id TEXT NOT NULL,
-                    nombre TEXT NOT NULL,
-                    tipo TEXT NOT NULL,
-                    relevancia REAL,
-                    FOREIGN KEY (feedback_id) REFERENCES feedback(feedback_id)
-                )
-            """)
-            
-            # Tabla de estadísticas agregadas (para optimizar consultas)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS estadisticas_diarias (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    fecha TEXT UNIQUE NOT NULL,
-                    total_feedback INTEGER DEFAULT 0,
-                    positivos INTEGER DEFAULT 0,
-                    negativos INTEGER DEFAULT 0,
-                    neutrales INTEGER DEFAULT 0,
-                    score_promedio REAL DEFAULT 0,
-                    last_updated TEXT NOT NULL
-                )
-            """)
+            inicio = datetime.now()
+            if version < 2:
+                self._migrate_create(ruta)
+                copiados = {"feedback": 0, "entidades": 0}
+                while True:
+                    # Copiar hasta alcanzar lo que se va escribiendo
+                    nuevos = 0
+                    for tabla in copiados:
+                        nuevos += self._migrate_copy(ruta, tabla, copiados, lote)
+                        time.sleep(pausa)
+                    if nuevos < lote:
+                        break
+                self._migrate_swap(ruta, copiados, lote)
+                self._migrate_drop_old(ruta, lote, pausa)
+            self._migrate_labels(ruta, lote, pausa)
             
-            # Índices para mejorar rendimiento
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_feedback_timestamp 
-                ON feedback(timestamp)
-            """)
+            if compactar:
+                conn = sqlite3.connect(ruta, isolation_level=None)
+                try:
+                    conn.execute("VACUUM")
+                finally:
+                    conn.close()
+            migrados += 1
+            logger.info(f"🔢 Esquema v{SCHEMA_VERSION} en {ruta} ({(datetime.now() - inicio).total_seconds():.1f} s)")
+        
+        return migrados
+    
+    @staticmethod
+    def _create_label_table(cursor):
+        """Etiquetas detectadas por Vision (nombre interno en valores, dominio 'etiqueta')"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS etiquetas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                feedback_id TEXT NOT NULL,
+                etiqueta_id INTEGER NOT NULL,
+                sentimiento_id INTEGER NOT NULL,
+                confianza REAL,
+                FOREIGN KEY (feedback_id) REFERENCES feedback(feedback_id)
+            )
+        """)
+        # Cubriente: las etiquetas más frecuentes por sentimiento salen del índice
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_etiquetas_sentimiento
+            ON etiquetas(sentimiento_id, etiqueta_id, confianza)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_etiquetas_feedback
+            ON etiquetas(feedback_id)
+        """)
+    
+    def _migrate_create(self, ruta: str):
+        with self.get_connection(ruta) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DROP TABLE IF EXISTS feedback_v2")
+            cursor.execute("DROP TABLE IF EXISTS entidades_v2")
+            self._create_encoded_tables(cursor, sufijo="_v2")
+            cursor.execute("PRAGMA user_version = 1")
+        self._forget_values(ruta)
+    
+    def _migrate_copy(self, ruta: str, tabla: str, copiados: Dict[str, int], lote: int) -> int:
+        with self.get_connection(ruta) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            return self._copy_batch(cursor, tabla, copiados, lote)
+    
+    @staticmethod
+    def _copy_batch(cursor, tabla: str, copiados: Dict[str, int], lote: int) -> int:
+        """Copiar codificadas las siguientes filas de tabla (con id posterior a copiados[tabla])"""
+        if tabla == "feedback":
+            dominios = (("tipo", "tipo"), ("sentimiento", "sentimiento"), ("categoria", "categoria"))
+            insercion = """
+                INSERT INTO feedback_v2
+                (id, feedback_id, tipo_id, sentimiento_id, score, magnitude, categoria_id,
+                 texto_muestra, timestamp, metadata, es_duplicado)
+                SELECT f.id, f.feedback_id, t.id, s.id, f.score, f.magnitude, c.id,
+                       f.texto_muestra, f.timestamp, f.metadata, f.es_duplicado
+                FROM feedback f
+                JOIN valores t ON t.dominio = 'tipo' AND t.valor = f.tipo
+                JOIN valores s ON s.dominio = 'sentimiento' AND s.valor = f.sentimiento
+                LEFT JOIN valores c ON c.dominio = 'categoria' AND c.valor = f.categoria
+                WHERE f.id > ? AND f.id <= ?
+            """
+        else:
+            dominios = (("entidad", "nombre"), ("entidad_tipo", "tipo"))
+            insercion = """
+                INSERT INTO entidades_v2 (id, feedback_id, nombre_id, tipo_id, relevancia)
+                SELECT e.id, e.feedback_id, n.id, t.id, e.relevancia
+                FROM entidades e
+                JOIN valores n ON n.dominio = 'entidad' AND n.valor = e.nombre
+                JOIN valores t ON t.dominio = 'entidad_tipo' AND t.valor = e.tipo
+                WHERE e.id > ? AND e.id <= ?
+            """
+        
+        desde = copiados[tabla]
+        cursor.execute(f"SELECT id FROM {tabla} WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?",
+                       (desde, lote - 1))
+        fila = cursor.fetchone()
+        if fila is None:
+            cursor.execute(f"SELECT MAX(id) FROM {tabla}")
+            fila = cursor.fetchone()
+        hasta = max(fila[0] or 0, desde)
+        if hasta == desde:
+            return 0
+        
+        for dominio, columna in dominios:
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO valores (dominio, valor)
+                SELECT DISTINCT ?, {columna} FROM {tabla}
+                WHERE id > ? AND id <= ? AND {columna} IS NOT NULL
+            """, (dominio, desde, hasta))
+        cursor.execute(insercion, (desde, hasta))
+        copiados[tabla] = hasta
+        return cursor.rowcount
+    
+    def _migrate_swap(self, ruta: str, copiados: Dict[str, int], lote: int):
+        """Copiar el último tramo e intercambiar las tablas (transacción corta)"""
+        with self.get_connection(ruta) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for tabla in copiados:
+                while self._copy_batch(cursor, tabla, copiados, lote):
+                    pass
+                # Filas borradas (clear_old_data) después de copiarlas
+                cursor.execute(f"DELETE FROM {tabla}_v2 WHERE id NOT IN (SELECT id FROM {tabla})")
             
+            # Sin reescribir las FOREIGN KEY de las demás tablas al renombrar
+            cursor.execute("PRAGMA legacy_alter_table = ON")
+            for tabla in copiados:
+                cursor.execute(f"ALTER TABLE {tabla} RENAME TO {tabla}_texto")
+                cursor.execute(f"ALTER TABLE {tabla}_v2 RENAME TO {tabla}")
+            cursor.execute("PRAGMA legacy_alter_table = OFF")
+            cursor.execute("PRAGMA user_version = 2")
+        self._forget_values(ruta)
+    
+    def _migrate_labels(self, ruta: str, lote: int, pausa: float):
+        """Versión 2 -> 3: pasar etiquetas, rostros y confianza del audio a columnas"""
+        with self.get_connection(ruta) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            self._ensure_column(cursor, "feedback", "rostros", "INTEGER")
+            self._ensure_column(cursor, "feedback", "audio_confianza", "REAL")
+            self._create_label_table(cursor)
+        
+        desde = 0
+        while True:
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                hasta = self._extract_metadata(cursor, ruta, desde, lote)
+                if hasta is None:
+                    # Al día: se cambia de versión en esta misma transacción
+                    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                    break
+            desde = hasta
+            time.sleep(pausa)
+        self._forget_values(ruta)
+    
+    def _extract_metadata(self, cursor, ruta: str, desde: int, lote: int) -> Optional[int]:
+        """Extraer del JSON las filas siguientes a desde; None si no queda ninguna"""
+        cursor.execute("""
+            SELECT id, feedback_id, sentimiento_id, metadata FROM feedback
+            WHERE id > ? ORDER BY id LIMIT ?
+        """, (desde, lote))
+        filas = cursor.fetchall()
+        if not filas:
+            return None
+        
+        for fila in filas:
+            metadata = json.loads(fila['metadata']) if fila['metadata'] else {}
+            if not {"rostros", "audio_confianza", "objetos"} & metadata.keys():
+                continue
+            rostros = metadata.pop("rostros", None)
+            audio_confianza = metadata.pop("audio_confianza", None)
+            self._insert_labels(cursor, ruta, fila['feedback_id'], fila['sentimiento_id'],
+                                metadata.pop("objetos", None))
             cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_feedback_sentimiento 
-                ON feedback(sentimiento)
-            """)
-            
+                UPDATE feedback SET rostros = ?, audio_confianza = ?, metadata = ?
+                WHERE id = ?
+            """, (rostros, audio_confianza, json.dumps(metadata), fila['id']))
+        return filas[-1]['id']
+    
+    def _insert_labels(self, cursor, ruta: str, feedback_id: str, sentimiento_id: int,
+                       objetos: Optional[List[Dict[str, Any]]]):
+        for objeto in objetos or []:
             cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_feedback_categoria 
-                ON feedback(categoria)
-            """)
-            
-            print("✅ Base de datos inicializada correctamente")
+                INSERT INTO etiquetas (feedback_id, etiqueta_id, sentimiento_id, confianza)
+                VALUES (?, ?, ?, ?)
+            """, (feedback_id, self._intern(cursor, ruta, "etiqueta", objeto.get("nombre")),
+                  sentimiento_id, objeto.get("confianza")))
     
-    def add_feedback(self, feedback_data: Dict[str, Any]) -> bool:
-        """Añadir feedback a la base de datos"""
-        try:
-            with self.get_connection() as conn:
+    def _migrate_drop_old(self, ruta: str, lote: int, pausa: float = 0.1):
+        """Vaciar por lotes y borrar las tablas de texto ya sustituidas"""
+        for tabla in ("feedback_texto", "entidades_texto"):
+            while True:
+                with self.get_connection(ruta) as conn:
+                    borradas = conn.execute(f"""
+                        DELETE FROM {tabla}
+                        WHERE id IN (SELECT id FROM {tabla} LIMIT ?)
+                    """, (lote,)).rowcount
+                if not borradas:
+                    break
+                time.sleep(pausa)
+            with self.get_connection(ruta) as conn:
+                conn.execute(f"DROP TABLE {tabla}")
+    
+    def _load_dedup_index(self):
+        """Cargar en memoria las firmas MinHash (calculando las que falten)"""
+        self.dedup_index = MinHashIndex()
+        for ruta in self.partitions():
+            with self.get_connection(ruta) as conn:
                 cursor = conn.cursor()
                 
-                # Datos principales
-                feedback_id = feedback_data.get("id")
-                tipo = feedback_data.get("tipo", "texto")
-                sentimiento = feedback_data.get("sentimiento", "neutral")
-                score = feedback_data.get("score", 0.0)
-                magnitude = feedback_data.get("magnitude")
-                categoria = feedback_data.get("categoria", "General")
-                texto_muestra = feedback_data.get("texto", "")[:500]  # Máximo 500 chars
-                timestamp = feedback_data.get("timestamp", datetime.now().isoformat())
-                
-                # Metadata adicional como JSON
-                metadata = {
-                    "confianza": feedback_data.get("confianza"),
-                    "rostros": feedback_data.get("rostros"),
-                    "objetos": feedback_data.get("objetos"),
-                    "audio_confianza": feedback_data.get("audio_confianza")
-                }
-                metadata_json = json.dumps({k: v for k, v in metadata.items() if v is not None})
-                
-                # Insertar feedback
+                # Feedback guardado antes de existir el índice
                 cursor.execute("""
-                    INSERT INTO feedback 
-                    (feedback_id, tipo, sentimiento, score, magnitude, categoria, 
-                     texto_muestra, timestamp, metadata)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (feedback_id, tipo, sentimiento, score, magnitude, categoria,
-                      texto_muestra, timestamp, metadata_json))
+                    SELECT f.feedback_id, f.texto_muestra
+                    FROM feedback f
+                    LEFT JOIN feedback_minhash s ON s.feedback_id = f.feedback_id
+                    WHERE s.feedback_id IS NULL AND f.es_duplicado = 0
+                      AND f.texto_muestra IS NOT NULL AND f.texto_muestra != ''
+                """)
+                pendientes = []
+                for row in cursor.fetchall():
+                    firma = minhash(row['texto_muestra'])
+                    if firma is not None:
+                        pendientes.append((row['feedback_id'], firma.tobytes()))
+                if os.path.dirname(ruta) == self.archive_dir:
+                    # Partición de solo lectura: las firmas quedan solo en memoria
+                    for feedback_id, firma in pendientes:
+                        self.dedup_index.add(np.frombuffer(firma, dtype=np.uint32), feedback_id)
+                else:
+                    cursor.executemany("""
+                        INSERT OR IGNORE INTO feedback_minhash (feedback_id, firma)
+                        VALUES (?, ?)
+                    """, pendientes)
                 
-                # Insertar entidades si existen
-                if "entidades" in feedback_data and feedback_data["entidades"]:
-                    for entidad in feedback_data["entidades"]:
-                        cursor.execute("""
-                            INSERT INTO entidades (feedback_id, nombre, tipo, relevancia)
-                            VALUES (?, ?, ?, ?)
-                        """, (feedback_id, entidad.get("nombre"), 
-                              entidad.get("tipo"), entidad.get("relevancia", 0)))
-                
-                # Actualizar estadísticas diarias
-                self._update_daily_stats(cursor, timestamp, sentimiento, score)
+                cursor.execute("SELECT feedback_id, firma FROM feedback_minhash")
+                for row in cursor.fetchall():
+                    self.dedup_index.add(np.frombuffer(row['firma'], dtype=np.uint32), row['feedback_id'])
+    
+    def find_duplicate(self, texto: str) -> Optional[Dict[str, Any]]:
+        """Buscar feedback casi idéntico ya guardado"""
+        if not texto:
+            return None
+        firma = minhash(texto)
+        encontrado = self.dedup_index.find(firma) if firma is not None else None
+        if encontrado is None:
+            return None
+        return {"feedback_id": encontrado[0], "similitud": round(encontrado[1], 2)}
+    
+    @staticmethod
+    def _decode_row(fila: Dict[str, Any], columnas: Dict[str, str], decode) -> Dict[str, Any]:
+        """Sustituir los ids de tipo, sentimiento y categoría de una fila por sus nombres"""
+        for campo in ("tipo", "sentimiento", "categoria"):
+            if columnas[campo] != campo:
+                fila[campo] = decode(fila.pop(columnas[campo]))
+        return fila
+    
+    @staticmethod
+    def _entities_of(cursor, feedback_id: str, columnas: Dict[str, str], decode) -> List[Dict[str, Any]]:
+        cursor.execute(f"""
+            SELECT {columnas['nombre']} AS nombre, {columnas['entidad_tipo']} AS tipo, relevancia
+            FROM entidades
+            WHERE feedback_id = ?
+        """, (feedback_id,))
+        return [
+            {"nombre": decode(e['nombre']), "tipo": decode(e['tipo']), "relevancia": e['relevancia']}
+            for e in cursor.fetchall()
+        ]
+    
+    @staticmethod
+    def _entities_by_feedback(cursor, feedback_ids: List[str], columnas: Dict[str, str],
+                              decode) -> Dict[str, List[Dict[str, Any]]]:
+        """Entidades de varios feedback en una sola consulta"""
+        entidades: Dict[str, List[Dict[str, Any]]] = {}
+        if not feedback_ids:
+            return entidades
+        cursor.execute(f"""
+            SELECT feedback_id, {columnas['nombre']} AS nombre,
+                   {columnas['entidad_tipo']} AS tipo, relevancia
+            FROM entidades
+            WHERE feedback_id IN ({", ".join("?" * len(feedback_ids))})
+        """, feedback_ids)
+        for e in cursor.fetchall():
+            entidades.setdefault(e['feedback_id'], []).append({
+                "nombre": decode(e['nombre']), "tipo": decode(e['tipo']),
+                "relevancia": e['relevancia']
+            })
+        return entidades
+    
+    @staticmethod
+    def _labels_of(cursor, feedback_ids: List[str], decode) -> Dict[str, List[Dict[str, Any]]]:
+        """Etiquetas de imagen por feedback_id (vacío si el fichero no tiene tabla etiquetas)"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'etiquetas'")
+        if cursor.fetchone() is None or not feedback_ids:
+            return {}
+        cursor.execute(f"""
+            SELECT feedback_id, etiqueta_id, confianza FROM etiquetas
+            WHERE feedback_id IN ({", ".join("?" * len(feedback_ids))})
+            ORDER BY id
+        """, feedback_ids)
+        etiquetas: Dict[str, List[Dict[str, Any]]] = {}
+        for e in cursor.fetchall():
+            etiquetas.setdefault(e['feedback_id'], []).append(
+                {"nombre": decode(e['etiqueta_id']), "confianza": e['confianza']})
+        return etiquetas
+    
+    @staticmethod
+    def _merge_image_metadata(metadata: Dict[str, Any], fila: Dict[str, Any],
+                              objetos: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Devolver a metadata los datos de imagen guardados en columnas (versión 3)"""
+        for campo in ("rostros", "audio_confianza"):
+            if fila.get(campo) is not None:
+                metadata[campo] = fila[campo]
+        if objetos:
+            metadata["objetos"] = objetos
+        return metadata
+    
+    def get_feedback(self, feedback_id: str) -> Optional[Dict[str, Any]]:
+        """Obtener un feedback con sus entidades"""
+        for ruta in self.partitions(recientes_primero=True):
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
                 
-                print(f"✅ Feedback {feedback_id} guardado en base de datos")
-                return True
+                cursor.execute("SELECT * FROM feedback WHERE feedback_id = ?", (feedback_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    continue
                 
-        except sqlite3.IntegrityError:
-            print(f"⚠️ Feedback {feedback_id} ya existe en la base de datos")
-            return False
-        except Exception as e:
-            print(f"❌ Error al guardar feedback: {str(e)}")
-            return False
+                columnas, decode = self.column_map(conn, ruta)
+                feedback = self._decode_row(dict(row), columnas, decode)
+                metadata = json.loads(feedback['metadata']) if feedback['metadata'] else {}
+                objetos = self._labels_of(cursor, [feedback_id], decode).get(feedback_id)
+                feedback['metadata'] = self._merge_image_metadata(metadata, feedback, objetos)
+                feedback['entidades'] = self._entities_of(cursor, feedback_id, columnas, decode)
+                return feedback
+        return None
+    
+    def add_feedback(self, feedback_data: Dict[str, Any]) -> bool:
+        """Añadir feedback a la base de datos"""
+        if self.writer is not None:
+            # Modo multi-worker: la escritura la hace el proceso escritor
+            return self.writer.add_feedback(feedback_data)
+        return self.add_feedback_many([feedback_data])[0]
+    
+    def add_feedback_many(self, items: List[Dict[str, Any]]) -> List[bool]:
+        """
+        Añadir varios feedback en una sola transacción; devuelve si se guardó cada uno
+        
+        False solo significa que el feedback_id ya existía. Un error de la base
+        de datos se propaga, salvo que otra partición del lote ya se hubiera
+        confirmado: entonces se devuelve lo que sí quedó guardado.
+        """
+        if self.writer is not None:
+            return self.writer.add_feedback_many(items)
+        try:
+            resultados, eventos = self.write_many(items)
+        except PartialWriteError as e:
+            # Las particiones confirmadas antes del fallo sí están guardadas
+            logger.exception("❌ Error al guardar feedback", extra={
+                "evento": "feedback_error",
+                "feedback_ids": [item.get("id") for item, ok in zip(items, e.resultados) if not ok]})
+            resultados, eventos = e.resultados, e.eventos
+        except Exception:
+            logger.exception("❌ Error al guardar feedback", extra={
+                "evento": "feedback_error", "feedback_ids": [item.get("id") for item in items]})
+            raise
+        
+        for evento in eventos:
+            self.apply_committed(evento)
+        return resultados
+    
+    def write_many(self, items: List[Dict[str, Any]], verbose: bool = True):
+        """
+        Escribir un lote de feedback en una sola transacción (una por partición)
+        
+        Cada elemento va en su propio SAVEPOINT: un feedback_id repetido no
+        aborta el resto del lote. Devuelve (resultados, eventos) sin aplicar
+        los eventos al estado en memoria; los errores de SQLite se propagan
+        (como PartialWriteError si ya se había confirmado otra partición).
+        """
+        # Agrupar por fichero de destino manteniendo el orden original
+        grupos: Dict[str, List[int]] = {}
+        items = [
+            item if item.get("timestamp") else dict(item, timestamp=datetime.now().isoformat())
+            for item in items
+        ]
+        for i, item in enumerate(items):
+            grupos.setdefault(self._partition_for(item["timestamp"]), []).append(i)
+        
+        resultados = [False] * len(items)
+        eventos = {}
+        for ruta, indices in grupos.items():
+            try:
+                with self.get_connection(ruta) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("BEGIN IMMEDIATE")
+                    version = self._schema_version(cursor)
+                    
+                    for i in indices:
+                        cursor.execute("SAVEPOINT feedback_item")
+                        try:
+                            eventos[i] = self._insert_feedback(cursor, items[i], ruta, version)
+                            cursor.execute("RELEASE SAVEPOINT feedback_item")
+                            resultados[i] = True
+                        except sqlite3.IntegrityError:
+                            cursor.execute("ROLLBACK TO SAVEPOINT feedback_item")
+                            cursor.execute("RELEASE SAVEPOINT feedback_item")
+                            # Los valores nuevos de este elemento también se han deshecho
+                            self._forget_values(ruta)
+                            if verbose:
+                                logger.warning("⚠️ Feedback ya existe en la base de datos",
+                                               extra={"evento": "feedback_duplicado",
+                                                      "feedback_id": items[i].get("id")})
+            except Exception as e:
+                self._forget_values(ruta)
+                # La transacción de esta partición se ha deshecho entera
+                for i in indices:
+                    resultados[i] = False
+                    eventos.pop(i, None)
+                if not eventos:
+                    raise
+                raise PartialWriteError(
+                    f"Lote guardado en parte ({len(eventos)} de {len(items)}): {str(e)}",
+                    resultados, [eventos[i] for i in sorted(eventos)]) from e
+        
+        eventos = [eventos[i] for i in sorted(eventos)]
+        if verbose:
+            for evento in eventos:
+                logger.info("✅ Feedback guardado en base de datos",
+                            extra={"evento": "feedback_guardado", "feedback_id": evento['resumen']['id']})
+        return resultados, eventos
+    
+    def _insert_feedback(self, cursor, feedback_data: Dict[str, Any], ruta: str,
+                         version: int = SCHEMA_VERSION) -> Dict[str, Any]:
+        """Insertar un feedback (sin confirmar); devuelve el evento para apply_committed"""
+        # Datos principales
+        feedback_id = feedback_data.get("id")
+        tipo = feedback_data.get("tipo", "texto")
+        sentimiento = feedback_data.get("sentimiento", "neutral")
+        score = feedback_data.get("score", 0.0)
+        magnitude = feedback_data.get("magnitude")
+        categoria = feedback_data.get("categoria", "General")
+        texto = feedback_data.get("texto", "")
+        texto_muestra = texto[:500]  # Máximo 500 chars
+        timestamp = feedback_data.get("timestamp") or datetime.now().isoformat()
+        duplicado_de = feedback_data.get("duplicado_de")
+        
+        # Metadata adicional como JSON (desde la versión 3, rostros,
+        # confianza del audio y etiquetas van en columnas y tabla propias)
+        metadata = {
+            "confianza": feedback_data.get("confianza"),
+            "duplicado_de": duplicado_de
+        }
+        if version < 3:
+            metadata.update(rostros=feedback_data.get("rostros"),
+                            objetos=feedback_data.get("objetos"),
+                            audio_confianza=feedback_data.get("audio_confianza"))
+        metadata_json = json.dumps({k: v for k, v in metadata.items() if v is not None})
+        
+        # Insertar feedback (ids de la tabla valores o, sin migrar, texto)
+        fila = {
+            "feedback_id": feedback_id, "score": score, "magnitude": magnitude,
+            "texto_muestra": texto_muestra, "timestamp": timestamp,
+            "metadata": metadata_json, "es_duplicado": 1 if duplicado_de else 0
+        }
+        if version < 2:
+            fila.update(tipo=tipo, sentimiento=sentimiento, categoria=categoria)
+        else:
+            fila.update(tipo_id=self._intern(cursor, ruta, "tipo", tipo),
+                        sentimiento_id=self._intern(cursor, ruta, "sentimiento", sentimiento),
+                        categoria_id=self._intern(cursor, ruta, "categoria", categoria))
+        if version >= 3:
+            fila.update(rostros=feedback_data.get("rostros"),
+                        audio_confianza=feedback_data.get("audio_confianza"))
+        cursor.execute(f"""
+            INSERT INTO feedback ({", ".join(fila)})
+            VALUES ({", ".join("?" * len(fila))})
+        """, tuple(fila.values()))
+        if version >= 3:
+            self._insert_labels(cursor, ruta, feedback_id, fila["sentimiento_id"],
+                                feedback_data.get("objetos"))
+        
+        # Firma MinHash (solo de los originales, no de los duplicados)
+        firma = minhash(texto) if texto and not duplicado_de else None
+        if firma is not None:
+            cursor.execute("""
+                INSERT INTO feedback_minhash (feedback_id, firma)
+                VALUES (?, ?)
+            """, (feedback_id, firma.tobytes()))
+        
+        # Insertar entidades si existen
+        if "entidades" in feedback_data and feedback_data["entidades"]:
+            for entidad in feedback_data["entidades"]:
+                fila = {"feedback_id": feedback_id, "relevancia": entidad.get("relevancia", 0)}
+                if version < 2:
+                    fila.update(nombre=entidad.get("nombre"), tipo=entidad.get("tipo"))
+                else:
+                    fila.update(nombre_id=self._intern(cursor, ruta, "entidad", entidad.get("nombre")),
+                                tipo_id=self._intern(cursor, ruta, "entidad_tipo", entidad.get("tipo")))
+                cursor.execute(f"""
+                    INSERT INTO entidades ({", ".join(fila)})
+                    VALUES ({", ".join("?" * len(fila))})
+                """, tuple(fila.values()))
+        
+        # Actualizar estadísticas diarias
+        self._update_daily_stats(cursor, timestamp, sentimiento, score)
+        
+        return {
+            "firma": firma.tobytes() if firma is not None else None,
+            "resumen": {
+                "id": feedback_id,
+                "tipo": tipo,
+                "sentimiento": sentimiento,
+                "score": score,
+                "magnitude": magnitude,
+                "categoria": categoria,
+                "texto": texto_muestra[:100],
+                "timestamp": timestamp,
+                "es_duplicado": bool(duplicado_de)
+            }
+        }
+    
+    def apply_committed(self, evento: Dict[str, Any]):
+        """
+        Actualizar el estado en memoria tras una escritura confirmada
+        
+        Se llama tras guardar en este proceso o, en modo multi-worker, al
+        recibir del proceso escritor las escrituras de cualquier worker.
+        """
+        if evento["firma"] is not None:
+            self.dedup_index.add(np.frombuffer(evento["firma"], dtype=np.uint32), evento["resumen"]["id"])
+        self._notify(evento["resumen"])
+    
+    def resync(self):
+        """Recargar el estado en memoria (p. ej. tras perder eventos del escritor)"""
+        self._load_dedup_index()
+        for hook in self._resync_hooks:
+            try:
+                hook()
+            except Exception:
+                logger.exception("⚠️ Error al resincronizar")
     
     def _update_daily_stats(self, cursor, timestamp: str, sentimiento: str, score: float):
         """Actualizar estadísticas diarias agregadas"""
@@ -193,237 +1149,681 @@ class FeedbackDatabase:
                   1 if sentimiento == 'neutral' else 0,
                   score, datetime.now().isoformat()))
     
-    def get_statistics(self) -> Dict[str, Any]:
-        """Obtener estadísticas generales de todo el histórico"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Total de feedback
-            cursor.execute("SELECT COUNT(*) as total FROM feedback")
-            total = cursor.fetchone()['total']
-            
-            if total == 0:
-                return {
-                    "total": 0,
-                    "positivos": 0,
-                    "negativos": 0,
-                    "neutrales": 0,
-                    "score_promedio": 0,
-                    "porcentaje_positivos": 0,
-                    "porcentaje_negativos": 0,
-                    "porcentaje_neutrales": 0
-                }
-            
-            # Contar por sentimiento
-            cursor.execute("""
-                SELECT sentimiento, COUNT(*) as count 
-                FROM feedback 
-                GROUP BY sentimiento
-            """)
-            
-            sentimientos = {row['sentimiento']: row['count'] for row in cursor.fetchall()}
-            positivos = sentimientos.get('positivo', 0)
-            negativos = sentimientos.get('negativo', 0)
-            neutrales = sentimientos.get('neutral', 0)
-            
-            # Score promedio
-            cursor.execute("SELECT AVG(score) as avg_score FROM feedback")
-            score_promedio = cursor.fetchone()['avg_score'] or 0
-            
+    @staticmethod
+    def _time_filter(excluir_duplicados: bool = False, desde: Optional[str] = None,
+                     hasta: Optional[str] = None, condiciones: Optional[List[str]] = None):
+        """Cláusula WHERE (y sus parámetros) para duplicados y rango temporal [desde, hasta)"""
+        condiciones = list(condiciones or [])
+        params = []
+        if excluir_duplicados:
+            condiciones.append("es_duplicado = 0")
+        if desde:
+            condiciones.append("timestamp >= ?")
+            params.append(desde)
+        if hasta:
+            condiciones.append("timestamp < ?")
+            params.append(hasta)
+        where = ("WHERE " + " AND ".join(condiciones)) if condiciones else ""
+        return where, params
+    
+    def get_statistics(self, excluir_duplicados: bool = False, desde: Optional[str] = None,
+                       hasta: Optional[str] = None) -> Dict[str, Any]:
+        """Obtener estadísticas generales (de todo el histórico o de un rango)"""
+        where, params = self._time_filter(excluir_duplicados, desde, hasta)
+        sentimientos = {}
+        total = 0
+        score_suma = 0.0
+        for ruta in self.partitions(desde, hasta):
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                columnas, decode = self.column_map(conn, ruta)
+                
+                # Contar por sentimiento (total y score salen de la misma pasada)
+                cursor.execute(f"""
+                    SELECT {columnas['sentimiento']} as sentimiento, COUNT(*) as count,
+                           SUM(score) as score_suma
+                    FROM feedback 
+                    {where}
+                    GROUP BY 1
+                """, params)
+                
+                for row in cursor.fetchall():
+                    sentimiento = decode(row['sentimiento'])
+                    sentimientos[sentimiento] = sentimientos.get(sentimiento, 0) + row['count']
+                    total += row['count']
+                    score_suma += row['score_suma'] or 0
+        
+        if total == 0:
             return {
-                "total": total,
-                "positivos": positivos,
-                "negativos": negativos,
-                "neutrales": neutrales,
-                "score_promedio": round(score_promedio, 2),
-                "porcentaje_positivos": round((positivos / total * 100), 1),
-                "porcentaje_negativos": round((negativos / total * 100), 1),
-                "porcentaje_neutrales": round((neutrales / total * 100), 1)
+                "total": 0,
+                "positivos": 0,
+                "negativos": 0,
+                "neutrales": 0,
+                "score_promedio": 0,
+                "porcentaje_positivos": 0,
+                "porcentaje_negativos": 0,
+                "porcentaje_neutrales": 0
             }
+        
+        positivos = sentimientos.get('positivo', 0)
+        negativos = sentimientos.get('negativo', 0)
+        neutrales = sentimientos.get('neutral', 0)
+        
+        return {
+            "total": total,
+            "positivos": positivos,
+            "negativos": negativos,
+            "neutrales": neutrales,
+            "score_promedio": round(score_suma / total, 2),
+            "porcentaje_positivos": round((positivos / total * 100), 1),
+            "porcentaje_negativos": round((negativos / total * 100), 1),
+            "porcentaje_neutrales": round((neutrales / total * 100), 1)
+        }
     
     def get_recent_feedback(self, limit: int = 5) -> List[Dict[str, Any]]:
         """Obtener feedback reciente"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT feedback_id, tipo, sentimiento, score, categoria, 
-                       texto_muestra, timestamp
-                FROM feedback
-                ORDER BY timestamp DESC
-                LIMIT ?
-            """, (limit,))
-            
-            results = []
-            for row in cursor.fetchall():
-                results.append({
-                    "id": row['feedback_id'],
-                    "tipo": row['tipo'],
-                    "sentimiento": row['sentimiento'],
-                    "score": round(row['score'], 2),
-                    "categoria": row['categoria'],
-                    "texto": row['texto_muestra'][:100] if row['texto_muestra'] else "",
-                    "timestamp": row['timestamp']
-                })
-            
-            return results
+        results = []
+        for ruta in self._recent_partitions(lambda: len(results) >= limit):
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                columnas, decode = self.column_map(conn, ruta)
+                
+                cursor.execute(f"""
+                    SELECT feedback_id, {columnas['tipo']} as tipo, {columnas['sentimiento']} as sentimiento,
+                           score, {columnas['categoria']} as categoria, texto_muestra, timestamp
+                    FROM feedback
+                    ORDER BY timestamp DESC
+                    LIMIT ?
+                """, (limit,))
+                
+                for row in cursor.fetchall():
+                    results.append({
+                        "id": row['feedback_id'],
+                        "tipo": decode(row['tipo']),
+                        "sentimiento": decode(row['sentimiento']),
+                        "score": round(row['score'], 2),
+                        "categoria": decode(row['categoria']),
+                        "texto": row['texto_muestra'][:100] if row['texto_muestra'] else "",
+                        "timestamp": row['timestamp']
+                    })
+        
+        results.sort(key=lambda r: r['timestamp'], reverse=True)
+        return results[:limit]
+    
+    def _count_by(self, campos: List[str], excluir_duplicados: bool, desde: Optional[str],
+                  hasta: Optional[str], condiciones: Optional[List[str]] = None) -> Dict[Any, int]:
+        """Contar feedback por uno o varios campos sumando todas las particiones"""
+        conteo = {}
+        for ruta in self.partitions(desde, hasta):
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                columnas, decode = self.column_map(conn, ruta)
+                where, params = self._time_filter(excluir_duplicados, desde, hasta,
+                                                  [c.format(**columnas) for c in condiciones or []])
+                seleccion = ", ".join(f"{columnas[c]} as {c}" for c in campos)
+                cursor.execute(f"""
+                    SELECT {seleccion}, COUNT(*) as count
+                    FROM feedback
+                    {where}
+                    GROUP BY {", ".join(str(i + 1) for i in range(len(campos)))}
+                """, params)
+                for row in cursor.fetchall():
+                    valores = tuple(decode(row[c]) for c in campos)
+                    clave = valores[0] if len(campos) == 1 else valores
+                    conteo[clave] = conteo.get(clave, 0) + row['count']
+        return conteo
     
-    def get_categories(self) -> Dict[str, int]:
+    def get_categories(self, excluir_duplicados: bool = False, desde: Optional[str] = None,
+                       hasta: Optional[str] = None) -> Dict[str, int]:
         """Obtener distribución de categorías"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT categoria, COUNT(*) as count
-                FROM feedback
-                WHERE categoria IS NOT NULL
-                GROUP BY categoria
-                ORDER BY count DESC
-            """)
-            
-            return {row['categoria']: row['count'] for row in cursor.fetchall()}
+        conteo = self._count_by(["categoria"], excluir_duplicados, desde, hasta,
+                                ["{categoria} IS NOT NULL"])
+        return dict(sorted(conteo.items(), key=lambda kv: kv[1], reverse=True))
     
-    def get_stats_by_type(self) -> Dict[str, int]:
+    def get_stats_by_type(self, excluir_duplicados: bool = False, desde: Optional[str] = None,
+                          hasta: Optional[str] = None) -> Dict[str, int]:
         """Obtener estadísticas por tipo de análisis"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT tipo, COUNT(*) as count
-                FROM feedback
-                GROUP BY tipo
-            """)
-            
-            return {row['tipo']: row['count'] for row in cursor.fetchall()}
+        return self._count_by(["tipo"], excluir_duplicados, desde, hasta)
     
     def get_daily_trends(self, days: int = 7) -> List[Dict[str, Any]]:
         """Obtener tendencias de los últimos N días"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT fecha, total_feedback, positivos, negativos, neutrales, 
-                       score_promedio
-                FROM estadisticas_diarias
-                ORDER BY fecha DESC
-                LIMIT ?
-            """, (days,))
-            
-            results = []
-            for row in cursor.fetchall():
-                results.append({
-                    "fecha": row['fecha'],
-                    "total": row['total_feedback'],
-                    "positivos": row['positivos'],
-                    "negativos": row['negativos'],
-                    "neutrales": row['neutrales'],
-                    "score_promedio": round(row['score_promedio'], 2)
-                })
-            
-            return list(reversed(results))  # Más antiguo primero
+        dias = {}
+        for ruta in self._recent_partitions(lambda: len(dias) >= days):
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute("""
+                    SELECT fecha, total_feedback, positivos, negativos, neutrales, 
+                           score_promedio
+                    FROM estadisticas_diarias
+                    ORDER BY fecha DESC
+                    LIMIT ?
+                """, (days,))
+                
+                for row in cursor.fetchall():
+                    dia = dias.setdefault(row['fecha'], {
+                        "fecha": row['fecha'], "total": 0, "positivos": 0,
+                        "negativos": 0, "neutrales": 0, "score_suma": 0.0
+                    })
+                    dia["total"] += row['total_feedback']
+                    dia["positivos"] += row['positivos']
+                    dia["negativos"] += row['negativos']
+                    dia["neutrales"] += row['neutrales']
+                    dia["score_suma"] += row['score_promedio'] * row['total_feedback']
+        
+        results = []
+        for fecha in sorted(dias)[-days:]:  # Más antiguo primero
+            dia = dias[fecha]
+            score_suma = dia.pop("score_suma")
+            dia["score_promedio"] = round(score_suma / dia["total"], 2) if dia["total"] else 0
+            results.append(dia)
+        return results
     
-    def get_top_entities(self, limit: int = 10) -> List[Dict[str, Any]]:
+    def get_top_entities(self, limit: int = 10, desde: Optional[str] = None,
+                         hasta: Optional[str] = None) -> List[Dict[str, Any]]:
         """Obtener las entidades más mencionadas"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT nombre, tipo, COUNT(*) as mentions, 
-                       AVG(relevancia) as avg_relevancia
-                FROM entidades
-                GROUP BY nombre, tipo
-                ORDER BY mentions DESC, avg_relevancia DESC
-                LIMIT ?
-            """, (limit,))
-            
-            results = []
-            for row in cursor.fetchall():
-                results.append({
-                    "nombre": row['nombre'],
-                    "tipo": row['tipo'],
-                    "menciones": row['mentions'],
-                    "relevancia_promedio": round(row['avg_relevancia'], 2) if row['avg_relevancia'] else 0
-                })
-            
-            return results
+        if desde or hasta:
+            where, params = self._time_filter(desde=desde, hasta=hasta)
+            origen = f"entidades WHERE feedback_id IN (SELECT feedback_id FROM feedback {where})"
+        else:
+            origen, params = "entidades", []
+        
+        entidades = {}
+        for ruta in self.partitions(desde, hasta):
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                columnas, decode = self.column_map(conn, ruta)
+                
+                cursor.execute(f"""
+                    SELECT {columnas['nombre']} as nombre, {columnas['entidad_tipo']} as tipo,
+                           COUNT(*) as mentions, 
+                           SUM(relevancia) as suma_relevancia,
+                           COUNT(relevancia) as con_relevancia
+                    FROM {origen}
+                    GROUP BY 1, 2
+                """, params)
+                
+                for row in cursor.fetchall():
+                    clave = (decode(row['nombre']), decode(row['tipo']))
+                    e = entidades.setdefault(clave, [0, 0.0, 0])
+                    e[0] += row['mentions']
+                    e[1] += row['suma_relevancia'] or 0
+                    e[2] += row['con_relevancia']
+        
+        # Más mencionadas primero; a igualdad, mayor relevancia media
+        orden = sorted(entidades.items(), key=lambda kv: (
+            -kv[1][0], -(kv[1][1] / kv[1][2] if kv[1][2] else 0), kv[0][0] or "", kv[0][1] or ""
+        ))
+        results = []
+        for (nombre, tipo), (menciones, suma, con_relevancia) in orden[:limit]:
+            results.append({
+                "nombre": nombre,
+                "tipo": tipo,
+                "menciones": menciones,
+                "relevancia_promedio": round(suma / con_relevancia, 2) if suma else 0
+            })
+        
+        return results
     
-    def get_sentiment_by_category(self) -> Dict[str, Dict[str, int]]:
-        """Obtener distribución de sentimientos por categoría"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT categoria, sentimiento, COUNT(*) as count
-                FROM feedback
-                WHERE categoria IS NOT NULL
-                GROUP BY categoria, sentimiento
-                ORDER BY categoria, sentimiento
-            """)
-            
-            result = {}
-            for row in cursor.fetchall():
-                categoria = row['categoria']
-                sentimiento = row['sentimiento']
-                count = row['count']
+    def get_top_labels(self, sentimiento: Optional[str] = None, limit: int = 10,
+                       desde: Optional[str] = None, hasta: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Etiquetas de imagen más frecuentes por sentimiento
+        
+        Sin rango temporal se resuelve entero desde idx_etiquetas_sentimiento;
+        los ficheros aún sin migrar a la versión 3 no tienen tabla etiquetas
+        y no cuentan hasta que migrate_schema los procesa.
+        """
+        condiciones, params = [], []
+        if desde or hasta:
+            where, params = self._time_filter(desde=desde, hasta=hasta)
+            condiciones.append(f"feedback_id IN (SELECT feedback_id FROM feedback {where})")
+        
+        etiquetas = {}
+        for ruta in self.partitions(desde, hasta):
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'etiquetas'")
+                if cursor.fetchone() is None:
+                    continue
+                _, decode = self.column_map(conn, ruta)
                 
-                if categoria not in result:
-                    result[categoria] = {'positivo': 0, 'negativo': 0, 'neutral': 0}
+                filtro, valores = list(condiciones), list(params)
+                if sentimiento:
+                    cursor.execute("SELECT id FROM valores WHERE dominio = 'sentimiento' AND valor = ?",
+                                   (sentimiento,))
+                    row = cursor.fetchone()
+                    if row is None:
+                        continue
+                    filtro.insert(0, "sentimiento_id = ?")
+                    valores.insert(0, row[0])
+                where = ("WHERE " + " AND ".join(filtro)) if filtro else ""
                 
-                result[categoria][sentimiento] = count
+                cursor.execute(f"""
+                    SELECT sentimiento_id, etiqueta_id, COUNT(*) as apariciones,
+                           SUM(confianza) as suma_confianza, COUNT(confianza) as con_confianza
+                    FROM etiquetas {where}
+                    GROUP BY sentimiento_id, etiqueta_id
+                """, valores)
+                
+                for row in cursor.fetchall():
+                    clave = (decode(row['sentimiento_id']), decode(row['etiqueta_id']))
+                    e = etiquetas.setdefault(clave, [0, 0.0, 0])
+                    e[0] += row['apariciones']
+                    e[1] += row['suma_confianza'] or 0
+                    e[2] += row['con_confianza']
+        
+        result: Dict[str, List[Dict[str, Any]]] = {}
+        for (sent, etiqueta), (apariciones, suma, con_confianza) in sorted(
+                etiquetas.items(), key=lambda kv: (kv[0][0] or "", -kv[1][0], kv[0][1] or "")):
+            lista = result.setdefault(sent, [])
+            if len(lista) < limit:
+                lista.append({
+                    "etiqueta": etiqueta,
+                    "apariciones": apariciones,
+                    "confianza_promedio": round(suma / con_confianza, 2) if con_confianza else None
+                })
+        
+        return result
+    
+    def get_sentiment_by_category(self, excluir_duplicados: bool = False, desde: Optional[str] = None,
+                                  hasta: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        """Obtener distribución de sentimientos por categoría"""
+        conteo = self._count_by(["categoria", "sentimiento"], excluir_duplicados, desde, hasta,
+                                ["{categoria} IS NOT NULL"])
+        
+        result = {}
+        for (categoria, sentimiento), count in sorted(conteo.items()):
+            if categoria not in result:
+                result[categoria] = {'positivo': 0, 'negativo': 0, 'neutral': 0}
             
-            return result
+            result[categoria][sentimiento] = count
+        
+        return result
     
     def clear_old_data(self, days: int = 90):
-        """Limpiar datos antiguos (más de X días)"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            from datetime import timedelta
-            cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
-            
-            # Eliminar feedback antiguo
-            cursor.execute("""
-                DELETE FROM feedback
-                WHERE timestamp < ?
-            """, (cutoff_date,))
-            
-            deleted = cursor.rowcount
+        """
+        Limpiar datos antiguos (más de X días)
+        
+        Con particionado, los meses enteramente anteriores al corte se borran
+        como ficheros; solo el mes del corte se limpia fila a fila.
+        """
+        if self.writer is not None:
+            # Con el proceso escritor activo, la ejecuta él (ver writer.py)
+            return self.writer.run("clear_old_data", days)
+        cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
+        deleted = 0
+        
+        for ruta in self.partitions(hasta=cutoff_date):
+            mes = self._mes(ruta)
+            if mes is not None and mes < cutoff_date[:7]:
+                with self.get_connection(ruta) as conn:
+                    deleted += conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
+                self._drop_partition(ruta)
+                continue
+            if os.path.dirname(ruta) == self.archive_dir:
+                # Solo lectura: se borrará entera cuando el corte pase de mes
+                continue
             
-            # Limpiar entidades huérfanas
-            cursor.execute("""
-                DELETE FROM entidades
-                WHERE feedback_id NOT IN (SELECT feedback_id FROM feedback)
-            """)
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                
+                # Eliminar feedback antiguo
+                cursor.execute("""
+                    DELETE FROM feedback
+                    WHERE timestamp < ?
+                """, (cutoff_date,))
+                
+                deleted += cursor.rowcount
+                
+                # Limpiar entidades y firmas huérfanas
+                cursor.execute("""
+                    DELETE FROM entidades
+                    WHERE feedback_id NOT IN (SELECT feedback_id FROM feedback)
+                """)
+                
+                cursor.execute("""
+                    DELETE FROM feedback_minhash
+                    WHERE feedback_id NOT IN (SELECT feedback_id FROM feedback)
+                """)
+                
+                if self._schema_version(cursor) >= 3:
+                    cursor.execute("""
+                        DELETE FROM etiquetas
+                        WHERE feedback_id NOT IN (SELECT feedback_id FROM feedback)
+                    """)
             
-            print(f"🗑️ Eliminados {deleted} registros antiguos (>{days} días)")
-            return deleted
+        if deleted:
+            # Índice de duplicados, analítica, alertas, feed y chatbot dejan
+            # de contar las filas borradas
+            self.resync()
+        
+        logger.info(f"🗑️ Eliminados {deleted} registros antiguos (>{days} días)")
+        return deleted
     
     def export_to_json(self, filepath: str = "feedback_export.json"):
-        """Exportar toda la base de datos a JSON"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        """Exportar toda la base de datos a JSON (escribiendo fila a fila)"""
+        total = 0
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write("[")
+            for ruta in self.partitions(recientes_primero=True):
+                with self.get_connection(ruta) as conn:
+                    cursor = conn.cursor()
+                    consulta = conn.cursor()
+                    
+                    columnas, decode = self.column_map(conn, ruta)
+                    cursor.execute("SELECT * FROM feedback ORDER BY timestamp DESC")
+                    
+                    while True:
+                        filas = cursor.fetchmany(500)
+                        if not filas:
+                            break
+                        
+                        # Entidades y etiquetas asociadas, por lotes
+                        ids = [fila['feedback_id'] for fila in filas]
+                        entidades = self._entities_by_feedback(consulta, ids, columnas, decode)
+                        etiquetas = self._labels_of(consulta, ids, decode)
+                        for row in filas:
+                            feedback_dict = self._decode_row(dict(row), columnas, decode)
+                            feedback_dict['entidades'] = entidades.get(feedback_dict['feedback_id'], [])
+                            if feedback_dict['feedback_id'] in etiquetas:
+                                feedback_dict['objetos'] = etiquetas[feedback_dict['feedback_id']]
+                            f.write(",\n" if total else "\n")
+                            f.write(json.dumps(feedback_dict, ensure_ascii=False, indent=2))
+                            total += 1
+            f.write("\n]\n")
+        
+        logger.info(f"📁 Datos exportados a {filepath}")
+        return filepath
+    
+    def import_from_json(self, filepath: str, lote: int = 5000, offline: bool = False) -> Dict[str, int]:
+        """
+        Restaurar en bloque un fichero de export_to_json (o JSON lines)
+        
+        El fichero se lee en streaming en este proceso y cada lote de
+        registros se inserta con restore_batch (con executemany, una
+        transacción por mes); con el proceso escritor conectado (db.writer)
+        los lotes los escribe él, entre las escrituras de la web. Durante la
+        carga no se tocan las estadísticas diarias ni las firmas MinHash: al
+        final finish_restore recalcula las estadísticas de los días cargados
+        y resync() rehace el estado en memoria de todos los workers. Los
+        feedback_id que ya existen se saltan sin abortar la carga.
+        
+        Con offline=True además se quitan los índices secundarios durante la
+        carga (se recrean al final). Solo con el servidor parado: sin ellos
+        las consultas concurrentes recorrerían las tablas enteras.
+        """
+        if offline and self.writer is not None:
+            raise ValueError("La restauración offline no puede hacerse a través del proceso escritor")
+        inicio = datetime.now()
+        stats = {"insertados": 0, "duplicados": 0}
+        cargas: Dict[str, Dict[str, Any]] = {}
+        
+        def restaurar(registros: List[Dict[str, Any]]):
+            if offline:
+                parcial = self._restore_batch(registros, cargas, quitar_indices=True)
+            else:
+                parcial = self.restore_batch(registros)
+                for ruta, fechas in parcial.pop("fechas").items():
+                    cargas.setdefault(ruta, {"indices": [], "fechas": set()})["fechas"].update(fechas)
+            for clave in stats:
+                stats[clave] += parcial[clave]
+        
+        try:
+            with open(filepath, encoding='utf-8') as f:
+                registros = []
+                for registro in _iter_json_records(f):
+                    registros.append(registro)
+                    if len(registros) >= lote:
+                        restaurar(registros)
+                        registros = []
+                if registros:
+                    restaurar(registros)
+        finally:
+            # Índices y agregados se rehacen aunque la carga se interrumpa
+            if cargas:
+                self.finish_restore({ruta: {"indices": carga["indices"], "fechas": sorted(carga["fechas"])}
+                                     for ruta, carga in cargas.items()})
+        
+        segundos = (datetime.now() - inicio).total_seconds()
+        logger.info(f"📥 Restaurados {stats['insertados']} feedback desde {filepath} "
+                    f"({stats['duplicados']} ya existían, {segundos:.1f} s)")
+        return stats
+    
+    def restore_batch(self, registros: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Insertar un lote de registros exportados (devuelve las fechas cargadas de cada fichero)"""
+        if self.writer is not None:
+            return self.writer.run("restore_batch", registros)
+        cargas: Dict[str, Dict[str, Any]] = {}
+        stats = self._restore_batch(registros, cargas)
+        stats["fechas"] = {ruta: sorted(carga["fechas"]) for ruta, carga in cargas.items()}
+        return stats
+    
+    def finish_restore(self, cargas: Dict[str, Dict[str, Any]]):
+        """Recalcular lo que la restauración deja pendiente y avisar a los workers"""
+        if self.writer is not None:
+            return self.writer.run("finish_restore", cargas)
+        for ruta, carga in cargas.items():
+            self._finish_bulk_load(ruta, carga)
+        self.resync()
+    
+    def _restore_batch(self, registros: List[Dict[str, Any]], cargas: Dict[str, Dict[str, Any]],
+                       quitar_indices: bool = False) -> Dict[str, int]:
+        """Repartir un lote por ficheros e insertarlo (una transacción por fichero)"""
+        stats = {"insertados": 0, "duplicados": 0}
+        por_fichero: Dict[str, List[Dict[str, Any]]] = {}
+        for registro in registros:
+            registro['timestamp'] = registro.get('timestamp') or datetime.now().isoformat()
+            por_fichero.setdefault(self._partition_for(registro['timestamp']), []).append(registro)
+        for ruta, registros_fichero in por_fichero.items():
+            self._bulk_insert(ruta, registros_fichero, cargas, stats, quitar_indices)
+        return stats
+    
+    def _bulk_insert(self, ruta: str, registros: List[Dict[str, Any]],
+                     cargas: Dict[str, Dict[str, Any]], stats: Dict[str, int],
+                     quitar_indices: bool = False):
+        """Insertar un lote de registros exportados en un fichero (una transacción)"""
+        try:
+            with self.get_connection(ruta) as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                version = self._schema_version(cursor)
             
-            cursor.execute("SELECT * FROM feedback ORDER BY timestamp DESC")
+                carga = cargas.get(ruta)
+                if carga is None:
+                    indices = []
+                    if quitar_indices:
+                        # Primera vez: quitar los índices secundarios (se recrean al final)
+                        cursor.execute("""
+                            SELECT name, sql FROM sqlite_master
+                            WHERE type = 'index' AND sql IS NOT NULL
+                              AND tbl_name IN ('feedback', 'entidades', 'etiquetas')
+                        """)
+                        indices = [(row['name'], row['sql']) for row in cursor.fetchall()]
+                        for nombre, _ in indices:
+                            cursor.execute(f"DROP INDEX {nombre}")
+                    carga = cargas[ruta] = {"indices": indices, "fechas": set()}
             
-            data = []
-            for row in cursor.fetchall():
-                feedback_dict = dict(row)
-                
-                # Obtener entidades asociadas
-                cursor.execute("""
-                    SELECT nombre, tipo, relevancia 
-                    FROM entidades 
-                    WHERE feedback_id = ?
-                """, (feedback_dict['feedback_id'],))
+                # feedback_id ya presentes (en este fichero, en su archivo o en el lote)
+                existentes = self._existing_ids(cursor, ruta, [r.get('feedback_id') for r in registros])
+                feedback, entidades, etiquetas = [], [], []
+                for registro in registros:
+                    feedback_id = registro.get('feedback_id') or str(uuid.uuid4())
+                    if feedback_id in existentes:
+                        stats['duplicados'] += 1
+                        continue
+                    existentes.add(feedback_id)
                 
-                feedback_dict['entidades'] = [dict(e) for e in cursor.fetchall()]
-                data.append(feedback_dict)
+                    fila, sentimiento_id = self._bulk_row(cursor, ruta, registro, feedback_id, version)
+                    feedback.append(fila)
+                    carga["fechas"].add(registro['timestamp'][:10])
+                    for entidad in registro.get('entidades') or []:
+                        if version < 2:
+                            entidades.append((feedback_id, entidad.get('nombre'), entidad.get('tipo'),
+                                              entidad.get('relevancia', 0)))
+                        else:
+                            entidades.append((feedback_id,
+                                              self._intern(cursor, ruta, "entidad", entidad.get('nombre')),
+                                              self._intern(cursor, ruta, "entidad_tipo", entidad.get('tipo')),
+                                              entidad.get('relevancia', 0)))
+                    if version >= 3:
+                        for objeto in registro.get('_objetos') or []:
+                            etiquetas.append((feedback_id,
+                                              self._intern(cursor, ruta, "etiqueta", objeto.get('nombre')),
+                                              sentimiento_id, objeto.get('confianza')))
             
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+                if feedback:
+                    columnas = list(feedback[0])
+                    cursor.executemany(f"""
+                        INSERT INTO feedback ({", ".join(columnas)})
+                        VALUES ({", ".join("?" * len(columnas))})
+                    """, [tuple(fila.values()) for fila in feedback])
+                    nombre, tipo = ("nombre", "tipo") if version < 2 else ("nombre_id", "tipo_id")
+                    cursor.executemany(f"""
+                        INSERT INTO entidades (feedback_id, {nombre}, {tipo}, relevancia)
+                        VALUES (?, ?, ?, ?)
+                    """, entidades)
+                    cursor.executemany("""
+                        INSERT INTO etiquetas (feedback_id, etiqueta_id, sentimiento_id, confianza)
+                        VALUES (?, ?, ?, ?)
+                    """, etiquetas)
+                stats['insertados'] += len(feedback)
+        except Exception:
+            # Los ids internados en la transacción deshecha ya no son válidos
+            self._forget_values(ruta)
+            raise
+    
+    def _existing_ids(self, cursor, ruta: str, ids: List[Optional[str]]) -> set:
+        ids = [i for i in ids if i]
+        archivo = os.path.join(self.archive_dir, os.path.basename(ruta))
+        existentes = set()
+        for i in range(0, len(ids), 900):
+            trozo = ids[i:i + 900]
+            marcas = ", ".join("?" * len(trozo))
+            cursor.execute(f"SELECT feedback_id FROM feedback WHERE feedback_id IN ({marcas})", trozo)
+            existentes.update(row[0] for row in cursor.fetchall())
+            if self.partitioned and os.path.exists(archivo):
+                with self.get_connection(archivo) as conn:
+                    existentes.update(row[0] for row in conn.execute(
+                        f"SELECT feedback_id FROM feedback WHERE feedback_id IN ({marcas})", trozo))
+        return existentes
+    
+    def _bulk_row(self, cursor, ruta: str, registro: Dict[str, Any], feedback_id: str, version: int):
+        """Fila de feedback (dict columna -> valor) de un registro exportado"""
+        metadata = registro.get('metadata') or {}
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        # Datos de imagen: columnas en la exportación v3, dentro de metadata antes
+        for campo in ("rostros", "audio_confianza", "objetos"):
+            if registro.get(campo) is not None:
+                metadata[campo] = registro[campo]
+        
+        sentimiento = registro.get('sentimiento', 'neutral')
+        fila = {
+            "feedback_id": feedback_id, "score": registro.get('score', 0.0),
+            "magnitude": registro.get('magnitude'),
+            "texto_muestra": (registro.get('texto_muestra') or registro.get('texto') or "")[:500],
+            "timestamp": registro['timestamp'], "es_duplicado": 1 if registro.get('es_duplicado') else 0
+        }
+        sentimiento_id = None
+        if version < 2:
+            fila.update(tipo=registro.get('tipo', 'texto'), sentimiento=sentimiento,
+                        categoria=registro.get('categoria', 'General'))
+        else:
+            sentimiento_id = self._intern(cursor, ruta, "sentimiento", sentimiento)
+            fila.update(tipo_id=self._intern(cursor, ruta, "tipo", registro.get('tipo', 'texto')),
+                        sentimiento_id=sentimiento_id,
+                        categoria_id=self._intern(cursor, ruta, "categoria", registro.get('categoria', 'General')))
+        if version >= 3:
+            fila.update(rostros=metadata.pop("rostros", None),
+                        audio_confianza=metadata.pop("audio_confianza", None))
+            registro['_objetos'] = metadata.pop("objetos", None)
+        fila["metadata"] = json.dumps(metadata)
+        return fila, sentimiento_id
+    
+    def _finish_bulk_load(self, ruta: str, carga: Dict[str, Any]):
+        """Recrear los índices y recalcular las estadísticas de los días cargados"""
+        with self.get_connection(ruta) as conn:
+            cursor = conn.cursor()
+            for _, sql in carga["indices"]:
+                cursor.execute(sql.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1))
             
-            print(f"📁 Datos exportados a {filepath}")
-            return filepath
+            columnas, decode = self.column_map(conn, ruta)
+            fechas = sorted(carga["fechas"])
+            for i in range(0, len(fechas), 900):
+                trozo = fechas[i:i + 900]
+                cursor.execute(f"""
+                    SELECT substr(timestamp, 1, 10) as fecha, {columnas['sentimiento']} as sentimiento,
+                           COUNT(*) as n, SUM(score) as score_suma
+                    FROM feedback
+                    WHERE substr(timestamp, 1, 10) IN ({", ".join("?" * len(trozo))})
+                    GROUP BY 1, 2
+                """, trozo)
+                dias: Dict[str, Dict[str, float]] = {}
+                for row in cursor.fetchall():
+                    dia = dias.setdefault(row['fecha'], {"total": 0, "positivo": 0, "negativo": 0,
+                                                         "neutral": 0, "score": 0.0})
+                    dia["total"] += row['n']
+                    dia["score"] += row['score_suma'] or 0
+                    sentimiento = decode(row['sentimiento'])
+                    if sentimiento in dia:
+                        dia[sentimiento] += row['n']
+                cursor.executemany("""
+                    INSERT INTO estadisticas_diarias
+                    (fecha, total_feedback, positivos, negativos, neutrales, score_promedio, last_updated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(fecha) DO UPDATE SET
+                        total_feedback = excluded.total_feedback, positivos = excluded.positivos,
+                        negativos = excluded.negativos, neutrales = excluded.neutrales,
+                        score_promedio = excluded.score_promedio, last_updated = excluded.last_updated
+                """, [(fecha, d["total"], d["positivo"], d["negativo"], d["neutral"],
+                       d["score"] / d["total"], datetime.now().isoformat()) for fecha, d in dias.items()])
+            cursor.execute("ANALYZE")
+
+
+def _iter_json_records(f, bloque: int = 1 << 20):
+    """Registros de un array JSON o de un fichero JSON lines, sin cargarlo entero"""
+    decoder = json.JSONDecoder()
+    maximo = IMPORT_JSON_MAX_RECORD_MB * (1 << 20)
+    buffer = f.read(bloque)
+    pos = len(buffer) - len(buffer.lstrip())
+    if buffer[pos:pos + 1] != "[":
+        # JSON lines: un registro por línea
+        f.seek(0)
+        for linea in f:
+            if linea.strip():
+                yield json.loads(linea)
+        return
+    
+    pos += 1
+    while True:
+        # Saltar separadores hasta el siguiente registro o el cierre
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer):
+                break
+            trozo = f.read(bloque)
+            if not trozo:
+                return
+            buffer, pos = trozo, 0
+        if buffer[pos] == "]":
+            return
+        try:
+            registro, fin = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            pendiente = len(buffer) - pos
+            if pendiente > maximo:
+                raise ValueError(f"Registro JSON mal formado o mayor de {IMPORT_JSON_MAX_RECORD_MB:g} MB")
+            # Se lee al menos lo que ya hay pendiente: el registro se vuelve
+            # a decodificar O(log n) veces, no una por bloque
+            trozo = f.read(max(bloque, pendiente))
+            if not trozo:
+                raise
+            buffer, pos = buffer[pos:] + trozo, 0
+            continue
+        yield registro
+        pos = fin
 
 
 # Función helper para inicializar la base de datos
@@ -433,10 +1833,26 @@ def get_database(db_path: str = "feedback_analytics.db") -> FeedbackDatabase:
 
 
 if __name__ == "__main__":
-    # Prueba de la base de datos
-    db = FeedbackDatabase("test_feedback.db")
-    print("✅ Base de datos de prueba creada")
-    
-    # Obtener estadísticas (debería estar vacía)
-    stats = db.get_statistics()
-    print(f"📊 Estadísticas iniciales: {stats}")
\ No newline at end of file
+    import argparse
+
+    import logs
+    from writer import get_writer
+
+    logs.setup()
+    parser = argparse.ArgumentParser(description="Exportar o restaurar el feedback en JSON")
+    parser.add_argument("accion", choices=["export", "import"])
+    parser.add_argument("fichero", nargs="?", default="feedback_export.json")
+    parser.add_argument("--lote", type=int, default=5000,
+                        help="Registros por transacción al restaurar")
+    parser.add_argument("--offline", action="store_true",
+                        help="Quitar los índices durante la restauración (solo con el servidor parado)")
+    args = parser.parse_args()
+
+    db = FeedbackDatabase("feedback_analytics.db")
+    if not args.offline:
+        # Con el proceso escritor activo, la restauración escribe a través de él
+        db.writer = get_writer()
+    if args.accion == "export":
+        db.export_to_json(args.fichero)
+    else:
+        db.import_from_json(args.fichero, lote=args.lote, offline=args.offline)
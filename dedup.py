@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Detección de feedback casi duplicado con MinHash + LSH
+
+Cada texto se normaliza (minúsculas, sin tildes ni puntuación) y se parte
+en shingles de 4 caracteres. Su firma MinHash de 64 valores estima la
+similitud de Jaccard entre dos textos. Para no comparar contra todo el
+histórico, la firma se divide en 16 bandas de 4 valores (LSH): solo se
+verifican los textos que coinciden en alguna banda completa.
+"""
+import os
+import re
+import unicodedata
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# Similitud de Jaccard (estimada) a partir de la cual se considera duplicado
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.7"))
+
+_SHINGLE = 4
+_PERMUTACIONES = 64
+_BANDAS = 16
+_FILAS = _PERMUTACIONES // _BANDAS
+
+# Familia de hashes (a·x + b) >> 32 con semilla fija: las firmas guardadas
+# en SQLite siguen siendo válidas entre reinicios
+_rng = np.random.default_rng(20240601)
+_A = _rng.integers(1, 2 ** 63, size=_PERMUTACIONES, dtype=np.uint64) | np.uint64(1)
+_B = _rng.integers(0, 2 ** 63, size=_PERMUTACIONES, dtype=np.uint64)
+
+_RE_PALABRA = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_text(texto: str) -> str:
+    """Minúsculas, sin tildes ni puntuación y con espacios simples"""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return " ".join(_RE_PALABRA.findall(texto))
+
+
+def minhash(texto: str) -> Optional[np.ndarray]:
+    """Calcular la firma MinHash (uint32) de un texto; None si está vacío"""
+    normalizado = normalize_text(texto)
+    if not normalizado:
+        return None
+
+    n = max(1, len(normalizado) - _SHINGLE + 1)
+    shingles = {normalizado[i:i + _SHINGLE] for i in range(n)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles),
+                         dtype=np.uint64, count=len(shingles))
+
+    # (n_shingles, 64): cada columna es una permutación distinta
+    with np.errstate(over="ignore"):
+        permutados = (hashes[:, None] * _A[None, :] + _B[None, :]) >> np.uint64(32)
+    return permutados.min(axis=0).astype(np.uint32)
+
+
+class MinHashIndex:
+    """Índice LSH en memoria de firmas MinHash"""
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self._bandas: List[Dict[bytes, List[str]]] = [{} for _ in range(_BANDAS)]
+        self._firmas: Dict[str, bytes] = {}
+
+    def __len__(self):
+        return len(self._firmas)
+
+    @staticmethod
+    def _claves(firma: np.ndarray) -> List[bytes]:
+        """Clave de cada banda (los bytes de sus 4 valores)"""
+        crudo = firma.tobytes()
+        ancho = _FILAS * 4
+        return [crudo[i * ancho:(i + 1) * ancho] for i in range(_BANDAS)]
+
+    def add(self, firma: np.ndarray, feedback_id: str):
+        """Añadir una firma al índice"""
+        self._firmas[feedback_id] = firma.tobytes()
+        for banda, clave in zip(self._bandas, self._claves(firma)):
+            banda.setdefault(clave, []).append(feedback_id)
+
+    def find(self, firma: np.ndarray) -> Optional[Tuple[str, float]]:
+        """Buscar el feedback más parecido; devuelve (feedback_id, similitud) o None"""
+        candidatos = set()
+        for banda, clave in zip(self._bandas, self._claves(firma)):
+            candidatos.update(banda.get(clave, ()))
+
+        mejor = None
+        for feedback_id in candidatos:
+            otra = np.frombuffer(self._firmas[feedback_id], dtype=np.uint32)
+            similitud = float(np.count_nonzero(otra == firma)) / _PERMUTACIONES
+            if similitud >= self.threshold and (mejor is None or similitud > mejor[1]):
+                mejor = (feedback_id, similitud)
+        return mejor
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Pub/sub en proceso para el feed en vivo de feedback (Server-Sent Events)
+
+FeedbackDatabase avisa de cada feedback guardado a sus listeners; el
+FeedbackBroker es uno de ellos y reparte un resumen del feedback y los
+deltas de estadísticas a todos los clientes conectados. Los totales se
+mantienen en memoria de forma incremental, así que un panel conectado no
+genera ninguna consulta a SQLite.
+
+Cada cliente tiene un buffer acotado: si no consume a tiempo y el buffer
+se llena, se le desconecta (el EventSource del navegador reconecta solo y
+recibe de nuevo la instantánea). Tras un resync (p. ej. al borrar datos
+antiguos) se envía una instantánea nueva a todos los clientes.
+"""
+import asyncio
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+
+STREAM_CLIENT_BUFFER = int(os.getenv("STREAM_CLIENT_BUFFER", "100"))
+STREAM_MAX_CLIENTS = int(os.getenv("STREAM_MAX_CLIENTS", "1000"))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+
+# Marca que se encola para cerrar la conexión de un cliente lento
+_DESCONECTAR = object()
+# Marca que se encola tras un resync para reenviar la instantánea
+_RESINCRONIZAR = object()
+
+
+class Subscriber:
+    """Cliente conectado al feed con su cola acotada"""
+
+    def __init__(self, buffer: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=buffer)
+        self.dropped = False
+
+
+class FeedbackBroker:
+    """Reparte los eventos de feedback nuevo entre los clientes conectados"""
+
+    def __init__(self, db, buffer: int = STREAM_CLIENT_BUFFER,
+                 max_clients: int = STREAM_MAX_CLIENTS):
+        self.db = db
+        self.buffer = buffer
+        self.max_clients = max_clients
+        self._subscribers = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._totales: Optional[Dict[str, Any]] = None
+        self.descartados = 0
+
+    # ---------- Totales incrementales ----------
+
+    def _load_totals(self):
+        """Cargar los totales una sola vez desde la base de datos"""
+        stats = self.db.get_statistics()
+        self._totales = {
+            "total": stats["total"],
+            "sentimientos": {
+                "positivo": stats["positivos"],
+                "negativo": stats["negativos"],
+                "neutral": stats["neutrales"],
+            },
+            "categorias": self.db.get_categories(),
+            "tipos": self.db.get_stats_by_type(),
+            "score_suma": stats["score_promedio"] * stats["total"],
+        }
+
+    def reset(self):
+        """Descartar los totales en memoria y reenviar la instantánea a los clientes"""
+        with self._lock:
+            self._totales = None
+        self._publish(_RESINCRONIZAR)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Totales actuales (desde memoria)"""
+        with self._lock:
+            if self._totales is None:
+                self._load_totals()
+            t = self._totales
+            return {
+                "seq": self._seq,
+                "total": t["total"],
+                "sentimientos": dict(t["sentimientos"]),
+                "categorias": dict(t["categorias"]),
+                "tipos": dict(t["tipos"]),
+                "score_promedio": round(t["score_suma"] / t["total"], 2) if t["total"] else 0,
+            }
+
+    # ---------- Publicación ----------
+
+    def on_feedback(self, resumen: Dict[str, Any]):
+        """Listener de FeedbackDatabase: se llama tras guardar cada feedback"""
+        with self._lock:
+            self._seq += 1
+            delta = {
+                "total": 1,
+                "sentimiento": resumen["sentimiento"],
+                "categoria": resumen.get("categoria"),
+                "tipo": resumen["tipo"],
+                "score": resumen["score"],
+            }
+            if self._totales is not None:
+                t = self._totales
+                t["total"] += 1
+                t["sentimientos"][delta["sentimiento"]] = t["sentimientos"].get(delta["sentimiento"], 0) + 1
+                if delta["categoria"]:
+                    t["categorias"][delta["categoria"]] = t["categorias"].get(delta["categoria"], 0) + 1
+                t["tipos"][delta["tipo"]] = t["tipos"].get(delta["tipo"], 0) + 1
+                t["score_suma"] += delta["score"] or 0
+            evento = {"seq": self._seq, "feedback": resumen, "delta": delta}
+        self._publish(evento)
+
+    def _publish(self, evento):
+        """Repartir un evento desde cualquier hilo"""
+        if not self._subscribers or self._loop is None:
+            return
+
+        # add_feedback puede ejecutarse fuera del hilo del event loop
+        try:
+            en_el_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            en_el_loop = False
+        if en_el_loop:
+            self._dispatch(evento)
+        else:
+            self._loop.call_soon_threadsafe(self._dispatch, evento)
+
+    def _dispatch(self, evento: Dict[str, Any]):
+        """Encolar el evento a cada cliente; desconectar a los que no dan abasto"""
+        for sub in list(self._subscribers):
+            if sub.dropped:
+                continue
+            try:
+                sub.queue.put_nowait(evento)
+            except asyncio.QueueFull:
+                sub.dropped = True
+                self.descartados += 1
+                # Hacer sitio para la marca de desconexión
+                sub.queue.get_nowait()
+                sub.queue.put_nowait(_DESCONECTAR)
+
+    # ---------- Suscripción ----------
+
+    def subscribe(self) -> Optional[Subscriber]:
+        """Registrar un cliente; None si se ha alcanzado el máximo"""
+        if len(self._subscribers) >= self.max_clients:
+            return None
+        self._loop = asyncio.get_running_loop()
+        sub = Subscriber(self.buffer)
+        self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        self._subscribers.discard(sub)
+
+    @property
+    def clientes(self) -> int:
+        return len(self._subscribers)
+
+    async def stream(self, sub: Subscriber, request=None):
+        """Generador de eventos SSE para un cliente"""
+        try:
+            # El cliente se registra antes de tomar la instantánea para no
+            # perder eventos; los que ya cuenta la instantánea se saltan
+            instantanea = self.snapshot()
+            yield _sse("snapshot", instantanea)
+            while True:
+                try:
+                    evento = await asyncio.wait_for(sub.queue.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if request is not None and await request.is_disconnected():
+                        break
+                    yield ": heartbeat\n\n"
+                    continue
+
+                if evento is _DESCONECTAR:
+                    yield _sse("dropped", {"motivo": "cliente lento"})
+                    break
+                if evento is _RESINCRONIZAR:
+                    # Datos borrados o recargados: los deltas ya no cuadran
+                    instantanea = self.snapshot()
+                    yield _sse("snapshot", instantanea)
+                    continue
+                if evento["seq"] <= instantanea["seq"]:
+                    continue
+                yield _sse("feedback", evento, evento["seq"])
+        finally:
+            self.unsubscribe(sub)
+
+
+def _sse(evento: str, datos: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    """Formatear un mensaje Server-Sent Events"""
+    linea_id = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{linea_id}event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Clientes de Google Cloud con inicialización perezosa
+
+Los SDK de Google (y sus canales gRPC) solo se importan y se crean la
+primera vez que se usan, así el servidor arranca rápido y la app puede
+importarse aunque no haya credenciales configuradas.
+"""
+import importlib
+import importlib.util
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Módulos de los SDK (se importan bajo demanda)
+_MODULOS = {
+    "language": "google.cloud.language_v1",
+    "speech": "google.cloud.speech_v1",
+    "vision": "google.cloud.vision",
+}
+
+# Constructores de cada cliente a partir de su módulo
+_CLIENTES: Dict[str, Callable[[Any], Any]] = {
+    "language": lambda mod: mod.LanguageServiceClient(),
+    "speech": lambda mod: mod.SpeechClient(),
+    "vision": lambda mod: mod.ImageAnnotatorClient(),
+}
+
+_modulos_cargados: Dict[str, Any] = {}
+_clientes_creados: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+# Tiempos de importación y creación (ms) para el informe de arranque
+_tiempos: Dict[str, Dict[str, float]] = {}
+
+
+def _registrar_tiempo(nombre: str, fase: str, inicio: float):
+    """Guardar la duración de una fase de inicialización"""
+    _tiempos.setdefault(nombre, {})[fase] = round((time.perf_counter() - inicio) * 1000, 1)
+
+
+def get_module(nombre: str):
+    """Obtener el módulo del SDK indicado, importándolo la primera vez"""
+    modulo = _modulos_cargados.get(nombre)
+    if modulo is not None:
+        return modulo
+
+    with _lock:
+        modulo = _modulos_cargados.get(nombre)
+        if modulo is None:
+            inicio = time.perf_counter()
+            modulo = importlib.import_module(_MODULOS[nombre])
+            _registrar_tiempo(nombre, "import_ms", inicio)
+            _modulos_cargados[nombre] = modulo
+    return modulo
+
+
+def get_client(nombre: str):
+    """Obtener el cliente indicado, creándolo la primera vez"""
+    cliente = _clientes_creados.get(nombre)
+    if cliente is not None:
+        return cliente
+
+    modulo = get_module(nombre)
+    with _lock:
+        cliente = _clientes_creados.get(nombre)
+        if cliente is None:
+            inicio = time.perf_counter()
+            cliente = _CLIENTES[nombre](modulo)
+            _registrar_tiempo(nombre, "cliente_ms", inicio)
+            _clientes_creados[nombre] = cliente
+    return cliente
+
+
+def language_module():
+    """Módulo google.cloud.language_v1"""
+    return get_module("language")
+
+
+def speech_module():
+    """Módulo google.cloud.speech_v1"""
+    return get_module("speech")
+
+
+def vision_module():
+    """Módulo google.cloud.vision"""
+    return get_module("vision")
+
+
+def get_language_client():
+    """Cliente de Natural Language API"""
+    return get_client("language")
+
+
+def get_speech_client():
+    """Cliente de Speech-to-Text API"""
+    return get_client("speech")
+
+
+def get_vision_client():
+    """Cliente de Vision API"""
+    return get_client("vision")
+
+
+def dialogflow_available() -> bool:
+    """Comprobar si el SDK de Dialogflow está instalado sin importarlo"""
+    try:
+        return importlib.util.find_spec("google.cloud.dialogflow") is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def warmup(nombres: Optional[list] = None) -> Dict[str, str]:
+    """
+    Crear por adelantado los clientes (y sus canales gRPC)
+
+    Pensado para ejecutarse en segundo plano cuando el servidor ya acepta
+    tráfico. Los errores (p. ej. sin credenciales) no se propagan: el
+    cliente se volverá a intentar crear en la primera petición real.
+    """
+    resultado = {}
+    for nombre in nombres or list(_CLIENTES):
+        try:
+            get_client(nombre)
+            resultado[nombre] = "ok"
+        except Exception as e:
+            resultado[nombre] = f"error: {e}"
+    logger.info(f"🔥 Warm-up de clientes Google: {resultado}")
+    return resultado
+
+
+def warmup_enabled() -> bool:
+    """El warm-up se activa con GOOGLE_CLIENTS_WARMUP=1"""
+    return os.getenv("GOOGLE_CLIENTS_WARMUP", "0").lower() in ("1", "true", "yes")
+
+
+def startup_report() -> Dict[str, Any]:
+    """Informe de tiempos de importación y creación de clientes"""
+    return {
+        nombre: {
+            "importado": nombre in _modulos_cargados,
+            "cliente_creado": nombre in _clientes_creados,
+            **_tiempos.get(nombre, {}),
+        }
+        for nombre in _MODULOS
+    }
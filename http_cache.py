@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+GET condicional (ETag / 304) para los endpoints de estadísticas y listados
+
+El ETag se calcula a partir de la versión de escritura de la base de datos
+(sin ejecutar SQL) y de la URL pedida. Si coincide con If-None-Match se
+responde 304 directamente, sin consultar SQLite ni serializar nada.
+"""
+import hashlib
+import os
+from typing import Any, Callable
+
+from fastapi.responses import JSONResponse, Response
+from starlette.requests import Request
+
+
+# Cache-Control de las respuestas cacheables. Con "no-cache" el navegador o
+# proxy revalida siempre (barato gracias al 304); p. ej. "public, max-age=5"
+# permite además absorber el polling de los paneles sin llegar al servidor.
+STATS_CACHE_CONTROL = os.getenv("STATS_CACHE_CONTROL", "no-cache")
+
+
+def make_etag(version: str, request: Request) -> str:
+    """ETag fuerte para la versión de datos y la representación pedida"""
+    query = "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+    clave = f"{version}|{request.url.path}?{query}"
+    return '"' + hashlib.sha1(clave.encode("utf-8")).hexdigest()[:20] + '"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Comparar If-None-Match con el ETag (comparación débil, RFC 9110)"""
+    if if_none_match.strip() == "*":
+        return True
+    for candidato in if_none_match.split(","):
+        candidato = candidato.strip()
+        if candidato.startswith("W/"):
+            candidato = candidato[2:]
+        if candidato == etag:
+            return True
+    return False
+
+
+def conditional_json(request: Request, version: str, builder: Callable[[], Any],
+                     cache_control: str = STATS_CACHE_CONTROL) -> Response:
+    """Responder 304 si el cliente ya tiene esta versión; si no, construir el JSON"""
+    etag = make_etag(version, request)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse(content=builder(), headers=headers)
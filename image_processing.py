@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Preprocesado de imágenes antes de enviarlas a Vision API
+
+La subida se vuelca a un fichero temporal por bloques (sin cargarla entera
+en memoria), se valida el formato por sus bytes mágicos y se reduce a un
+tamaño máximo configurable, quitando los metadatos EXIF y recodificando en
+JPEG. Para detectar rostros, etiquetas y texto Vision no necesita más
+resolución, y así se reducen los bytes subidos y la latencia. Las imágenes
+que ya caben en ese tamaño se envían sin recodificar (solo sin metadatos)
+cuando así ocupan menos.
+
+summarize_annotation interpreta la respuesta de Vision igual para la API
+web y para la importación masiva (importer.py).
+"""
+import io
+import os
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+
+# Configuración (variables de entorno)
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1600"))  # px del lado mayor
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_MAX_UPLOAD_MB = int(os.getenv("IMAGE_MAX_UPLOAD_MB", "20"))
+
+# Tamaño de bloque al leer la subida y umbral a partir del cual el
+# fichero temporal pasa de memoria a disco
+CHUNK_SIZE = 1024 * 1024
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+# Firmas (bytes mágicos) de los formatos aceptados por Vision
+_FIRMAS = [
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+]
+
+
+# Segmentos JPEG de metadatos que se descartan sin recodificar: APP1 (EXIF,
+# XMP), APP13 (IPTC) y comentarios. Se conservan APP0, el perfil ICC (APP2)
+# y APP14 (Adobe), que afectan a cómo se interpretan los colores.
+_SEGMENTOS_METADATOS = {0xE1, 0xED, 0xFE}
+# Chunks de metadatos de WEBP y sus bits en las banderas de VP8X
+_CHUNKS_WEBP_METADATOS = {b"EXIF": 0x08, b"XMP ": 0x04}
+# Orientación EXIF (1 = sin girar)
+_TAG_ORIENTACION = 0x0112
+
+
+class InvalidImageError(ValueError):
+    """La subida no es una imagen válida o supera el tamaño permitido"""
+
+
+def detect_format(cabecera: bytes) -> Optional[str]:
+    """Detectar el formato de imagen a partir de los primeros bytes"""
+    if cabecera[:4] == b"RIFF" and cabecera[8:12] == b"WEBP":
+        return "WEBP"
+    for firma, formato in _FIRMAS:
+        if cabecera.startswith(firma):
+            return formato
+    return None
+
+
+def strip_metadata(datos: bytes, formato: str) -> Optional[bytes]:
+    """
+    Quitar EXIF/XMP de un JPEG o WEBP sin recodificar la imagen
+
+    Devuelve None si el formato no se admite o la estructura del fichero no
+    es la esperada.
+    """
+    if formato == "JPEG":
+        return _strip_jpeg(datos)
+    if formato == "WEBP":
+        return _strip_webp(datos)
+    return None
+
+
+def _strip_jpeg(datos: bytes) -> Optional[bytes]:
+    if not datos.startswith(b"\xff\xd8"):
+        return None
+    partes = [b"\xff\xd8"]
+    pos = 2
+    while pos + 4 <= len(datos):
+        if datos[pos] != 0xFF:
+            return None
+        marcador = datos[pos + 1]
+        if marcador == 0xFF:
+            # Relleno entre segmentos
+            pos += 1
+            continue
+        if marcador == 0xDA:
+            # Inicio de los datos de imagen: el resto se copia tal cual
+            partes.append(datos[pos:])
+            return b"".join(partes)
+        longitud = int.from_bytes(datos[pos + 2:pos + 4], "big")
+        if longitud < 2 or pos + 2 + longitud > len(datos):
+            return None
+        if marcador not in _SEGMENTOS_METADATOS:
+            partes.append(datos[pos:pos + 2 + longitud])
+        pos += 2 + longitud
+    return None
+
+
+def _strip_webp(datos: bytes) -> Optional[bytes]:
+    if len(datos) < 12 or datos[:4] != b"RIFF" or datos[8:12] != b"WEBP":
+        return None
+    partes = []
+    quitadas = 0
+    pos = 12
+    while pos + 8 <= len(datos):
+        fourcc = datos[pos:pos + 4]
+        longitud = int.from_bytes(datos[pos + 4:pos + 8], "little")
+        fin = pos + 8 + longitud + (longitud & 1)
+        if fin > len(datos) + (longitud & 1):
+            return None
+        if fourcc in _CHUNKS_WEBP_METADATOS:
+            quitadas |= _CHUNKS_WEBP_METADATOS[fourcc]
+        else:
+            partes.append(bytearray(datos[pos:fin]))
+        pos = fin
+    if pos < len(datos) or not partes:
+        return None
+    if partes[0][:4] == b"VP8X":
+        # Las banderas de VP8X no deben anunciar chunks que ya no están
+        partes[0][8] &= ~quitadas & 0xFF
+    cuerpo = b"WEBP" + b"".join(partes)
+    return b"RIFF" + len(cuerpo).to_bytes(4, "little") + cuerpo
+
+
+async def spool_upload(upload, max_bytes: Optional[int] = None):
+    """
+    Copiar una UploadFile a un fichero temporal por bloques
+
+    Devuelve el fichero (posicionado al inicio) y el número de bytes leídos.
+    """
+    limite = max_bytes if max_bytes is not None else IMAGE_MAX_UPLOAD_MB * 1024 * 1024
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    total = 0
+    try:
+        while True:
+            bloque = await upload.read(CHUNK_SIZE)
+            if not bloque:
+                break
+            total += len(bloque)
+            if total > limite:
+                raise InvalidImageError(
+                    f"La imagen supera el tamaño máximo de {limite // (1024 * 1024)} MB"
+                )
+            spool.write(bloque)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, total
+
+
+def prepare_image(fichero, max_side: Optional[int] = None,
+                  quality: Optional[int] = None) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Validar, reducir y recodificar una imagen para Vision
+
+    Devuelve los bytes JPEG resultantes y un diccionario con información
+    del procesado (formato original, dimensiones y bytes antes/después).
+    """
+    max_side = max_side or IMAGE_MAX_SIDE
+    quality = quality or IMAGE_JPEG_QUALITY
+
+    fichero.seek(0, io.SEEK_END)
+    bytes_originales = fichero.tell()
+    fichero.seek(0)
+
+    formato = detect_format(fichero.read(16))
+    if formato is None:
+        raise InvalidImageError("Formato de imagen no soportado. Usa JPG, PNG, GIF, BMP, TIFF o WEBP.")
+    fichero.seek(0)
+
+    try:
+        img = Image.open(fichero)
+        dimensiones_originales = img.size
+        tiene_exif = bool(img.info.get("exif"))
+        orientacion = img.getexif().get(_TAG_ORIENTACION, 1)
+
+        # En JPEG se decodifica directamente a escala reducida (ahorra memoria)
+        if formato == "JPEG":
+            img.draft("RGB", (max_side, max_side))
+
+        # Aplicar la orientación EXIF antes de descartar los metadatos
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        if img.mode not in ("RGB", "L"):
+            fondo = Image.new("RGB", img.size, (255, 255, 255))
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                fondo.paste(img, mask=img.split()[-1])
+            else:
+                fondo.paste(img.convert("RGB"))
+            img = fondo
+
+        salida = io.BytesIO()
+        # Sin parámetro exif: el JPEG resultante no lleva metadatos
+        img.save(salida, format="JPEG", quality=quality, optimize=True)
+    except InvalidImageError:
+        raise
+    except Exception as e:
+        raise InvalidImageError(f"No se pudo procesar la imagen: {e}")
+
+    contenido = salida.getvalue()
+
+    # Si no había que reducir, recodificar puede dar un fichero mayor que el
+    # original: se envía el original (sin metadatos) si ocupa menos. Con EXIF
+    # solo se puede en JPEG/WEBP sin girar, quitando los metadatos sin
+    # recodificar.
+    if img.size == dimensiones_originales:
+        fichero.seek(0)
+        original = fichero.read()
+        if not tiene_exif:
+            candidato = original
+        elif orientacion == 1:
+            candidato = strip_metadata(original, formato)
+        else:
+            candidato = None
+        if candidato is not None and len(candidato) <= len(contenido):
+            contenido = candidato
+
+    return contenido, {
+        "formato_original": formato,
+        "dimensiones_originales": list(dimensiones_originales),
+        "dimensiones": list(img.size),
+        "bytes_originales": bytes_originales,
+        "bytes_enviados": len(contenido),
+    }
+
+
+def vision_features(vision) -> List[Dict[str, Any]]:
+    """Detecciones que se piden a Vision para cada imagen"""
+    return [
+        {"type_": vision.Feature.Type.FACE_DETECTION},
+        {"type_": vision.Feature.Type.LABEL_DETECTION, "max_results": 10},
+        {"type_": vision.Feature.Type.TEXT_DETECTION},
+    ]
+
+
+def summarize_annotation(annotation, vision) -> Dict[str, Any]:
+    """Caras (hasta 3) con sus emociones, etiquetas, texto y sentimiento visual"""
+    likelihood_map = {
+        vision.Likelihood.VERY_UNLIKELY: 0.1,
+        vision.Likelihood.UNLIKELY: 0.3,
+        vision.Likelihood.POSSIBLE: 0.5,
+        vision.Likelihood.LIKELY: 0.7,
+        vision.Likelihood.VERY_LIKELY: 0.9
+    }
+
+    caras_info = []
+    for face in annotation.face_annotations[:3]:
+        emociones = {
+            "alegria": likelihood_map.get(face.joy_likelihood, 0),
+            "tristeza": likelihood_map.get(face.sorrow_likelihood, 0),
+            "enojo": likelihood_map.get(face.anger_likelihood, 0),
+            "sorpresa": likelihood_map.get(face.surprise_likelihood, 0)
+        }
+        emocion_dominante = max(emociones.items(), key=lambda x: x[1])
+        caras_info.append({
+            "emociones": emociones,
+            "emocion_principal": emocion_dominante[0]
+        })
+
+    objetos = [
+        {"nombre": label.description, "confianza": round(label.score, 2)}
+        for label in annotation.label_annotations
+    ]
+
+    texts = annotation.text_annotations
+    texto_detectado = texts[0].description if texts else ""
+
+    sentimiento_imagen = "neutral"
+    if caras_info:
+        if caras_info[0]["emocion_principal"] == "alegria":
+            sentimiento_imagen = "positivo"
+        elif caras_info[0]["emocion_principal"] in ["tristeza", "enojo"]:
+            sentimiento_imagen = "negativo"
+
+    return {
+        "caras": caras_info,
+        "rostros": len(annotation.face_annotations),
+        "objetos": objetos,
+        "texto": texto_detectado,
+        "sentimiento": sentimiento_imagen,
+    }
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Importación masiva de fotos y notas de voz (sin pasar por la API web)
+
+Recorre directorios o archivos .zip y analiza su contenido como lo harían
+/api/analyze/image y /api/analyze/audio, pero en bloque:
+
+- Las imágenes se preprocesan igual que en la web y se envían a Vision en
+  lotes de batch_annotate_images (hasta 16 imágenes y
+  IMPORT_VISION_BATCH_MB por petición) en vez de una llamada por imagen.
+- Los audios se normalizan, transcriben y analizan en paralelo
+  (IMPORT_AUDIO_WORKERS hilos) mientras se procesan las imágenes.
+- Todas las llamadas van por el carril masivo del planificador de cuotas.
+  La web conserva su prioridad durante la importación solo si ambos usan
+  el servicio central de cuotas (QUOTA_SERVER_ADDRESS); sin él, cada
+  proceso consume por su cuenta 1/QUOTA_PROCESSES de cada cuota.
+- Los resultados se guardan con FeedbackDatabase.add_feedback_many en
+  transacciones de IMPORT_CHUNK_SIZE feedback.
+
+Cada fichero guardado se anota en un checkpoint (una clave por línea, con
+ruta, fecha de modificación y tamaño): si la importación se interrumpe, al
+relanzarla se saltan los ya importados sin leerlos. El id de cada feedback
+sale del hash del contenido, así que un fichero tocado, movido o renombrado
+(o con el checkpoint perdido) se lee de nuevo pero no se vuelve a analizar
+ni se duplica.
+
+Uso:
+    python importer.py fotos_2024-05-01.zip notas_voz/ [--checkpoint fichero]
+"""
+import argparse
+import hashlib
+import io
+import logging
+import os
+import time
+import uuid
+import zipfile
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+if __name__ == "__main__":
+    # Punto de entrada: el .env se carga antes de importar los módulos que
+    # leen su configuración al importarse
+    load_dotenv()
+
+import audio_processing
+import google_clients
+import image_processing
+import quota
+
+logger = logging.getLogger(__name__)
+
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "200"))
+IMPORT_AUDIO_WORKERS = int(os.getenv("IMPORT_AUDIO_WORKERS", "4"))
+IMPORT_VISION_BATCH_MB = float(os.getenv("IMPORT_VISION_BATCH_MB", "8"))
+
+# Máximo de imágenes por petición síncrona de batch_annotate_images
+VISION_BATCH_MAX = 16
+# Speech-to-Text síncrono solo acepta hasta un minuto de audio
+SPEECH_MAX_SECONDS = 60
+
+_EXTENSIONES = {
+    ".jpg": "imagen", ".jpeg": "imagen", ".png": "imagen", ".gif": "imagen",
+    ".bmp": "imagen", ".tif": "imagen", ".tiff": "imagen",
+    ".wav": "audio",
+}
+
+
+def _fichero(clave: str, nombre: str, tipo: str, fecha: datetime,
+             leer: Callable[[], bytes]) -> Dict[str, Any]:
+    return {"clave": clave, "nombre": nombre, "tipo": tipo,
+            "fecha": fecha.isoformat(), "leer": leer}
+
+
+def iter_media(origen: str) -> Iterator[Dict[str, Any]]:
+    """Ficheros de imagen y audio de un directorio (recursivo) o de un .zip"""
+    if zipfile.is_zipfile(origen):
+        # Se cierra al agotar el generador, al fallar o al cerrarlo (close())
+        with zipfile.ZipFile(origen) as archivo:
+            base = os.path.abspath(origen)
+            for info in archivo.infolist():
+                tipo = _EXTENSIONES.get(os.path.splitext(info.filename)[1].lower())
+                if tipo is None or info.is_dir():
+                    continue
+                yield _fichero(f"{base}!{info.filename}:{info.CRC}:{info.file_size}",
+                               info.filename, tipo, datetime(*info.date_time),
+                               lambda info=info: archivo.read(info))
+        return
+
+    for raiz, _, nombres in os.walk(origen):
+        for nombre in sorted(nombres):
+            tipo = _EXTENSIONES.get(os.path.splitext(nombre)[1].lower())
+            if tipo is None:
+                continue
+            ruta = os.path.abspath(os.path.join(raiz, nombre))
+            st = os.stat(ruta)
+            yield _fichero(f"{ruta}:{st.st_mtime_ns}:{st.st_size}", nombre, tipo,
+                           datetime.fromtimestamp(st.st_mtime),
+                           lambda ruta=ruta: open(ruta, "rb").read())
+
+
+def _feedback_id(contenido: bytes) -> str:
+    """Id determinista a partir del contenido (no de la ruta ni la fecha)"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "sha256:" + hashlib.sha256(contenido).hexdigest()))
+
+
+def _etiqueta(score: float) -> str:
+    if score > 0.25:
+        return "positivo"
+    elif score < -0.25:
+        return "negativo"
+    return "neutral"
+
+
+class BulkImporter:
+    """Importa ficheros de imagen y audio en lotes, con checkpoint"""
+
+    def __init__(self, db, checkpoint: str, chunk_size: int = IMPORT_CHUNK_SIZE,
+                 audio_workers: int = IMPORT_AUDIO_WORKERS,
+                 batch_bytes: int = int(IMPORT_VISION_BATCH_MB * 1024 * 1024)):
+        self.db = db
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        self.audio_workers = audio_workers
+        self.batch_bytes = batch_bytes
+        self.hechos = self._load_checkpoint()
+        self._lote_imagenes: List[Dict[str, Any]] = []
+        self._bytes_lote = 0
+        self._pendientes: List[Dict[str, Any]] = []
+        self.stats = {"importados": 0, "ya_importados": 0, "omitidos": 0, "errores": 0,
+                      "lotes_vision": 0}
+
+    # ---------- Checkpoint ----------
+
+    def _load_checkpoint(self) -> set:
+        if not os.path.exists(self.checkpoint):
+            return set()
+        with open(self.checkpoint, encoding="utf-8") as f:
+            return {linea.rstrip("\n") for linea in f if linea.strip()}
+
+    def _mark_done(self, claves: List[str]):
+        if not claves:
+            return
+        with open(self.checkpoint, "a", encoding="utf-8") as f:
+            f.writelines(clave + "\n" for clave in claves)
+            f.flush()
+            os.fsync(f.fileno())
+        self.hechos.update(claves)
+
+    # ---------- Recorrido ----------
+
+    def run(self, origenes: List[str]) -> Dict[str, int]:
+        inicio = time.perf_counter()
+        audios: deque = deque()
+        with ThreadPoolExecutor(max_workers=self.audio_workers) as pool:
+            for origen in origenes:
+                # closing(): el .zip se cierra también si la importación falla
+                with closing(iter_media(origen)) as ficheros:
+                    for fichero in ficheros:
+                        if fichero["clave"] in self.hechos:
+                            self.stats["ya_importados"] += 1
+                            continue
+                        if fichero["tipo"] == "imagen":
+                            self._add_image(fichero)
+                        else:
+                            # Se lee aquí (los hilos no comparten el .zip) y se
+                            # limita cuántos audios hay en memoria a la vez
+                            contenido = fichero.pop("leer")()
+                            if self._already_imported(fichero, contenido):
+                                continue
+                            audios.append((fichero, pool.submit(self._analyze_audio, fichero, contenido)))
+                            while len(audios) > self.audio_workers * 2:
+                                self._collect_audio(*audios.popleft())
+                        if len(self._pendientes) >= self.chunk_size:
+                            self._write()
+            self._flush_images()
+            while audios:
+                self._collect_audio(*audios.popleft())
+        self._write()
+
+        self.stats["segundos"] = round(time.perf_counter() - inicio, 1)
+        logger.info(f"📦 Importación terminada: {self.stats}")
+        return self.stats
+
+    # ---------- Imágenes (Vision por lotes) ----------
+
+    def _add_image(self, fichero: Dict[str, Any]):
+        original = fichero.pop("leer")()
+        if self._already_imported(fichero, original):
+            return
+        try:
+            contenido, _ = image_processing.prepare_image(io.BytesIO(original))
+        except image_processing.InvalidImageError as e:
+            self._skip(fichero, str(e))
+            return
+        if self._lote_imagenes and self._bytes_lote + len(contenido) > self.batch_bytes:
+            self._flush_images()
+        fichero["contenido"] = contenido
+        self._lote_imagenes.append(fichero)
+        self._bytes_lote += len(contenido)
+        if len(self._lote_imagenes) >= VISION_BATCH_MAX:
+            self._flush_images()
+
+    def _flush_images(self):
+        lote, self._lote_imagenes, self._bytes_lote = self._lote_imagenes, [], 0
+        if not lote:
+            return
+
+        vision = google_clients.vision_module()
+        features = image_processing.vision_features(vision)
+        try:
+            respuesta = quota.call(
+                "vision", google_clients.get_vision_client().batch_annotate_images,
+                requests=[{"image": vision.Image(content=f.pop("contenido")), "features": features}
+                          for f in lote],
+                carril=quota.MASIVO, coste=len(lote))
+        except Exception:
+            self.stats["errores"] += len(lote)
+            logger.exception(f"❌ Lote de {len(lote)} imágenes sin analizar")
+            return
+        self.stats["lotes_vision"] += 1
+
+        for fichero, annotation in zip(lote, respuesta.responses):
+            if annotation.error.message:
+                self.stats["errores"] += 1
+                logger.error(f"❌ {fichero['nombre']}: {annotation.error.message}")
+                continue
+            analisis = image_processing.summarize_annotation(annotation, vision)
+            self._pendientes.append({
+                "clave": fichero["clave"],
+                "id": fichero["id"],
+                "tipo": "imagen",
+                "sentimiento": analisis["sentimiento"],
+                "score": 0,
+                "rostros": analisis["rostros"],
+                "objetos": analisis["objetos"],
+                "timestamp": fichero["fecha"],
+            })
+
+    # ---------- Audio (hilos) ----------
+
+    def _analyze_audio(self, fichero: Dict[str, Any], contenido: bytes) -> Optional[Dict[str, Any]]:
+        """Normalizar, transcribir y analizar un audio (en un hilo del pool)"""
+        pcm, info = audio_processing.normalize_wav(contenido)
+        if info["duracion"] > SPEECH_MAX_SECONDS:
+            raise audio_processing.InvalidAudioError(
+                f"dura {info['duracion']}s (máximo {SPEECH_MAX_SECONDS}s)")
+
+        speech_v1 = google_clients.speech_module()
+        language_v1 = google_clients.language_module()
+        config = speech_v1.RecognitionConfig(
+            encoding=speech_v1.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=info["sample_rate"],
+            audio_channel_count=1,
+            language_code="es-ES",
+            enable_automatic_punctuation=True
+        )
+        response = quota.call("speech", google_clients.get_speech_client().recognize,
+                              config=config, audio=speech_v1.RecognitionAudio(content=pcm),
+                              carril=quota.MASIVO)
+        if not response.results:
+            raise audio_processing.InvalidAudioError("sin voz reconocible")
+
+        transcripcion = " ".join(r.alternatives[0].transcript for r in response.results).strip()
+        confidencias = [r.alternatives[0].confidence for r in response.results]
+        document = language_v1.Document(
+            content=transcripcion,
+            type_=language_v1.Document.Type.PLAIN_TEXT,
+            language="es"
+        )
+        sentiment_response = quota.call(
+            "language", google_clients.get_language_client().analyze_sentiment,
+            request={"document": document}, carril=quota.MASIVO)
+        score = sentiment_response.document_sentiment.score
+
+        return {
+            "clave": fichero["clave"],
+            "id": fichero["id"],
+            "tipo": "audio",
+            "sentimiento": _etiqueta(score),
+            "score": round(score, 2),
+            "texto": transcripcion,
+            "audio_confianza": round(sum(confidencias) / len(confidencias), 2),
+            "timestamp": fichero["fecha"],
+        }
+
+    def _collect_audio(self, fichero: Dict[str, Any], futuro):
+        try:
+            resultado = futuro.result()
+        except audio_processing.InvalidAudioError as e:
+            self._skip(fichero, str(e))
+            return
+        except Exception:
+            self.stats["errores"] += 1
+            logger.exception(f"❌ {fichero['nombre']}")
+            return
+        # La detección de duplicados usa el índice en memoria: en este hilo
+        duplicado = self.db.find_duplicate(resultado["texto"])
+        resultado["duplicado_de"] = duplicado["feedback_id"] if duplicado else None
+        self._pendientes.append(resultado)
+
+    # ---------- Escritura ----------
+
+    def _already_imported(self, fichero: Dict[str, Any], contenido: bytes) -> bool:
+        """Asignar el id del contenido y saltar el fichero si ya está guardado"""
+        fichero["id"] = _feedback_id(contenido)
+        if self.db.get_feedback(fichero["id"]) is None:
+            return False
+        # Mismo contenido ya importado (fichero tocado, movido o sin checkpoint)
+        self.stats["ya_importados"] += 1
+        self._mark_done([fichero["clave"]])
+        return True
+
+    def _skip(self, fichero: Dict[str, Any], motivo: str):
+        """Fichero inválido: no se reintentará en la siguiente ejecución"""
+        self.stats["omitidos"] += 1
+        logger.warning(f"⚠️ {fichero['nombre']} omitido: {motivo}")
+        self._mark_done([fichero["clave"]])
+
+    def _write(self):
+        pendientes, self._pendientes = self._pendientes, []
+        for i in range(0, len(pendientes), self.chunk_size):
+            lote = pendientes[i:i + self.chunk_size]
+            items = []
+            for item in lote:
+                item = dict(item)
+                del item["clave"]
+                items.append(item)
+            try:
+                resultados = self.db.add_feedback_many(items)
+            except Exception:
+                self.stats["errores"] += len(lote)
+                logger.exception(f"❌ Lote de {len(lote)} feedback sin guardar")
+                continue
+
+            hechos = []
+            for original, item, guardado in zip(lote, items, resultados):
+                if guardado:
+                    self.stats["importados"] += 1
+                elif self.db.get_feedback(item["id"]) is not None:
+                    # Importado en una ejecución anterior sin checkpoint
+                    self.stats["ya_importados"] += 1
+                else:
+                    self.stats["errores"] += 1
+                    continue
+                hechos.append(original["clave"])
+            self._mark_done(hechos)
+
+
+if __name__ == "__main__":
+    import logs
+    from database import FeedbackDatabase
+    from writer import get_writer
+
+    logs.setup()
+    parser = argparse.ArgumentParser(description="Importar fotos y notas de voz en bloque")
+    parser.add_argument("origenes", nargs="+", help="Directorios o archivos .zip")
+    parser.add_argument("--checkpoint", default="importacion.checkpoint",
+                        help="Fichero con los ficheros ya importados")
+    parser.add_argument("--chunk", type=int, default=IMPORT_CHUNK_SIZE,
+                        help="Feedback por transacción")
+    parser.add_argument("--audio-workers", type=int, default=IMPORT_AUDIO_WORKERS,
+                        help="Audios analizados en paralelo")
+    args = parser.parse_args()
+
+    db = FeedbackDatabase("feedback_analytics.db")
+    # Con el proceso escritor activo, también la importación escribe a través de él
+    db.writer = get_writer()
+    BulkImporter(db, args.checkpoint, chunk_size=args.chunk,
+                 audio_workers=args.audio_workers).run(args.origenes)
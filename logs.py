@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Logging estructurado (JSON lines) fuera del camino de las peticiones
+
+Los módulos usan logging.getLogger(__name__) como siempre; setup() instala
+en el logger raíz un QueueHandler, de modo que el hilo que registra (el de
+la petición, el escritor de SQLite...) solo encola el registro. La
+escritura en stdout la hace un QueueListener en su propio hilo. Si la cola
+se llena, los registros se descartan (nunca se bloquea) y el siguiente
+registro que entra indica cuántos se perdieron.
+
+- Formato JSON lines (LOG_FORMAT=json) o texto legible (LOG_FORMAT=text).
+- Nivel global (LOG_LEVEL) y por logger (LOG_LEVELS="database=WARNING,quota=DEBUG").
+- Muestreo de los mensajes de éxito muy frecuentes por nombre de evento
+  (LOG_SAMPLE_RATES="feedback_guardado=0.1"); WARNING o superior nunca se
+  muestrea.
+- request_id (cabecera X-Request-ID o uno nuevo por petición) y
+  feedback_id viajan en un contextvar y se añaden a todos los registros,
+  también a los de la base de datos ejecutada en el threadpool.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "feedback_guardado=0.1")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Campos de contexto de la petición en curso (request_id, feedback_id...)
+_contexto: contextvars.ContextVar = contextvars.ContextVar("contexto_log", default={})
+
+# Atributos propios de LogRecord (el resto son campos extra del registro)
+_ATRIBUTOS_RECORD = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _pares(valor: str) -> Dict[str, str]:
+    """'a=1,b=2' -> {'a': '1', 'b': '2'}"""
+    pares = {}
+    for parte in valor.split(","):
+        clave, _, dato = parte.partition("=")
+        if clave.strip() and dato.strip():
+            pares[clave.strip()] = dato.strip()
+    return pares
+
+
+# =====================================================
+# CONTEXTO
+# =====================================================
+
+def bind(**campos) -> contextvars.Token:
+    """Añadir campos (p. ej. feedback_id) a los registros del contexto actual"""
+    return _contexto.set({**_contexto.get(), **campos})
+
+
+def current() -> Dict[str, Any]:
+    """Campos de contexto actuales"""
+    return dict(_contexto.get())
+
+
+class _ContextFilter(logging.Filter):
+    """Copiar los campos de contexto al registro (sin pisar los extra explícitos)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for clave, valor in _contexto.get().items():
+            if not hasattr(record, clave):
+                setattr(record, clave, valor)
+        return True
+
+
+class _SamplingFilter(logging.Filter):
+    """Dejar pasar solo una fracción de los eventos de éxito configurados"""
+
+    def __init__(self, tasas: Dict[str, float]):
+        super().__init__()
+        self.tasas = tasas
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        tasa = self.tasas.get(getattr(record, "evento", None))
+        return tasa is None or random.random() < tasa
+
+
+# =====================================================
+# COLA Y FORMATO
+# =====================================================
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que descarta (y cuenta) en lugar de bloquear con la cola llena"""
+
+    def __init__(self, cola: queue.Queue):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Solo se resuelve el mensaje y la traza (el formato final, en el listener)
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if self.descartados:
+            record.descartados, self.descartados = self.descartados, 0
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por línea con el mensaje, el contexto y los campos extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        datos = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for clave, valor in vars(record).items():
+            if clave not in _ATRIBUTOS_RECORD and not clave.startswith("_"):
+                datos[clave] = valor
+        if record.exc_text:
+            datos["exc"] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formato legible para desarrollo, con los campos de contexto al final"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        linea = super().format(record)
+        extra = " ".join(f"{clave}={valor}" for clave, valor in vars(record).items()
+                         if clave not in _ATRIBUTOS_RECORD and not clave.startswith("_"))
+        return f"{linea} [{extra}]" if extra else linea
+
+
+def setup(nivel: str = LOG_LEVEL, niveles: str = LOG_LEVELS, formato: str = LOG_FORMAT,
+          muestreo: str = LOG_SAMPLE_RATES):
+    """Instalar el pipeline de logging en el logger raíz (idempotente)"""
+    global _listener
+    if _listener is not None:
+        return
+
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(TextFormatter() if formato == "text" else JsonFormatter())
+    cola: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = _QueueHandler(cola)
+    handler.addFilter(_SamplingFilter({evento: float(tasa) for evento, tasa in _pares(muestreo).items()}))
+    handler.addFilter(_ContextFilter())
+
+    raiz = logging.getLogger()
+    raiz.handlers = [handler]
+    raiz.setLevel(nivel)
+    for nombre, nivel_logger in _pares(niveles).items():
+        logging.getLogger(nombre).setLevel(nivel_logger.upper())
+
+    _listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Vaciar la cola y parar el hilo de escritura"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# =====================================================
+# MIDDLEWARE
+# =====================================================
+
+class RequestIdMiddleware:
+    """Middleware ASGI que asigna un request_id a cada petición y lo devuelve en X-Request-ID"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for clave, valor in scope["headers"]:
+            if clave == b"x-request-id":
+                request_id = valor.decode("latin-1")[:64]
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_con_id(mensaje):
+            if mensaje["type"] == "http.response.start":
+                mensaje = {**mensaje, "headers": list(mensaje.get("headers", []))
+                           + [(b"x-request-id", request_id.encode("latin-1"))]}
+            await send(mensaje)
+
+        marca = _contexto.set({"request_id": request_id})
+        try:
+            await self.app(scope, receive, send_con_id)
+        finally:
+            _contexto.reset(marca)
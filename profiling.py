@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Perfilado bajo demanda de peticiones individuales
+
+Cuando un endpoint se vuelve lento en producción, este modo permite ver en
+qué se va el tiempo (llamadas a Google, SQLite, serialización JSON...):
+
+- Se activa por petición con la cabecera "X-Profile: <PROFILE_TOKEN>" o
+  para una fracción aleatoria de peticiones (PROFILE_SAMPLE_RATE).
+- La respuesta lleva una cabecera Server-Timing con la duración de los
+  tramos con nombre: google.<api>, db.<método>, serialize y total.
+- Además se guarda el perfil de llamadas en PROFILE_DIR, como pstats
+  (.prof, para snakeviz o pstats) o como JSON de speedscope
+  (PROFILE_FORMAT=speedscope). Incluye el hilo del event loop y, por
+  separado, cada llamada de la petición al threadpool (run_in_threadpool:
+  Google, SQLite...), que es donde suele estar el trabajo real. Solo se
+  perfila una petición a la vez; las demás que coincidan reciben
+  únicamente el Server-Timing.
+
+Limitación: el perfil del hilo del event loop no distingue peticiones, así
+que incluye también lo que otras peticiones concurrentes ejecuten en el
+loop mientras dura la perfilada. Los perfiles del threadpool son solo de
+esta petición. En speedscope cada parte es un perfil distinto del fichero;
+en pstats se suman en uno.
+
+Sin PROFILE_TOKEN ni PROFILE_SAMPLE_RATE no se instala nada: ni el
+middleware ni los envoltorios de los tramos, así que el coste es cero.
+"""
+import cProfile
+import contextvars
+import functools
+import hmac
+import inspect
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import anyio.to_thread
+
+logger = logging.getLogger(__name__)
+
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "pstats")  # pstats | speedscope
+
+# Tramos de la petición en curso (None si no se está perfilando)
+_tramos: contextvars.ContextVar = contextvars.ContextVar("tramos_perfil", default=None)
+
+# Perfiles de llamadas de la petición perfilada (None en las demás)
+_perfiles: contextvars.ContextVar = contextvars.ContextVar("perfiles_llamadas", default=None)
+
+# Un solo perfil de llamadas a la vez (el profiler es global del hilo)
+_perfilando = threading.Lock()
+
+
+def enabled() -> bool:
+    """El perfilado está disponible si hay token o tasa de muestreo"""
+    return bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+# =====================================================
+# TRAMOS CON NOMBRE
+# =====================================================
+
+class _Tramos:
+    """Duración acumulada (ms) por nombre de tramo de una petición"""
+
+    def __init__(self):
+        self.duraciones: Dict[str, float] = {}
+        self.abiertos: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+
+class _Tramo:
+    """Mide un tramo; los anidados del mismo grupo (db.*, google.*) no se suman dos veces"""
+
+    def __init__(self, tramos: _Tramos, nombre: str):
+        self.tramos = tramos
+        self.nombre = nombre
+        self.grupo = nombre.split(".", 1)[0]
+
+    def __enter__(self):
+        with self.tramos.lock:
+            self.exterior = self.tramos.abiertos.get(self.grupo, 0) == 0
+            self.tramos.abiertos[self.grupo] = self.tramos.abiertos.get(self.grupo, 0) + 1
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duracion = (time.perf_counter() - self.inicio) * 1000
+        with self.tramos.lock:
+            self.tramos.abiertos[self.grupo] -= 1
+            if self.exterior:
+                self.tramos.duraciones[self.nombre] = self.tramos.duraciones.get(self.nombre, 0.0) + duracion
+        return False
+
+
+def _envolver(nombre: Callable[..., str], fn: Callable) -> Callable:
+    """Medir fn como tramo cuando la petición se está perfilando"""
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def envoltorio_async(*args, **kwargs):
+            tramos = _tramos.get()
+            if tramos is None:
+                return await fn(*args, **kwargs)
+            with _Tramo(tramos, nombre(*args)):
+                return await fn(*args, **kwargs)
+        return envoltorio_async
+
+    @functools.wraps(fn)
+    def envoltorio(*args, **kwargs):
+        tramos = _tramos.get()
+        if tramos is None:
+            return fn(*args, **kwargs)
+        with _Tramo(tramos, nombre(*args)):
+            return fn(*args, **kwargs)
+    return envoltorio
+
+
+def install(db) -> None:
+    """
+    Instalar los tramos: métodos públicos de la base de datos (db.*),
+    llamadas a Google a través de quota.call (google.<api>) y serialización
+    de la respuesta (serialize)
+    """
+    import fastapi.routing
+    import quota
+    from starlette.responses import JSONResponse
+
+    for nombre, valor in inspect.getmembers(type(db), inspect.isfunction):
+        if not nombre.startswith("_"):
+            setattr(db, nombre, _envolver(lambda *a, n=nombre: f"db.{n}", getattr(db, nombre)))
+    quota.call = _envolver(lambda api, *a: f"google.{api}", quota.call)
+    fastapi.routing.serialize_response = _envolver(lambda *a: "serialize",
+                                                   fastapi.routing.serialize_response)
+    JSONResponse.render = _envolver(lambda *a: "serialize", JSONResponse.render)
+    # run_in_threadpool (el de la app y el de FastAPI) pasa por aquí
+    anyio.to_thread.run_sync = _perfilar_hilo(anyio.to_thread.run_sync)
+
+
+def _perfilar_hilo(run_sync: Callable) -> Callable:
+    """Perfilar en el hilo del threadpool las funciones de la petición perfilada"""
+    @functools.wraps(run_sync)
+    async def envoltorio(func, *args, **kwargs):
+        perfiles = _perfiles.get()
+        if perfiles is None:
+            return await run_sync(func, *args, **kwargs)
+
+        nombre = getattr(getattr(func, "func", func), "__qualname__", "función")
+
+        def perfilada(*a):
+            perfil = perfiles.iniciar(f"threadpool: {nombre}")
+            try:
+                return func(*a)
+            finally:
+                if perfil is not None:
+                    perfil.disable()
+        return await run_sync(perfilada, *args, **kwargs)
+    return envoltorio
+
+
+# =====================================================
+# PERFIL DE LLAMADAS
+# =====================================================
+
+class _PerfilSpeedscope:
+    """Perfil por eventos (entrada/salida de cada función) en formato speedscope"""
+
+    def __init__(self):
+        self.frames: List[Dict[str, Any]] = []
+        self.indices: Dict[Any, int] = {}
+        self.eventos: List[Dict[str, Any]] = []
+        self.pila: List[int] = []
+        self.inicio = time.perf_counter()
+
+    def _frame(self, frame, funcion=None) -> int:
+        if funcion is not None:
+            clave = ("c", getattr(funcion, "__module__", None), getattr(funcion, "__qualname__", repr(funcion)))
+            datos = {"name": f"{clave[1] or ''}.{clave[2]}".lstrip(".")}
+        else:
+            codigo = frame.f_code
+            clave = (codigo.co_filename, codigo.co_firstlineno, codigo.co_name)
+            datos = {"name": codigo.co_name, "file": codigo.co_filename, "line": codigo.co_firstlineno}
+        indice = self.indices.get(clave)
+        if indice is None:
+            indice = self.indices[clave] = len(self.frames)
+            self.frames.append(datos)
+        return indice
+
+    def _trazar(self, frame, evento, arg):
+        ahora = (time.perf_counter() - self.inicio) * 1000
+        if evento in ("call", "c_call"):
+            indice = self._frame(frame, arg if evento == "c_call" else None)
+            self.pila.append(indice)
+            self.eventos.append({"type": "O", "frame": indice, "at": ahora})
+        elif self.pila:
+            # Los retornos de marcos abiertos antes de empezar se ignoran
+            self.eventos.append({"type": "C", "frame": self.pila.pop(), "at": ahora})
+
+    def enable(self):
+        sys.setprofile(self._trazar)
+
+    def disable(self):
+        sys.setprofile(None)
+        fin = (time.perf_counter() - self.inicio) * 1000
+        while self.pila:
+            self.eventos.append({"type": "C", "frame": self.pila.pop(), "at": fin})
+
+
+class _Perfiles:
+    """Perfiles de llamadas de una petición: el del event loop y uno por llamada al threadpool"""
+
+    def __init__(self, formato: str):
+        self.formato = formato
+        self.partes: List[tuple] = []
+        self.lock = threading.Lock()
+        self.inicio = time.perf_counter()
+
+    def iniciar(self, nombre: str):
+        """Activar un perfil nuevo en el hilo actual (None si no se puede)"""
+        perfil = _PerfilSpeedscope() if self.formato == "speedscope" else cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Python 3.12+: cProfile usa sys.monitoring y solo admite un
+            # profiler activo a la vez; esta parte se queda sin perfil
+            logger.debug(f"Sin perfil de {nombre}: ya hay otro profiler activo")
+            return None
+        with self.lock:
+            self.partes.append((nombre, perfil))
+        return perfil
+
+    def dump(self, ruta: str, nombre: str):
+        if self.formato != "speedscope":
+            # pstats.Stats no acepta perfiles sin ninguna llamada registrada
+            pstats.Stats(*(perfil for _, perfil in self.partes if perfil.getstats())).dump_stats(ruta)
+            return
+
+        # Una tabla de frames común y un perfil por parte, en la misma línea de tiempo
+        frames: List[Dict[str, Any]] = []
+        indices: Dict[str, int] = {}
+        perfiles = []
+        for parte, perfil in self.partes:
+            desplazamiento = (perfil.inicio - self.inicio) * 1000
+            remapeo = []
+            for datos in perfil.frames:
+                clave = json.dumps(datos, sort_keys=True)
+                if clave not in indices:
+                    indices[clave] = len(frames)
+                    frames.append(datos)
+                remapeo.append(indices[clave])
+            eventos = [{"type": e["type"], "frame": remapeo[e["frame"]], "at": e["at"] + desplazamiento}
+                       for e in perfil.eventos]
+            perfiles.append({
+                "type": "evented", "name": parte, "unit": "milliseconds",
+                "startValue": desplazamiento,
+                "endValue": eventos[-1]["at"] if eventos else desplazamiento,
+                "events": eventos,
+            })
+        with open(ruta, "w", encoding="utf-8") as f:
+            json.dump({
+                "$schema": "https://www.speedscope.app/file-format-schema.json",
+                "shared": {"frames": frames},
+                "profiles": perfiles,
+                "name": nombre,
+            }, f)
+
+
+def _fichero(scope, formato: str) -> str:
+    ruta = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_") or "raiz"
+    sufijo = ".speedscope.json" if formato == "speedscope" else ".prof"
+    marca = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    return os.path.join(PROFILE_DIR, f"{marca}_{scope['method']}_{ruta}{sufijo}")
+
+
+# =====================================================
+# MIDDLEWARE
+# =====================================================
+
+class ProfilingMiddleware:
+    """Middleware ASGI que perfila las peticiones autorizadas o muestreadas"""
+
+    def __init__(self, app, token: str = PROFILE_TOKEN, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 formato: str = PROFILE_FORMAT):
+        self.app = app
+        self.token = token.encode("utf-8")
+        self.sample_rate = sample_rate
+        self.formato = formato
+
+    def _activar(self, scope) -> bool:
+        if self.token:
+            for clave, valor in scope["headers"]:
+                if clave == b"x-profile":
+                    return hmac.compare_digest(valor, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._activar(scope):
+            await self.app(scope, receive, send)
+            return
+
+        tramos = _Tramos()
+        marca = _tramos.set(tramos)
+        perfiles = perfil = None
+        if _perfilando.acquire(blocking=False):
+            perfiles = _Perfiles(self.formato)
+        marca_perfiles = _perfiles.set(perfiles)
+        fichero = _fichero(scope, self.formato) if perfiles is not None else None
+        inicio = time.perf_counter()
+
+        async def send_con_tiempos(mensaje):
+            if mensaje["type"] == "http.response.start":
+                total = (time.perf_counter() - inicio) * 1000
+                partes = [f"{nombre};dur={ms:.1f}" for nombre, ms in sorted(tramos.duraciones.items())]
+                partes.append(f"total;dur={total:.1f}")
+                cabeceras = list(mensaje.get("headers", []))
+                cabeceras.append((b"server-timing", ", ".join(partes).encode("latin-1")))
+                if fichero:
+                    cabeceras.append((b"x-profile-file", os.path.basename(fichero).encode("latin-1")))
+                mensaje = {**mensaje, "headers": cabeceras}
+            await send(mensaje)
+
+        try:
+            if perfiles is not None:
+                perfil = perfiles.iniciar("event loop (incluye otras peticiones concurrentes)")
+            await self.app(scope, receive, send_con_tiempos)
+        finally:
+            if perfil is not None:
+                perfil.disable()
+            if perfiles is not None:
+                _perfilando.release()
+                try:
+                    os.makedirs(PROFILE_DIR, exist_ok=True)
+                    perfiles.dump(fichero, f"{scope['method']} {scope['path']}")
+                    logger.info(f"🔬 Perfil de {scope['method']} {scope['path']} guardado en {fichero}")
+                except Exception:
+                    logger.exception("⚠️ No se pudo guardar el perfil")
+            _perfiles.reset(marca_perfiles)
+            _tramos.reset(marca)
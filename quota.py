@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+Planificador de llamadas a las APIs de Google según sus cuotas
+
+Las peticiones interactivas (la web) y los trabajos masivos (importaciones,
+reanálisis) comparten las cuotas del mismo proyecto de Google. Todas las
+llamadas a Natural Language, Speech-to-Text y Vision pasan por aquí:
+
+- Un token bucket por API con la cuota configurada (peticiones por minuto).
+- Dos carriles: "interactivo" tiene prioridad estricta y "masivo" solo
+  consume tokens cuando no hay interactivas esperando, y nunca más de
+  QUOTA_BULK_SHARE de la cuota, para dejar siempre margen a la web.
+- Cada llamada espera su turno (FIFO dentro del carril) como mucho hasta su
+  plazo; si no lo consigue se lanza QuotaExceededError con un Retry-After.
+- Si Google responde RESOURCE_EXHAUSTED, la tasa de esa API se reduce a la
+  mitad y la llamada se reintenta dentro de su plazo; con cada llamada
+  correcta se recupera poco a poco hasta la cuota configurada (AIMD).
+
+Las cuotas son del proyecto de Google, no de cada proceso. Con
+QUOTA_SERVER_ADDRESS, los token buckets viven en un único servicio local
+(el proceso escritor lo sirve; sin escritor, `python quota.py`) y todos los
+workers de uvicorn y la importación masiva piden ahí su turno, así que la
+prioridad del carril interactivo se respeta entre procesos. Sin servicio
+central (o si no responde) cada proceso usa su parte de la cuota:
+1/QUOTA_PROCESSES de cada API.
+
+Uso (bloqueante, desde un hilo):
+    quota.call("language", client.analyze_sentiment, request={...})
+    quota.call("vision", client.annotate_image, {...}, carril=quota.MASIVO)
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Client, Listener
+from typing import Any, Callable, Dict, Optional
+
+from dotenv import load_dotenv
+
+if __name__ == "__main__":
+    # Punto de entrada: el .env se carga antes de leer la configuración
+    load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+INTERACTIVO = "interactivo"
+MASIVO = "masivo"
+CARRILES = (INTERACTIVO, MASIVO)
+
+# Cuotas por API en peticiones/minuto (por defecto, las de un proyecto nuevo)
+QUOTA_RPM = {
+    "language": float(os.getenv("QUOTA_LANGUAGE_RPM", "600")),
+    "speech": float(os.getenv("QUOTA_SPEECH_RPM", "900")),
+    "vision": float(os.getenv("QUOTA_VISION_RPM", "1800")),
+}
+QUOTA_BULK_SHARE = float(os.getenv("QUOTA_BULK_SHARE", "0.5"))
+QUOTA_INTERACTIVE_DEADLINE = float(os.getenv("QUOTA_INTERACTIVE_DEADLINE", "10"))
+QUOTA_BULK_DEADLINE = float(os.getenv("QUOTA_BULK_DEADLINE", "300"))
+# Servicio central de cuotas (ver QuotaServer) y reparto sin él
+QUOTA_SERVER_ADDRESS = os.getenv("QUOTA_SERVER_ADDRESS", "")
+# Obligatoria con el servicio central (el socket deserializa con pickle)
+QUOTA_SERVER_AUTHKEY = os.getenv("QUOTA_SERVER_AUTHKEY", "").encode("utf-8")
+QUOTA_PROCESSES = max(1, int(os.getenv("QUOTA_PROCESSES", "1")))
+
+# Tasa mínima tras RESOURCE_EXHAUSTED (fracción de la cuota) y recuperación por éxito
+_TASA_MINIMA = 0.05
+_RECUPERACION = 0.02
+# Esperas recientes que se guardan por carril para los percentiles
+_MUESTRAS = 1000
+
+
+class QuotaExceededError(RuntimeError):
+    """No hay cuota disponible para la llamada dentro de su plazo"""
+
+    def __init__(self, mensaje: str, retry_after: float):
+        super().__init__(mensaje)
+        self.retry_after = retry_after
+
+
+def is_resource_exhausted(error: Exception) -> bool:
+    """RESOURCE_EXHAUSTED de gRPC / 429 de HTTP, sin importar google.api_core"""
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    return getattr(error, "code", None) == 429 or "RESOURCE_EXHAUSTED" in str(error)
+
+
+class _Turno:
+    """Llamada esperando tokens en la cola de su carril"""
+
+    def __init__(self, carril: str, coste: float):
+        self.carril = carril
+        self.coste = coste
+
+
+class _CuotaApi:
+    """Token bucket de una API con colas por carril y tasa adaptativa"""
+
+    def __init__(self, nombre: str, rpm: float, bulk_share: float):
+        self.nombre = nombre
+        self.limite = rpm / 60.0          # tasa configurada (peticiones/s)
+        self.tasa = self.limite           # tasa actual (baja con RESOURCE_EXHAUSTED)
+        self.bulk_share = bulk_share
+        self.tokens = self._capacidad()
+        self.tokens_masivo = self._capacidad() * bulk_share
+        self.actualizado = time.monotonic()
+        self.pausa_hasta = 0.0
+        self.cond = threading.Condition()
+        self.colas = {carril: deque() for carril in CARRILES}
+        self.agotados = 0
+        self.metricas = {
+            carril: {"llamadas": 0, "rechazadas": 0, "espera_total": 0.0, "espera_max": 0.0,
+                     "muestras": deque(maxlen=_MUESTRAS)}
+            for carril in CARRILES
+        }
+
+    def _capacidad(self) -> float:
+        # Ráfaga de un segundo de cuota (al menos una petición)
+        return max(1.0, self.tasa)
+
+    def _rellenar(self, ahora: float):
+        transcurrido = ahora - self.actualizado
+        self.actualizado = ahora
+        if ahora < self.pausa_hasta:
+            return
+        self.tokens = min(self._capacidad(), self.tokens + transcurrido * self.tasa)
+        self.tokens_masivo = min(self._capacidad() * self.bulk_share,
+                                 self.tokens_masivo + transcurrido * self.tasa * self.bulk_share)
+
+    def _umbral(self, turno: _Turno) -> float:
+        # Un lote mayor que la ráfaga del carril sale con el cubo lleno y lo
+        # deja en deuda por el resto del coste (tokens negativos), así que
+        # los siguientes esperan lo que corresponde al lote entero
+        capacidad = self._capacidad() * (self.bulk_share if turno.carril == MASIVO else 1)
+        return min(turno.coste, max(1.0, capacidad))
+
+    def _puede(self, turno: _Turno) -> bool:
+        """Solo el primero de su carril, y el masivo si no hay interactivas esperando"""
+        umbral = self._umbral(turno)
+        if self.colas[turno.carril][0] is not turno or self.tokens < umbral:
+            return False
+        if turno.carril == MASIVO:
+            return not self.colas[INTERACTIVO] and self.tokens_masivo >= umbral
+        return True
+
+    def _espera_estimada(self, turno: _Turno, ahora: float) -> float:
+        """Segundos hasta tener los tokens que necesita el turno"""
+        tasa = self.tasa * (self.bulk_share if turno.carril == MASIVO else 1)
+        tokens = self.tokens_masivo if turno.carril == MASIVO else self.tokens
+        espera = max(0.0, (self._umbral(turno) - tokens) / tasa) if tasa > 0 else 1.0
+        return max(espera, self.pausa_hasta - ahora)
+
+    def acquire(self, carril: str, plazo: float, coste: float = 1):
+        """Esperar coste tokens (p. ej. imágenes de un lote) hasta el instante plazo"""
+        turno = _Turno(carril, coste)
+        inicio = time.monotonic()
+        with self.cond:
+            self.colas[carril].append(turno)
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._rellenar(ahora)
+                    if self._puede(turno):
+                        self.tokens -= coste
+                        if carril == MASIVO:
+                            self.tokens_masivo -= coste
+                        break
+                    if ahora >= plazo:
+                        self._registrar(carril, ahora - inicio, rechazada=True)
+                        en_cola = len(self.colas[carril])
+                        raise QuotaExceededError(
+                            f"Cuota de {self.nombre} agotada ({en_cola} llamadas {carril}s en cola)",
+                            retry_after=max(1.0, en_cola / max(self.tasa, 0.01)))
+                    self.cond.wait(min(plazo - ahora,
+                                       max(0.005, self._espera_estimada(turno, ahora))))
+            finally:
+                self.colas[carril].remove(turno)
+                # El siguiente de la cola (o el otro carril) puede tener turno ya
+                self.cond.notify_all()
+            self._registrar(carril, time.monotonic() - inicio)
+
+    def _registrar(self, carril: str, espera: float, rechazada: bool = False):
+        m = self.metricas[carril]
+        m["llamadas"] += 1
+        m["rechazadas"] += rechazada
+        m["espera_total"] += espera
+        m["espera_max"] = max(m["espera_max"], espera)
+        m["muestras"].append(espera)
+
+    def exhausted(self, pausa: float):
+        """Google ha respondido RESOURCE_EXHAUSTED: reducir la tasa a la mitad"""
+        with self.cond:
+            self.agotados += 1
+            self.tasa = max(self.limite * _TASA_MINIMA, self.tasa / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self.tokens_masivo = min(self.tokens_masivo, 0.0)
+            self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + pausa)
+
+    def succeeded(self):
+        """Llamada correcta: recuperar la tasa poco a poco hasta la cuota"""
+        if self.tasa < self.limite:
+            with self.cond:
+                self.tasa = min(self.limite, self.tasa + self.limite * _RECUPERACION)
+
+    def stats(self) -> Dict[str, Any]:
+        carriles = {}
+        for carril, m in self.metricas.items():
+            muestras = sorted(m["muestras"])
+            def percentil(p):
+                return round(muestras[min(len(muestras) - 1, int(p * len(muestras)))] * 1000, 1) if muestras else 0.0
+            carriles[carril] = {
+                "llamadas": m["llamadas"],
+                "rechazadas": m["rechazadas"],
+                "en_cola": len(self.colas[carril]),
+                "espera_media_ms": round(m["espera_total"] / m["llamadas"] * 1000, 1) if m["llamadas"] else 0.0,
+                "espera_p50_ms": percentil(0.5),
+                "espera_p95_ms": percentil(0.95),
+                "espera_max_ms": round(m["espera_max"] * 1000, 1),
+            }
+        return {
+            "cuota_rpm": round(self.limite * 60),
+            "tasa_actual_rpm": round(self.tasa * 60, 1),
+            "resource_exhausted": self.agotados,
+            "carriles": carriles,
+        }
+
+
+class QuotaScheduler:
+    """Reparte las cuotas de cada API entre los carriles interactivo y masivo"""
+
+    def __init__(self, cuotas: Optional[Dict[str, float]] = None,
+                 bulk_share: float = QUOTA_BULK_SHARE):
+        self.apis = {
+            nombre: _CuotaApi(nombre, rpm, bulk_share)
+            for nombre, rpm in (cuotas or QUOTA_RPM).items()
+        }
+
+    # Operaciones sobre los token buckets (RemoteQuotaScheduler las hace en el servicio central)
+
+    def _acquire(self, api: str, carril: str, limite: float, coste: float):
+        self.apis[api].acquire(carril, limite, coste)
+
+    def _exhausted(self, api: str, pausa: float) -> float:
+        """Reducir la tasa de la API; devuelve la nueva tasa (peticiones/s)"""
+        cuota = self.apis[api]
+        cuota.exhausted(pausa)
+        return cuota.tasa
+
+    def _succeeded(self, api: str):
+        self.apis[api].succeeded()
+
+    def call(self, api: str, fn: Callable, *args, carril: str = INTERACTIVO,
+             plazo: Optional[float] = None, coste: float = 1, **kwargs):
+        """
+        Ejecutar fn(*args, **kwargs) cuando haya cuota para la API
+
+        plazo son los segundos máximos de espera (por defecto según el
+        carril) y coste las unidades de cuota que consume la llamada (p. ej.
+        el número de imágenes de un batch_annotate_images). Los
+        RESOURCE_EXHAUSTED se reintentan dentro del plazo.
+        """
+        if api not in self.apis:
+            raise KeyError(f"API sin cuota configurada: {api}")
+        if plazo is None:
+            plazo = QUOTA_BULK_DEADLINE if carril == MASIVO else QUOTA_INTERACTIVE_DEADLINE
+        limite = time.monotonic() + plazo
+        pausa = 1.0
+        while True:
+            self._acquire(api, carril, limite, coste)
+            try:
+                resultado = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_resource_exhausted(e):
+                    raise
+                tasa = self._exhausted(api, pausa)
+                logger.warning(f"⚠️ RESOURCE_EXHAUSTED en {api}: tasa reducida a {tasa * 60:.0f} rpm")
+                if time.monotonic() + pausa >= limite:
+                    raise QuotaExceededError(f"Cuota de {api} agotada en Google: {str(e)}",
+                                             retry_after=pausa)
+                pausa = min(pausa * 2, 30)
+                continue
+            self._succeeded(api)
+            return resultado
+
+    def stats(self) -> Dict[str, Any]:
+        """Tasa actual y tiempos de espera por API y carril"""
+        return {nombre: cuota.stats() for nombre, cuota in self.apis.items()}
+
+
+# =====================================================
+# SERVICIO CENTRAL (un planificador para todos los procesos)
+# =====================================================
+
+class QuotaServer:
+    """Sirve un QuotaScheduler a los demás procesos por un socket local"""
+
+    def __init__(self, planificador: Optional[QuotaScheduler] = None, address=None,
+                 authkey: bytes = QUOTA_SERVER_AUTHKEY):
+        from writer import parse_address, require_authkey
+        self.scheduler = planificador or QuotaScheduler()
+        self.address = parse_address(address or QUOTA_SERVER_ADDRESS or "127.0.0.1:8766")
+        self.authkey = require_authkey(authkey, "QUOTA_SERVER_AUTHKEY")
+        self.listener = None
+
+    def start(self):
+        """Abrir el socket"""
+        if self.listener is None:
+            self.listener = Listener(self.address, authkey=self.authkey)
+            logger.info(f"🎫 Servicio de cuotas escuchando en {self.address}")
+
+    def serve_forever(self):
+        """Aceptar conexiones de los procesos cliente (bloquea)"""
+        self.start()
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            except Exception as e:
+                logger.warning(f"⚠️ Conexión rechazada por el servicio de cuotas: {str(e)}")
+                continue
+            threading.Thread(target=self._atender, args=(conn,), daemon=True).start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+
+    def _atender(self, conn):
+        """Una conexión = un hilo de un proceso cliente (una llamada a la vez)"""
+        try:
+            while True:
+                mensaje = conn.recv()
+                try:
+                    conn.send(("ok", self._ejecutar(*mensaje)))
+                except QuotaExceededError as e:
+                    conn.send(("quota", str(e), e.retry_after))
+                except Exception as e:
+                    conn.send(("error", f"{type(e).__name__}: {str(e)}", None))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _ejecutar(self, operacion: str, *args):
+        s = self.scheduler
+        if operacion == "acquire":
+            api, carril, espera, coste = args
+            return s._acquire(api, carril, time.monotonic() + espera, coste)
+        if operacion == "exhausted":
+            return s._exhausted(*args)
+        if operacion == "succeeded":
+            return s._succeeded(*args)
+        if operacion == "stats":
+            return s.stats()
+        raise ValueError(f"Operación desconocida: {operacion}")
+
+
+class RemoteQuotaScheduler(QuotaScheduler):
+    """
+    Planificador que pide los turnos al servicio central de cuotas
+
+    Si el servicio no responde, usa sus propios token buckets con la parte
+    de la cuota de este proceso (1/QUOTA_PROCESSES) hasta que vuelva.
+    """
+
+    def __init__(self, address=None, authkey: bytes = QUOTA_SERVER_AUTHKEY,
+                 cuotas: Optional[Dict[str, float]] = None, procesos: int = QUOTA_PROCESSES):
+        from writer import parse_address, require_authkey
+        super().__init__({nombre: rpm / procesos for nombre, rpm in (cuotas or QUOTA_RPM).items()})
+        self.address = parse_address(address or QUOTA_SERVER_ADDRESS)
+        self.authkey = require_authkey(authkey, "QUOTA_SERVER_AUTHKEY")
+        self._pool = []
+        self._lock = threading.Lock()
+        self._aviso = 0.0
+
+    def _pedir(self, *mensaje, espera: float = 5.0):
+        """Enviar una operación al servicio; None si no está disponible"""
+        with self._lock:
+            conn = self._pool.pop() if self._pool else None
+        try:
+            if conn is None:
+                conn = Client(self.address, authkey=self.authkey)
+            conn.send(mensaje)
+            if not conn.poll(espera + 5.0):
+                raise TimeoutError("sin respuesta del servicio de cuotas")
+            respuesta = conn.recv()
+        except Exception as e:
+            if conn is not None:
+                conn.close()
+            ahora = time.monotonic()
+            if ahora - self._aviso > 60:
+                self._aviso = ahora
+                logger.warning(f"⚠️ Servicio de cuotas no disponible en {self.address} ({str(e)}), "
+                               f"usando la cuota local (1/{QUOTA_PROCESSES})")
+            return None
+        with self._lock:
+            self._pool.append(conn)
+
+        if respuesta[0] == "quota":
+            raise QuotaExceededError(respuesta[1], retry_after=respuesta[2])
+        if respuesta[0] != "ok":
+            raise RuntimeError(f"Error del servicio de cuotas: {respuesta[1]}")
+        return respuesta
+
+    def _acquire(self, api: str, carril: str, limite: float, coste: float):
+        espera = max(0.0, limite - time.monotonic())
+        if self._pedir("acquire", api, carril, espera, coste, espera=espera) is None:
+            super()._acquire(api, carril, limite, coste)
+
+    def _exhausted(self, api: str, pausa: float) -> float:
+        respuesta = self._pedir("exhausted", api, pausa)
+        return respuesta[1] if respuesta is not None else super()._exhausted(api, pausa)
+
+    def _succeeded(self, api: str):
+        if self._pedir("succeeded", api) is None:
+            super()._succeeded(api)
+
+    def stats(self) -> Dict[str, Any]:
+        respuesta = self._pedir("stats")
+        if respuesta is None:
+            return {"central": None, "local": super().stats()}
+        return {"central": str(self.address), **respuesta[1]}
+
+
+def get_scheduler() -> QuotaScheduler:
+    """Planificador del servicio central si QUOTA_SERVER_ADDRESS está definido; si no, uno local"""
+    if QUOTA_SERVER_ADDRESS:
+        return RemoteQuotaScheduler()
+    return QuotaScheduler({nombre: rpm / QUOTA_PROCESSES for nombre, rpm in QUOTA_RPM.items()})
+
+
+scheduler = get_scheduler()
+
+
+def call(api: str, fn: Callable, *args, **kwargs):
+    """Atajo a scheduler.call (planificador compartido del proceso)"""
+    return scheduler.call(api, fn, *args, **kwargs)
+
+
+if __name__ == "__main__":
+    # Servicio central de cuotas independiente (sin proceso escritor)
+    import logs
+    logs.setup()
+    QuotaServer(QuotaScheduler(), address=os.getenv("QUOTA_SERVER_ADDRESS")).serve_forever()
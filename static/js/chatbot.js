@@ -26,6 +26,50 @@ const chatbot = {
         
         console.log('✅ Elementos del chatbot encontrados');
         this.attachEventListeners();
+        this.connectLiveFeed();
+    },
+    
+    connectLiveFeed() {
+        // Feed en vivo (SSE): los totales llegan como instantánea + deltas,
+        // sin volver a consultar /api/chatbot/stats
+        if (!window.EventSource) {
+            return;
+        }
+        
+        const status = this.container.querySelector('.chatbot-status');
+        const source = new EventSource('/api/stream/feedback');
+        
+        const render = () => {
+            if (status && this.liveStats) {
+                status.textContent = `En línea · ${this.liveStats.total} feedback`;
+            }
+        };
+        
+        source.addEventListener('snapshot', (e) => {
+            this.liveStats = JSON.parse(e.data);
+            render();
+        });
+        
+        source.addEventListener('feedback', (e) => {
+            const { seq, delta } = JSON.parse(e.data);
+            // Los eventos anteriores a la instantánea ya están contados en ella
+            if (!this.liveStats || seq <= this.liveStats.seq) {
+                return;
+            }
+            this.liveStats.seq = seq;
+            const stats = this.liveStats;
+            stats.total += delta.total;
+            stats.sentimientos[delta.sentimiento] = (stats.sentimientos[delta.sentimiento] || 0) + 1;
+            if (delta.categoria) {
+                stats.categorias[delta.categoria] = (stats.categorias[delta.categoria] || 0) + 1;
+            }
+            stats.tipos[delta.tipo] = (stats.tipos[delta.tipo] || 0) + 1;
+            render();
+        });
+        
+        source.addEventListener('dropped', () => {
+            console.warn('⚠️ Feed en vivo desconectado por el servidor, reconectando...');
+        });
     },
     
     attachEventListeners() {
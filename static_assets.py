@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Recursos estáticos con huella de contenido y compresión de respuestas
+
+- Al arrancar se lee el directorio static/ y a cada fichero se le calcula
+  una huella (sha256 del contenido). La plantilla pide las URLs con
+  asset_url("css/style.css") y recibe "/static/css/style.<huella>.css", que
+  se sirve con Cache-Control inmutable de un año: el navegador no vuelve a
+  pedirla hasta que cambie el contenido (y con él la URL).
+- Los ficheros de texto (CSS, JS, SVG...) se comprimen una sola vez al
+  arrancar en gzip y, si está instalado el paquete brotli, en br. Se sirve
+  la mejor variante que acepte el cliente según Accept-Encoding.
+- Las URLs sin huella siguen funcionando (con revalidación por ETag) y los
+  ficheros añadidos después de arrancar se sirven desde disco.
+- CompressionMiddleware comprime las respuestas JSON/HTML grandes de la API
+  (a partir de COMPRESS_MIN_BYTES), incluidas las que van en streaming.
+"""
+import gzip
+import hashlib
+import mimetypes
+import logging
+import os
+import zlib
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+
+from http_cache import _etag_matches
+
+logger = logging.getLogger(__name__)
+
+# brotli es opcional: sin él solo se usa gzip
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "31536000"))
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_TYPES = tuple(
+    t.strip() for t in os.getenv("COMPRESS_TYPES", "application/json,text/html").split(",") if t.strip()
+)
+
+# Extensiones que merece la pena precomprimir (las imágenes ya van comprimidas)
+_COMPRIMIBLES = (".css", ".js", ".svg", ".html", ".json", ".txt", ".map", ".ico")
+# Las respuestas dinámicas usan niveles rápidos; los estáticos, los máximos
+_NIVEL_GZIP = 6
+_CALIDAD_BROTLI = 4
+
+
+def _codificaciones(cabecera: str) -> Tuple[str, ...]:
+    """Codificaciones aceptadas por el cliente (sin las de q=0), por preferencia del servidor"""
+    aceptadas = set()
+    for parte in cabecera.lower().split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        q = parametros.strip()
+        if q.startswith("q=") and q[2:].strip() in ("0", "0.0", "0.00", "0.000"):
+            continue
+        aceptadas.add(nombre.strip())
+    orden = ("br", "gzip") if BROTLI_AVAILABLE else ("gzip",)
+    return tuple(c for c in orden if c in aceptadas or "*" in aceptadas)
+
+
+# =====================================================
+# RECURSOS CON HUELLA
+# =====================================================
+
+class StaticAssets:
+    """App ASGI para /static que sirve los recursos desde memoria con su huella"""
+
+    def __init__(self, directory: str = "static", max_age: int = STATIC_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        # Ruta pedida (con o sin huella) -> (recurso, inmutable)
+        self.rutas: Dict[str, Tuple[Dict[str, Any], bool]] = {}
+        # Ruta original -> ruta con huella
+        self.huellas: Dict[str, str] = {}
+        self.fallback = StaticFiles(directory=directory, check_dir=False)
+        self.load()
+
+    def load(self):
+        """Calcular huellas y variantes comprimidas de todos los ficheros"""
+        rutas, huellas = {}, {}
+        total = {"": 0, "gzip": 0, "br": 0}
+        for raiz, _, ficheros in os.walk(self.directory):
+            for nombre in sorted(ficheros):
+                completa = os.path.join(raiz, nombre)
+                relativa = os.path.relpath(completa, self.directory).replace(os.sep, "/")
+                with open(completa, "rb") as f:
+                    datos = f.read()
+                digest = hashlib.sha256(datos).hexdigest()
+                base, extension = os.path.splitext(relativa)
+                con_huella = f"{base}.{digest[:12]}{extension}"
+
+                recurso = {
+                    "tipo": mimetypes.guess_type(nombre)[0] or "application/octet-stream",
+                    "etag": f'"{digest[:20]}"',
+                    "variantes": {"": datos},
+                }
+                if extension.lower() in _COMPRIMIBLES:
+                    comprimido = gzip.compress(datos, compresslevel=9, mtime=0)
+                    if len(comprimido) < len(datos):
+                        recurso["variantes"]["gzip"] = comprimido
+                    if BROTLI_AVAILABLE:
+                        comprimido = brotli.compress(datos, quality=11)
+                        if len(comprimido) < len(datos):
+                            recurso["variantes"]["br"] = comprimido
+                for codificacion in total:
+                    total[codificacion] += len(recurso["variantes"].get(codificacion, datos))
+
+                rutas[relativa] = (recurso, False)
+                rutas[con_huella] = (recurso, True)
+                huellas[relativa] = con_huella
+
+        self.rutas, self.huellas = rutas, huellas
+        resumen = f"{len(huellas)} ficheros, {total[''] // 1024} KB (gzip {total['gzip'] // 1024} KB"
+        resumen += f", br {total['br'] // 1024} KB)" if BROTLI_AVAILABLE else ")"
+        logger.info(f"📦 Recursos estáticos con huella: {resumen}")
+
+    def url(self, ruta: str) -> str:
+        """URL pública de un recurso (con huella si existe al arrancar)"""
+        ruta = ruta.lstrip("/")
+        return "/static/" + self.huellas.get(ruta, ruta)
+
+    async def __call__(self, scope, receive, send):
+        encontrado = self.rutas.get(scope["path"].lstrip("/")) if scope["type"] == "http" else None
+        if encontrado is None or scope["method"] not in ("GET", "HEAD"):
+            await self.fallback(scope, receive, send)
+            return
+
+        recurso, inmutable = encontrado
+        cabeceras_peticion = Headers(scope=scope)
+        cache_control = f"public, max-age={self.max_age}, immutable" if inmutable else "no-cache"
+        cabeceras = [
+            (b"cache-control", cache_control.encode()),
+            (b"etag", recurso["etag"].encode()),
+            (b"vary", b"Accept-Encoding"),
+        ]
+
+        if_none_match = cabeceras_peticion.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, recurso["etag"]):
+            await send({"type": "http.response.start", "status": 304, "headers": cabeceras})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        codificacion = next((c for c in _codificaciones(cabeceras_peticion.get("accept-encoding", ""))
+                             if c in recurso["variantes"]), "")
+        cuerpo = recurso["variantes"][codificacion]
+        cabeceras += [
+            (b"content-type", recurso["tipo"].encode()),
+            (b"content-length", str(len(cuerpo)).encode()),
+        ]
+        if codificacion:
+            cabeceras.append((b"content-encoding", codificacion.encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": cabeceras})
+        await send({"type": "http.response.body", "body": cuerpo if scope["method"] == "GET" else b""})
+
+
+# =====================================================
+# COMPRESIÓN DE RESPUESTAS
+# =====================================================
+
+class _Compresor:
+    """gzip o brotli incremental (una respuesta)"""
+
+    def __init__(self, codificacion: str):
+        self.codificacion = codificacion
+        if codificacion == "br":
+            self.compresor = brotli.Compressor(quality=_CALIDAD_BROTLI)
+        else:
+            self.compresor = zlib.compressobj(_NIVEL_GZIP, zlib.DEFLATED, 31)
+
+    def parte(self, datos: bytes) -> bytes:
+        """Comprimir un trozo y vaciar el búfer (para no retener el streaming)"""
+        if self.codificacion == "br":
+            return self.compresor.process(datos) + self.compresor.flush()
+        return self.compresor.compress(datos) + self.compresor.flush(zlib.Z_SYNC_FLUSH)
+
+    def final(self, datos: bytes = b"") -> bytes:
+        if self.codificacion == "br":
+            return self.compresor.process(datos) + self.compresor.finish()
+        return self.compresor.compress(datos) + self.compresor.flush()
+
+
+class CompressionMiddleware:
+    """Middleware ASGI que comprime las respuestas grandes de los tipos indicados"""
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_BYTES, tipos: Tuple[str, ...] = COMPRESS_TYPES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.tipos = tipos
+
+    async def __call__(self, scope, receive, send):
+        codificaciones = ()
+        if scope["type"] == "http":
+            codificaciones = _codificaciones(Headers(scope=scope).get("accept-encoding", ""))
+        if not codificaciones:
+            await self.app(scope, receive, send)
+            return
+
+        inicio: Optional[Dict[str, Any]] = None
+        compresor: Optional[_Compresor] = None
+        directo = False
+
+        def cabeceras_comprimidas(longitud: Optional[int]):
+            cabeceras = MutableHeaders(raw=list(inicio["headers"]))
+            cabeceras["content-encoding"] = codificaciones[0]
+            cabeceras.add_vary_header("Accept-Encoding")
+            if longitud is None:
+                del cabeceras["content-length"]
+            else:
+                cabeceras["content-length"] = str(longitud)
+            # Otra representación: el ETag fuerte pasa a débil
+            etag = cabeceras.get("etag")
+            if etag and not etag.startswith("W/"):
+                cabeceras["etag"] = "W/" + etag
+            return {**inicio, "headers": cabeceras.raw}
+
+        async def send_comprimido(mensaje):
+            nonlocal inicio, compresor, directo
+            if mensaje["type"] == "http.response.start":
+                cabeceras = Headers(raw=mensaje["headers"])
+                tipo = cabeceras.get("content-type", "").split(";")[0].strip()
+                if "content-encoding" in cabeceras or tipo not in self.tipos:
+                    directo = True
+                    await send(mensaje)
+                else:
+                    inicio = mensaje
+                return
+            if directo or mensaje["type"] != "http.response.body":
+                await send(mensaje)
+                return
+
+            cuerpo = mensaje.get("body", b"")
+            mas = mensaje.get("more_body", False)
+            if compresor is not None:
+                datos = compresor.parte(cuerpo) if mas else compresor.final(cuerpo)
+                await send({"type": "http.response.body", "body": datos, "more_body": mas})
+            elif mas:
+                # Respuesta en streaming: se comprime trozo a trozo sin Content-Length
+                compresor = _Compresor(codificaciones[0])
+                await send(cabeceras_comprimidas(None))
+                await send({"type": "http.response.body", "body": compresor.parte(cuerpo), "more_body": True})
+            elif len(cuerpo) < self.minimum_size:
+                await send(inicio)
+                await send(mensaje)
+            else:
+                datos = _Compresor(codificaciones[0]).final(cuerpo)
+                await send(cabeceras_comprimidas(len(datos)))
+                await send({"type": "http.response.body", "body": datos})
+
+        await self.app(scope, receive, send_comprimido)
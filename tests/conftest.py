@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Configuración común de las pruebas
+
+Los módulos de la aplicación están en la raíz del repositorio (sin
+paquete), así que se añade al path. Las pruebas no importan app.py (crea
+la base de datos y los clientes de Google al importarse) ni llaman a Google.
+"""
+import os
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Control de admisión de los endpoints de análisis (admission.py)"""
+import asyncio
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from admission import AdmissionMiddleware, AdmissionRejected, _Limitador
+
+MB = 1024 * 1024
+
+
+def _limitador(**kwargs) -> _Limitador:
+    config = {"concurrencia": 1, "bytes": 10 * MB, "max_peticion": 5 * MB, "cola": 2, "espera": 1.0}
+    config.update(kwargs)
+    return _Limitador(**config)
+
+
+async def _en_cola(limitador: _Limitador, n: int = 1) -> asyncio.Task:
+    tarea = asyncio.create_task(limitador.acquire(n))
+    await asyncio.sleep(0.01)
+    return tarea
+
+
+def test_cola_fifo_al_liberar():
+    async def prueba():
+        limitador = _limitador()
+        await limitador.acquire(1)
+        primera, segunda = await _en_cola(limitador), await _en_cola(limitador)
+        assert not primera.done() and len(limitador.cola) == 2
+
+        limitador.release(1, 0.1)
+        await asyncio.sleep(0.01)
+        assert primera.done() and not segunda.done()
+        limitador.release(1, 0.1)
+        await segunda
+        assert limitador.en_curso == 1 and limitador.stats["encoladas"] == 2
+
+    asyncio.run(prueba())
+
+
+def test_presupuesto_de_bytes_y_tamano_maximo():
+    async def prueba():
+        limitador = _limitador(concurrencia=4)
+        await limitador.acquire(4 * MB)
+        await limitador.acquire(4 * MB)
+        tercera = await _en_cola(limitador, 4 * MB)
+        assert not tercera.done()
+        limitador.release(4 * MB, 0.1)
+        await tercera
+
+        with pytest.raises(AdmissionRejected) as error:
+            await limitador.acquire(6 * MB)
+        assert error.value.status == 413
+
+    asyncio.run(prueba())
+
+
+def test_cola_llena_y_espera_agotada_responden_503():
+    async def prueba():
+        limitador = _limitador(espera=0.05)
+        await limitador.acquire(1)
+        esperando = [await _en_cola(limitador), await _en_cola(limitador)]
+        with pytest.raises(AdmissionRejected) as llena:
+            await limitador.acquire(1)
+        assert llena.value.status == 503 and llena.value.retry_after >= 1
+
+        for tarea in esperando:
+            with pytest.raises(AdmissionRejected):
+                await tarea
+        assert not limitador.cola and limitador.en_curso == 1
+
+    asyncio.run(prueba())
+
+
+def test_cancelar_en_cola_no_pierde_el_hueco():
+    async def prueba():
+        limitador = _limitador()
+        await limitador.acquire(1)
+        tarea = await _en_cola(limitador)
+        tarea.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tarea
+        assert not limitador.cola
+        limitador.release(1, 0.1)
+        assert limitador.en_curso == 0 and limitador.bytes_en_curso == 0
+
+    asyncio.run(prueba())
+
+
+def test_cancelar_tras_recibir_el_hueco_lo_devuelve():
+    async def prueba():
+        limitador = _limitador()
+        await limitador.acquire(1)
+        tarea = await _en_cola(limitador)
+        # Se le concede el hueco, pero se cancela antes de que despierte
+        limitador.release(1, 0.1)
+        tarea.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tarea
+        assert limitador.en_curso == 0 and limitador.bytes_en_curso == 0
+        await asyncio.wait_for(limitador.acquire(1), 0.1)
+
+    asyncio.run(prueba())
+
+
+@pytest.fixture
+def cliente():
+    app = FastAPI()
+
+    @app.post("/api/analyze/text")
+    async def analizar(request: Request):
+        return {"bytes": len(await request.body())}
+
+    @app.post("/api/chatbot/message")
+    async def chatbot(request: Request):
+        return {"bytes": len(await request.body())}
+
+    limitadores = {"/api/analyze/text": _limitador(max_peticion=1024)}
+    app.add_middleware(AdmissionMiddleware, limitadores=limitadores)
+    cliente = TestClient(app)
+    cliente.limitadores = limitadores
+    return cliente
+
+
+def test_middleware_admite_y_rechaza_cuerpos_grandes(cliente):
+    assert cliente.post("/api/analyze/text", content=b"x" * 100).json() == {"bytes": 100}
+    respuesta = cliente.post("/api/analyze/text", content=b"x" * 2048)
+    assert respuesta.status_code == 413
+    # Las demás rutas no tienen límites
+    assert cliente.post("/api/chatbot/message", content=b"x" * 2048).status_code == 200
+    limitador = cliente.limitadores["/api/analyze/text"]
+    assert limitador.en_curso == 0 and limitador.stats["demasiado_grandes"] == 1
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Cubo pre-agregado frente al recorrido completo (analytics.py)"""
+import pytest
+
+import analytics
+from analytics import AnalyticsEngine
+
+
+def _filas(n_categorias: int):
+    filas = []
+    for i in range(n_categorias * 3):
+        filas.append({
+            "timestamp": f"2024-0{1 + i % 3}-1{i % 10}T10:00:00",
+            "tipo": ("texto", "audio")[i % 2],
+            "sentimiento": ("positivo", "negativo", "neutral")[i % 3],
+            "score": (i % 7 - 3) / 4,
+            "magnitude": None if i % 5 == 0 else (i % 4) / 2,
+            "categoria": f"cat{i % n_categorias}",
+        })
+    return filas
+
+
+def _ordenadas(filas):
+    return sorted(filas, key=lambda fila: [str(fila[clave]) for clave in sorted(fila)])
+
+
+@pytest.fixture
+def motor(monkeypatch):
+    # Menos celdas de categoría que categorías: el resto acaba en "otras"
+    monkeypatch.setattr(analytics, "ANALYTICS_CUBE_CATEGORIES", 4)
+    motor = AnalyticsEngine()
+    motor.append_many(_filas(10))
+    return motor
+
+
+@pytest.mark.parametrize("claves, filtros", [
+    (["tipo", "sentimiento"], {}),
+    (["fecha"], {"tipo": "audio"}),
+    (["sentimiento"], {"categoria": "cat1"}),
+])
+def test_cubo_coincide_con_el_recorrido(motor, claves, filtros):
+    assert motor._cube_reduce(claves, **filtros) is not None
+    assert _ordenadas(motor.group_by(claves, **filtros)) == _ordenadas(motor._group_by_scan(claves, **filtros))
+
+
+@pytest.mark.parametrize("claves, filtros", [
+    (["categoria"], {}),
+    (["tipo"], {"categoria": "cat9"}),
+])
+def test_categorias_plegadas_usan_el_recorrido(motor, claves, filtros):
+    assert motor._cube_reduce(claves, **filtros) is None
+    filas = motor.group_by(claves, **filtros)
+    if claves == ["categoria"]:
+        assert {fila["categoria"] for fila in filas} == {f"cat{i}" for i in range(10)}
+    assert sum(fila["count"] for fila in filas) == (30 if not filtros else 3)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Normalización de WAV para Speech-to-Text (audio_processing.py)"""
+import io
+import os
+import struct
+import wave
+
+import numpy as np
+import pytest
+
+import audio_processing
+from audio_processing import InvalidAudioError, normalize_wav
+
+FIXTURES = os.path.dirname(os.path.abspath(__file__))
+
+
+def _wav(muestras: np.ndarray, rate: int, canales: int = 1) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(canales)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes((np.clip(muestras, -1, 1) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def _tono(rate: int, segundos: float, frecuencia: float = 440.0) -> np.ndarray:
+    t = np.arange(int(rate * segundos)) / rate
+    return 0.5 * np.sin(2 * np.pi * frecuencia * t)
+
+
+def test_prueba_voz_se_reduce_a_mono_16k():
+    with open(os.path.join(FIXTURES, "pruebaVOZ1.wav"), "rb") as f:
+        contenido = f.read()
+    pcm, info = normalize_wav(contenido)
+
+    assert info["canales_originales"] == 2
+    assert info["sample_rate_original"] == 22050
+    assert info["sample_rate"] == audio_processing.AUDIO_TARGET_RATE == 16000
+    # PCM de 16 bits mono: 2 bytes por muestra a la frecuencia de destino
+    assert len(pcm) == info["bytes_enviados"]
+    assert len(pcm) / 2 / 16000 == pytest.approx(info["duracion"], abs=0.01)
+    # Se recorta silencio, nunca se alarga
+    assert 0 < info["duracion"] <= info["duracion_original"] == pytest.approx(9.75, abs=0.01)
+    assert info["bytes_ahorrados"] == len(contenido) - len(pcm) > 0
+
+
+def test_remuestreo_conserva_la_frecuencia_del_tono():
+    pcm, info = normalize_wav(_wav(_tono(44100, 1.0, 440.0), 44100))
+    senal = np.frombuffer(pcm, dtype="<i2").astype(np.float64)
+    espectro = np.abs(np.fft.rfft(senal))
+    pico = np.argmax(espectro) * info["sample_rate"] / len(senal)
+    assert info["sample_rate"] == 16000
+    assert pico == pytest.approx(440.0, abs=2.0)
+
+
+def test_no_se_sube_la_frecuencia_de_audio_de_8k():
+    pcm, info = normalize_wav(_wav(_tono(8000, 1.0), 8000))
+    assert info["sample_rate"] == 8000
+    assert len(pcm) == 2 * 8000
+
+
+def test_estereo_se_promedia_a_mono():
+    tono = _tono(16000, 0.5)
+    estereo = np.stack([tono, tono], axis=1).reshape(-1)
+    pcm, info = normalize_wav(_wav(estereo, 16000, canales=2))
+    assert info["canales_originales"] == 2
+    assert len(pcm) == 2 * len(tono)
+
+
+def _cabecera(canales: int, rate: int, bits: int) -> bytes:
+    fmt = struct.pack("<HHIIHH", 1, canales, rate, rate * canales * bits // 8 if bits else 0,
+                      canales * bits // 8, bits)
+    datos = b"\0" * 64
+    cuerpo = b"WAVE" + b"fmt " + struct.pack("<I", 16) + fmt + b"data" + struct.pack("<I", len(datos)) + datos
+    return b"RIFF" + struct.pack("<I", len(cuerpo)) + cuerpo
+
+
+@pytest.mark.parametrize("canales, rate, bits", [(0, 16000, 16), (1, 0, 16), (1, 16000, 0), (1, 16000, 12)])
+def test_cabeceras_invalidas_se_rechazan(canales, rate, bits):
+    with pytest.raises(InvalidAudioError):
+        normalize_wav(_cabecera(canales, rate, bits))
+
+
+def test_no_wav_se_rechaza():
+    with pytest.raises(InvalidAudioError):
+        normalize_wav(b"ID3" + b"\0" * 100)
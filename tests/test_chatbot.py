@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Contexto por sesión y respuestas precalculadas del chatbot (chatbot.py)"""
+import time
+
+import pytest
+
+from chatbot import _SIN_DATOS, ChatbotEngine, SessionStore
+from database import FeedbackDatabase
+
+
+@pytest.fixture
+def motor(tmp_path):
+    db = FeedbackDatabase(str(tmp_path / "feedback.db"), partitioned=False)
+    motor = ChatbotEngine(db, sesiones=SessionStore(max_sesiones=2, ttl=60))
+    motor.refresh()
+    return motor
+
+
+def test_sesiones_caducan_y_se_expulsan_las_menos_usadas():
+    sesiones = SessionStore(max_sesiones=2, ttl=0.05)
+    sesiones.update("a", intent="categorias")
+    assert sesiones.get("a")["intent"] == "categorias"
+    time.sleep(0.06)
+    assert sesiones.get("a") == {} and len(sesiones) == 0
+
+    sesiones.ttl = 60
+    for session_id in ("a", "b", "a", "c"):
+        sesiones.update(session_id, intent="ayuda")
+    assert sesiones.get("b") == {} and sesiones.get("a")["turnos"] == 2
+    assert sesiones.expulsadas == 1
+
+
+def test_filtro_de_sentimiento_usa_el_tema_anterior(motor):
+    assert motor.reply("¿Qué categorías tengo?", "s1")["intent"] == "categorias"
+    respuesta = motor.reply("¿y los negativos?", "s1")
+    assert (respuesta["intent"], respuesta["sentimiento"]) == ("categorias", "negativo")
+    # Otra sesión no comparte el contexto
+    assert motor.reply("¿y los negativos?", "s2")["intent"] == "sentimiento"
+
+
+def test_contexto_se_actualiza_con_todos_los_intents(motor):
+    motor.reply("¿Qué categorías tengo?", "s1")
+    motor.reply("hola, ayuda", "s1")
+    assert motor.sesiones.get("s1")["intent"] == "ayuda"
+    assert motor.reply("¿y los negativos?", "s1")["intent"] == "sentimiento"
+
+
+def test_sin_respuestas_no_consulta_sqlite(tmp_path, monkeypatch):
+    db = FeedbackDatabase(str(tmp_path / "feedback.db"), partitioned=False)
+    motor = ChatbotEngine(db)
+
+    def prohibido():
+        raise AssertionError("refresh() en el camino de la petición")
+
+    monkeypatch.setattr(motor, "refresh", prohibido)
+    assert motor.reply("estadísticas")["response"] == _SIN_DATOS
+    assert motor.reply_dialogflow("Estadisticas", {}) == _SIN_DATOS
+    # Se pide el cálculo al hilo de fondo
+    assert motor._cambios.is_set()
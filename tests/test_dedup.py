@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Detección de casi duplicados con MinHash + LSH (dedup.py)"""
+import numpy as np
+
+from database import FeedbackDatabase
+from dedup import MinHashIndex, minhash, normalize_text
+
+TEXTO = "La comida estaba fría y el camarero tardó más de media hora en atendernos"
+
+
+def test_normalizacion_ignora_mayusculas_tildes_y_puntuacion():
+    assert normalize_text("¡La COMIDA, estaba   fría!") == "la comida estaba fria"
+
+
+def test_firma_determinista_y_none_sin_texto():
+    assert np.array_equal(minhash(TEXTO), minhash(TEXTO))
+    assert minhash("¡¿...?!") is None
+
+
+def test_casi_duplicado_supera_el_umbral():
+    indice = MinHashIndex(threshold=0.7)
+    indice.add(minhash(TEXTO), "original")
+
+    exacto = indice.find(minhash(TEXTO.upper().replace("í", "i") + "!!"))
+    assert exacto == ("original", 1.0)
+
+    parecido = indice.find(minhash(TEXTO.replace("media hora", "media horita")))
+    assert parecido is not None and parecido[0] == "original"
+    assert 0.7 <= parecido[1] < 1.0
+
+
+def test_textos_distintos_no_son_duplicados():
+    indice = MinHashIndex(threshold=0.7)
+    indice.add(minhash(TEXTO), "original")
+    assert indice.find(minhash("Me encantó el postre de chocolate, volveremos pronto")) is None
+
+
+def test_umbral_mas_alto_rechaza_el_casi_duplicado():
+    indice = MinHashIndex(threshold=1.0)
+    indice.add(minhash(TEXTO), "original")
+    assert indice.find(minhash(TEXTO.replace("media hora", "media horita"))) is None
+
+
+def test_devuelve_el_mas_parecido():
+    indice = MinHashIndex(threshold=0.5)
+    indice.add(minhash(TEXTO.replace("fría", "templada")), "lejano")
+    indice.add(minhash(TEXTO), "exacto")
+    assert indice.find(minhash(TEXTO))[0] == "exacto"
+
+
+def test_base_de_datos_detecta_duplicados_tras_reiniciar(tmp_path):
+    ruta = str(tmp_path / "feedback.db")
+    db = FeedbackDatabase(ruta, partitioned=False)
+    assert db.add_feedback({"id": "f1", "tipo": "texto", "texto": TEXTO, "sentimiento": "negativo"})
+    assert db.find_duplicate(TEXTO)["feedback_id"] == "f1"
+
+    # Las firmas se guardan en SQLite: otro proceso las carga al arrancar
+    otra = FeedbackDatabase(ruta, partitioned=False)
+    encontrado = otra.find_duplicate(TEXTO + ".")
+    assert encontrado == {"feedback_id": "f1", "similitud": 1.0}
+    assert otra.find_duplicate("Nada que ver con lo anterior") is None
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Particiones mensuales y lotes repartidos entre varias (database.py)"""
+import os
+import sqlite3
+
+import pytest
+
+from database import FeedbackDatabase, PartialWriteError
+
+
+def _feedback(feedback_id: str, timestamp: str) -> dict:
+    return {"id": feedback_id, "tipo": "texto", "sentimiento": "neutral", "score": 0.0,
+            "texto": f"Comentario {feedback_id} del {timestamp}", "timestamp": timestamp}
+
+
+@pytest.fixture
+def db(tmp_path):
+    return FeedbackDatabase(str(tmp_path / "feedback.db"), partitioned=True)
+
+
+@pytest.fixture
+def falla_en_junio(db, monkeypatch):
+    """La transacción de la partición de junio falla a mitad"""
+    original = db._insert_feedback
+
+    def insertar(cursor, datos, ruta, *args, **kwargs):
+        if ruta.endswith("feedback_2024_06.db"):
+            raise sqlite3.OperationalError("disk I/O error")
+        return original(cursor, datos, ruta, *args, **kwargs)
+
+    monkeypatch.setattr(db, "_insert_feedback", insertar)
+
+
+def test_cada_mes_va_a_su_fichero(db):
+    assert db.add_feedback_many([_feedback("mayo", "2024-05-10T10:00:00"),
+                                 _feedback("junio", "2024-06-10T10:00:00")]) == [True, True]
+    assert sorted(os.path.basename(r) for r in db.partitions()) == ["feedback_2024_05.db", "feedback_2024_06.db"]
+    assert db.get_feedback("mayo") is not None and db.get_feedback("junio") is not None
+
+
+def test_fallo_parcial_informa_de_lo_confirmado(db, falla_en_junio):
+    items = [_feedback("m1", "2024-05-01T10:00:00"), _feedback("j1", "2024-06-01T10:00:00"),
+             _feedback("m2", "2024-05-02T10:00:00")]
+    with pytest.raises(PartialWriteError) as error:
+        db.write_many(items)
+    assert error.value.resultados == [True, False, True]
+    assert [e["resumen"]["id"] for e in error.value.eventos] == ["m1", "m2"]
+
+
+def test_add_feedback_many_devuelve_el_resultado_parcial(db, falla_en_junio):
+    notificados = []
+    db.add_listener(lambda resumen: notificados.append(resumen["id"]))
+    items = [_feedback("m1", "2024-05-01T10:00:00"), _feedback("j1", "2024-06-01T10:00:00")]
+
+    assert db.add_feedback_many(items) == [True, False]
+    assert notificados == ["m1"]
+    assert db.get_feedback("m1") is not None
+    assert db.get_feedback("j1") is None
+
+
+def test_fallo_sin_nada_confirmado_se_propaga(db, falla_en_junio):
+    with pytest.raises(sqlite3.OperationalError):
+        db.add_feedback_many([_feedback("j1", "2024-06-01T10:00:00")])
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Planificador de cuotas de Google con carriles y servicio central (quota.py)"""
+import threading
+import time
+
+import pytest
+
+from quota import (INTERACTIVO, MASIVO, QuotaExceededError, QuotaScheduler, QuotaServer,
+                   RemoteQuotaScheduler, _CuotaApi)
+
+CLAVE = b"clave-de-prueba"
+
+
+def _acquire(cuota: _CuotaApi, carril: str = INTERACTIVO, plazo: float = 0.05, coste: float = 1):
+    cuota.acquire(carril, time.monotonic() + plazo, coste)
+
+
+def test_rafaga_de_un_segundo_y_despues_espera():
+    cuota = _CuotaApi("language", rpm=600, bulk_share=0.5)   # 10/s, ráfaga de 10
+    for _ in range(10):
+        _acquire(cuota, plazo=0)
+    with pytest.raises(QuotaExceededError) as error:
+        _acquire(cuota, plazo=0.01)
+    assert error.value.retry_after >= 1
+    inicio = time.monotonic()
+    _acquire(cuota, plazo=1)
+    assert 0.05 < time.monotonic() - inicio < 0.5
+
+
+def test_carril_masivo_limitado_a_su_parte():
+    cuota = _CuotaApi("vision", rpm=600, bulk_share=0.5)
+    for _ in range(5):
+        _acquire(cuota, MASIVO, plazo=0)
+    with pytest.raises(QuotaExceededError):
+        _acquire(cuota, MASIVO, plazo=0.01)
+    # La web sigue teniendo la otra mitad de la ráfaga
+    _acquire(cuota, INTERACTIVO, plazo=0)
+
+
+def test_lote_mayor_que_la_rafaga_deja_deuda():
+    cuota = _CuotaApi("vision", rpm=600, bulk_share=1.0)
+    _acquire(cuota, plazo=0, coste=30)
+    assert cuota.tokens == pytest.approx(-20, abs=0.1)
+    # La siguiente llamada espera a que se pague el lote entero (~2 s)
+    with pytest.raises(QuotaExceededError):
+        _acquire(cuota, plazo=0.5)
+
+
+def test_resource_exhausted_reduce_la_tasa():
+    planificador = QuotaScheduler({"speech": 600})
+
+    def agotada():
+        raise RuntimeError("429 RESOURCE_EXHAUSTED: quota")
+
+    with pytest.raises(QuotaExceededError):
+        planificador.call("speech", agotada, plazo=0.5)
+    assert planificador.apis["speech"].tasa == pytest.approx(5.0)
+    assert planificador.stats()["speech"]["resource_exhausted"] == 1
+
+
+def test_errores_normales_se_propagan_y_api_desconocida():
+    planificador = QuotaScheduler({"language": 600})
+    with pytest.raises(ZeroDivisionError):
+        planificador.call("language", lambda: 1 / 0)
+    with pytest.raises(KeyError):
+        planificador.call("traductor", lambda: None)
+    assert planificador.call("language", lambda x: x * 2, 21) == 42
+
+
+@pytest.fixture
+def servicio(tmp_path):
+    servidor = QuotaServer(QuotaScheduler({"language": 600}), address=str(tmp_path / "cuotas.sock"),
+                           authkey=CLAVE)
+    servidor.start()
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    yield servidor
+    servidor.close()
+
+
+def test_sin_authkey_no_arranca(tmp_path):
+    with pytest.raises(ValueError):
+        QuotaServer(QuotaScheduler({"language": 600}), address=str(tmp_path / "c.sock"), authkey=b"")
+    with pytest.raises(ValueError):
+        RemoteQuotaScheduler(str(tmp_path / "c.sock"), authkey=b"", cuotas={"language": 600})
+
+
+def test_los_procesos_comparten_los_cubos_del_servicio(servicio):
+    web = RemoteQuotaScheduler(servicio.address, authkey=CLAVE, cuotas={"language": 600})
+    importador = RemoteQuotaScheduler(servicio.address, authkey=CLAVE, cuotas={"language": 600})
+    for _ in range(10):
+        web.call("language", lambda: None, plazo=0)
+    # El importador ve la ráfaga ya gastada por la web
+    with pytest.raises(QuotaExceededError):
+        importador.call("language", lambda: None, plazo=0.01)
+    assert importador.stats()["central"] == str(servicio.address)
+
+
+def test_sin_servicio_usa_su_parte_de_la_cuota(tmp_path):
+    planificador = RemoteQuotaScheduler(str(tmp_path / "no-existe.sock"), authkey=CLAVE,
+                                        cuotas={"language": 600}, procesos=2)
+    assert planificador.apis["language"].limite == pytest.approx(5.0)
+    for _ in range(5):
+        planificador.call("language", lambda: None, plazo=0)
+    with pytest.raises(QuotaExceededError):
+        planificador.call("language", lambda: None, plazo=0.01)
+    assert planificador.stats()["central"] is None
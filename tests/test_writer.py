@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Proceso escritor único (writer.py), en un hilo y con un socket Unix temporal"""
+import threading
+import time
+
+import pytest
+
+import writer
+from database import FeedbackDatabase
+from writer import FeedbackWriterServer, RemoteFeedbackWriter, WriterBusyError, WriterError
+
+CLAVE = b"clave-de-prueba"
+
+
+def _feedback(feedback_id: str, texto: str = None) -> dict:
+    return {"id": feedback_id, "tipo": "texto", "sentimiento": "positivo", "score": 0.5,
+            "texto": texto or f"Comentario de prueba número {feedback_id}"}
+
+
+@pytest.fixture
+def escritor(tmp_path):
+    db = FeedbackDatabase(str(tmp_path / "feedback.db"), partitioned=False)
+    servidor = FeedbackWriterServer(db, address=str(tmp_path / "escritor.sock"), authkey=CLAVE)
+    servidor.start()
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    yield servidor
+    servidor.close()
+
+
+def _cliente(servidor) -> RemoteFeedbackWriter:
+    return RemoteFeedbackWriter(servidor.address, authkey=CLAVE)
+
+
+def test_sin_authkey_no_arranca(tmp_path):
+    db = FeedbackDatabase(str(tmp_path / "feedback.db"), partitioned=False)
+    with pytest.raises(ValueError):
+        FeedbackWriterServer(db, address=str(tmp_path / "s.sock"), authkey=b"")
+    with pytest.raises(ValueError):
+        RemoteFeedbackWriter(str(tmp_path / "s.sock"), authkey=b"")
+
+
+def test_guarda_y_rechaza_ids_repetidos(escritor):
+    cliente = _cliente(escritor)
+    assert cliente.add_feedback_many([_feedback("a"), _feedback("b")]) == [True, True]
+    assert cliente.add_feedback(_feedback("a")) is False
+    assert escritor.db.get_feedback("b") is not None
+
+
+def test_escrituras_concurrentes_se_agrupan(escritor):
+    # Escritor lento: mientras confirma un lote se acumulan los siguientes
+    original = escritor.db.write_many
+
+    def lento(items, *args, **kwargs):
+        time.sleep(0.05)
+        return original(items, *args, **kwargs)
+
+    escritor.db.write_many = lento
+    resultados = []
+    hilos = [threading.Thread(target=lambda i=i: resultados.append(_cliente(escritor).add_feedback(_feedback(f"f{i}"))))
+             for i in range(20)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert resultados == [True] * 20
+    assert escritor.stats["feedback"] == 20
+    assert escritor.stats["lotes"] < 20
+
+
+def test_los_suscriptores_reciben_los_eventos(escritor, tmp_path):
+    worker = FeedbackDatabase(str(tmp_path / "feedback.db"), partitioned=False)
+    recibidos = []
+    worker.add_listener(recibidos.append)
+    cliente = _cliente(escritor)
+    assert cliente.start_subscription(worker)
+
+    texto = "El envío llegó tarde y la caja venía rota por un lateral"
+    cliente.add_feedback(_feedback("evento", texto))
+    for _ in range(100):
+        if recibidos:
+            break
+        time.sleep(0.02)
+    assert [r["id"] for r in recibidos] == ["evento"]
+    # El índice de duplicados del worker también se actualiza
+    assert worker.find_duplicate(texto)["feedback_id"] == "evento"
+
+
+def test_lote_caducado_no_se_guarda(escritor, monkeypatch):
+    original = escritor.db.write_many
+
+    def lento(items, *args, **kwargs):
+        time.sleep(0.6)
+        return original(items, *args, **kwargs)
+
+    escritor.db.write_many = lento
+    monkeypatch.setattr(writer, "WRITER_TIMEOUT", 0.3)
+    primero = threading.Thread(target=_cliente(escritor).add_feedback, args=(_feedback("lento"),))
+    primero.start()
+    time.sleep(0.05)
+
+    # Espera detrás del lote lento y su plazo vence antes de empezar
+    with pytest.raises(WriterBusyError):
+        _cliente(escritor).add_feedback(_feedback("caducado"))
+    primero.join()
+    assert escritor.db.get_feedback("caducado") is None
+    assert escritor.stats["caducados"] == 1
+
+
+def test_tareas_de_mantenimiento(escritor):
+    cliente = _cliente(escritor)
+    assert cliente.run("clear_old_data", 90) == 0
+    with pytest.raises(WriterError):
+        cliente.run("export_to_json", "/tmp/no.json")
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""
+Proceso escritor único para desplegar con varios workers de uvicorn
+
+SQLite admite un solo escritor a la vez: si cada worker escribe por su
+cuenta aparecen errores "database is locked". Con FEEDBACK_WRITER_ADDRESS
+definido, los workers no escriben en SQLite: envían cada feedback a este
+proceso por un socket local y esperan su confirmación. Las lecturas siguen
+siendo locales en cada worker (SQLite en modo WAL).
+
+El escritor agrupa las peticiones que llegan a la vez en una sola
+transacción (group commit), así que el rendimiento crece con el número de
+workers en lugar de competir por el bloqueo. La cola es acotada: si está
+llena, el worker recibe "ocupado" y responde 503 con Retry-After en vez de
+perder el feedback. Cada lote lleva el plazo del worker (WRITER_TIMEOUT):
+si el escritor no lo ha empezado a tiempo lo descarta sin guardarlo, para
+que el reintento tras el 503 no lo guarde dos veces.
+
+Tras cada commit el escritor reenvía los eventos a todos los workers
+suscritos, que actualizan su índice de duplicados, el feed en vivo y la
+analítica en memoria como si hubieran escrito ellos.
+
+Las operaciones de mantenimiento que también escriben (retención y
+particiones) se ejecutan igualmente en el escritor, entre dos lotes; cuando
+el escritor se resincroniza tras ellas, todos los workers lo hacen también.
+
+Arranque (con la misma FEEDBACK_WRITER_AUTHKEY secreta en ambos):
+    FEEDBACK_WRITER_ADDRESS=127.0.0.1:8765 python writer.py
+    FEEDBACK_WRITER_ADDRESS=127.0.0.1:8765 uvicorn app:app --workers 4
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+if __name__ == "__main__":
+    # Punto de entrada: el .env se carga antes de leer la configuración de
+    # este módulo y de los que se importan después
+    load_dotenv()
+
+from database import PartialWriteError
+
+logger = logging.getLogger(__name__)
+
+
+# Configuración (variables de entorno)
+FEEDBACK_WRITER_ADDRESS = os.getenv("FEEDBACK_WRITER_ADDRESS", "")
+# Sin valor por defecto: multiprocessing.connection deserializa (pickle) lo
+# que llega, así que una clave conocida permitiría ejecutar código en el escritor
+FEEDBACK_WRITER_AUTHKEY = os.getenv("FEEDBACK_WRITER_AUTHKEY", "").encode("utf-8")
+WRITER_QUEUE_SIZE = int(os.getenv("WRITER_QUEUE_SIZE", "1000"))
+WRITER_BATCH_SIZE = int(os.getenv("WRITER_BATCH_SIZE", "200"))
+WRITER_ENQUEUE_TIMEOUT = float(os.getenv("WRITER_ENQUEUE_TIMEOUT", "2"))
+WRITER_TIMEOUT = float(os.getenv("WRITER_TIMEOUT", "30"))
+
+# Margen que el worker espera, más allá de WRITER_TIMEOUT, a que termine la
+# transacción de un lote que el escritor empezó dentro de plazo
+_MARGEN_CONFIRMACION = 10.0
+
+# Eventos pendientes por worker suscrito antes de desconectarlo
+_BUFFER_SUSCRIPTOR = 1000
+
+# Operaciones de mantenimiento de FeedbackDatabase que también escriben: con
+# el escritor activo, los workers y los scripts las delegan en él
+TAREAS = ("clear_old_data", "archive_partition", "compact_partition", "migrate_to_partitions",
+          "restore_batch", "finish_restore")
+
+
+class WriterError(RuntimeError):
+    """No se pudo guardar el feedback a través del proceso escritor"""
+
+
+class WriterBusyError(WriterError):
+    """La cola del proceso escritor está llena (reintentar más tarde)"""
+
+
+def require_authkey(authkey: bytes, variable: str) -> bytes:
+    """Clave de un socket de multiprocessing.connection (obligatoria)"""
+    if not authkey:
+        raise ValueError(f"Falta {variable}: define una clave secreta compartida "
+                         f"(p. ej. python -c \"import secrets; print(secrets.token_hex(32))\")")
+    return authkey
+
+
+def parse_address(direccion: str):
+    """"host:puerto" -> tupla TCP; cualquier otra cosa es un socket Unix"""
+    host, sep, puerto = direccion.rpartition(":")
+    if sep and puerto.isdigit():
+        return (host or "127.0.0.1", int(puerto))
+    return direccion
+
+
+# =====================================================
+# SERVIDOR (proceso escritor)
+# =====================================================
+
+class _Trabajo:
+    """Lote de feedback (o tarea de mantenimiento) enviado por un worker, pendiente de confirmar"""
+
+    def __init__(self, items: List[Dict[str, Any]], tarea: Optional[tuple] = None,
+                 plazo: Optional[float] = None):
+        self.items = items
+        self.tarea = tarea
+        # Instante (monotonic) a partir del cual el worker ya no espera la respuesta
+        self.plazo = plazo
+        self.hecho = threading.Event()
+        self.respuesta = None
+
+
+class _Suscriptor:
+    """Worker suscrito a los eventos confirmados, con su cola acotada"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cola: queue.Queue = queue.Queue(maxsize=_BUFFER_SUSCRIPTOR)
+
+
+class FeedbackWriterServer:
+    """Escritor único: serializa y agrupa las escrituras de todos los workers"""
+
+    def __init__(self, db, address=None, authkey: bytes = FEEDBACK_WRITER_AUTHKEY,
+                 queue_size: int = WRITER_QUEUE_SIZE, batch_size: int = WRITER_BATCH_SIZE):
+        self.db = db
+        self.address = parse_address(address or FEEDBACK_WRITER_ADDRESS or "127.0.0.1:8765")
+        self.authkey = require_authkey(authkey, "FEEDBACK_WRITER_AUTHKEY")
+        self.batch_size = batch_size
+        self._cola: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._suscriptores = set()
+        self._lock = threading.Lock()
+        self.listener = None
+        self.stats = {"lotes": 0, "feedback": 0, "rechazados": 0, "caducados": 0}
+        # Si el escritor recarga su estado (datos borrados, restaurados...),
+        # los workers también
+        db.add_resync_hook(lambda: self._difundir(("resync", None)))
+
+    def serve_forever(self):
+        """Aceptar conexiones de los workers (bloquea)"""
+        self.start()
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            except Exception as e:
+                # Handshake fallido (authkey incorrecta, conexión cortada...)
+                logger.warning(f"⚠️ Conexión rechazada por el escritor: {str(e)}")
+                continue
+            threading.Thread(target=self._atender, args=(conn,), daemon=True).start()
+
+    def start(self):
+        """Abrir el socket y arrancar el hilo escritor"""
+        if self.listener is None:
+            self.listener = Listener(self.address, authkey=self.authkey)
+            threading.Thread(target=self._bucle_escritura, daemon=True).start()
+            logger.info(f"✍️ Proceso escritor escuchando en {self.address}")
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+
+    # ---------- Conexiones de los workers ----------
+
+    def _atender(self, conn):
+        """Atender las peticiones de una conexión de worker"""
+        try:
+            while True:
+                mensaje = conn.recv()
+                if mensaje[0] == "add":
+                    # El plazo llega en segundos relativos: no depende del reloj del worker
+                    plazo = time.monotonic() + mensaje[2] if len(mensaje) > 2 else None
+                    conn.send(self._encolar(_Trabajo(mensaje[1], plazo=plazo)))
+                elif mensaje[0] == "run":
+                    if mensaje[1] not in TAREAS:
+                        conn.send(("error", f"Tarea desconocida: {mensaje[1]}"))
+                    else:
+                        conn.send(self._encolar(_Trabajo([], tarea=mensaje[1:])))
+                elif mensaje[0] == "subscribe":
+                    self._servir_suscripcion(conn)
+                    return
+                else:
+                    conn.send(("error", f"Mensaje desconocido: {mensaje[0]}"))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _encolar(self, trabajo: _Trabajo):
+        """Encolar un trabajo y esperar a que se confirme (backpressure si la cola está llena)"""
+        try:
+            self._cola.put(trabajo, timeout=WRITER_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            self.stats["rechazados"] += len(trabajo.items)
+            return ("busy", None)
+        trabajo.hecho.wait()
+        return trabajo.respuesta
+
+    # ---------- Escritura (un solo hilo) ----------
+
+    def _bucle_escritura(self):
+        """Vaciar la cola en transacciones agrupadas"""
+        siguiente = None
+        while True:
+            primero, siguiente = siguiente or self._cola.get(), None
+            if primero.tarea is not None:
+                self._ejecutar_tarea(primero)
+                continue
+            trabajos = [primero]
+            n = len(primero.items)
+            while n < self.batch_size:
+                try:
+                    trabajo = self._cola.get_nowait()
+                except queue.Empty:
+                    break
+                if trabajo.tarea is not None:
+                    # Las tareas van solas, después del lote en curso
+                    siguiente = trabajo
+                    break
+                trabajos.append(trabajo)
+                n += len(trabajo.items)
+
+            # Un lote que el worker ya dio por perdido (503) no se guarda: si
+            # reintenta, el feedback quedaría dos veces
+            ahora = time.monotonic()
+            for trabajo in [t for t in trabajos if t.plazo is not None and t.plazo < ahora]:
+                trabajos.remove(trabajo)
+                self.stats["caducados"] += len(trabajo.items)
+                trabajo.respuesta = ("expired", None)
+                trabajo.hecho.set()
+            if not trabajos:
+                continue
+
+            items = [item for trabajo in trabajos for item in trabajo.items]
+            try:
+                resultados, eventos = self.db.write_many(items)
+            except PartialWriteError as e:
+                # Lo confirmado antes del fallo se notifica como siempre
+                logger.exception("❌ Error al guardar feedback", extra={
+                    "evento": "feedback_error",
+                    "feedback_ids": [item.get("id") for item, ok in zip(items, e.resultados) if not ok]})
+                resultados, eventos = e.resultados, e.eventos
+            except Exception as e:
+                logger.exception("❌ Error al guardar feedback", extra={
+                    "evento": "feedback_error", "feedback_ids": [item.get("id") for item in items]})
+                for trabajo in trabajos:
+                    trabajo.respuesta = ("error", str(e))
+                    trabajo.hecho.set()
+                continue
+
+            pos = 0
+            for trabajo in trabajos:
+                trabajo.respuesta = ("ok", resultados[pos:pos + len(trabajo.items)])
+                pos += len(trabajo.items)
+                trabajo.hecho.set()
+
+            self.stats["lotes"] += 1
+            self.stats["feedback"] += len(eventos)
+            for evento in eventos:
+                self.db.apply_committed(evento)
+            if eventos:
+                self._difundir(("events", eventos))
+
+    def _ejecutar_tarea(self, trabajo: _Trabajo):
+        """Ejecutar una tarea de mantenimiento entre dos lotes (resync() avisa a los workers)"""
+        nombre, args, kwargs = trabajo.tarea
+        logger.info(f"🛠️ Tarea de mantenimiento en el escritor: {nombre}")
+        try:
+            trabajo.respuesta = ("ok", getattr(self.db, nombre)(*args, **kwargs))
+        except Exception as e:
+            logger.exception(f"❌ Error en la tarea de mantenimiento {nombre}")
+            trabajo.respuesta = ("error", f"{type(e).__name__}: {str(e)}")
+            # Puede haber cambiado datos antes de fallar
+            self.db.resync()
+        trabajo.hecho.set()
+
+    # ---------- Difusión de eventos ----------
+
+    def _servir_suscripcion(self, conn):
+        """Enviar los eventos confirmados a un worker hasta que se desconecte"""
+        sub = _Suscriptor(conn)
+        # Se registra antes de confirmar: lo que se escriba mientras el worker
+        # se resincroniza le llega después como eventos
+        with self._lock:
+            self._suscriptores.add(sub)
+        try:
+            conn.send(("subscribed", None))
+            while True:
+                mensaje = sub.cola.get()
+                if mensaje is None:
+                    break
+                conn.send(mensaje)
+        finally:
+            with self._lock:
+                self._suscriptores.discard(sub)
+
+    def _difundir(self, mensaje: tuple):
+        """Encolar un mensaje a cada worker; desconectar a los que no dan abasto"""
+        with self._lock:
+            suscriptores = list(self._suscriptores)
+        for sub in suscriptores:
+            try:
+                sub.cola.put_nowait(mensaje)
+            except queue.Full:
+                # Se le desconecta; el worker se resincroniza al reconectar
+                with self._lock:
+                    self._suscriptores.discard(sub)
+                sub.cola.get_nowait()
+                sub.cola.put_nowait(None)
+
+
+# =====================================================
+# CLIENTE (workers de la aplicación)
+# =====================================================
+
+class RemoteFeedbackWriter:
+    """Envía los feedback al proceso escritor y recibe sus eventos confirmados"""
+
+    def __init__(self, address=None, authkey: bytes = FEEDBACK_WRITER_AUTHKEY):
+        self.address = parse_address(address or FEEDBACK_WRITER_ADDRESS)
+        self.authkey = require_authkey(authkey, "FEEDBACK_WRITER_AUTHKEY")
+        self._pool: List[Any] = []
+        self._lock = threading.Lock()
+        self._suscrito = threading.Event()
+
+    # ---------- Escrituras ----------
+
+    def _conexion(self):
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+        return Client(self.address, authkey=self.authkey)
+
+    def _devolver(self, conn):
+        with self._lock:
+            self._pool.append(conn)
+
+    def add_feedback_many(self, items: List[Dict[str, Any]]) -> List[bool]:
+        """Guardar un lote a través del escritor; lanza WriterError si no se confirma"""
+        try:
+            conn = self._conexion()
+        except Exception as e:
+            raise WriterError(f"Proceso escritor no disponible: {str(e)}")
+
+        try:
+            # El escritor descarta el lote si no lo empieza dentro de WRITER_TIMEOUT;
+            # el margen cubre la transacción de uno empezado a tiempo
+            conn.send(("add", items, WRITER_TIMEOUT))
+            if not conn.poll(WRITER_TIMEOUT + _MARGEN_CONFIRMACION):
+                raise TimeoutError("sin confirmación del escritor")
+            estado, datos = conn.recv()
+        except Exception as e:
+            conn.close()
+            raise WriterError(f"Proceso escritor no disponible: {str(e)}")
+        self._devolver(conn)
+
+        if estado == "busy":
+            raise WriterBusyError("Proceso escritor saturado, reintentar más tarde")
+        if estado == "expired":
+            raise WriterBusyError("El escritor no llegó a guardar el lote a tiempo (no se ha guardado)")
+        if estado != "ok":
+            raise WriterError(f"Error del proceso escritor: {datos}")
+        return datos
+
+    def add_feedback(self, feedback_data: Dict[str, Any]) -> bool:
+        return self.add_feedback_many([feedback_data])[0]
+
+    def run(self, tarea: str, *args, **kwargs):
+        """Ejecutar una tarea de mantenimiento de FeedbackDatabase en el escritor (sin plazo)"""
+        try:
+            conn = self._conexion()
+        except Exception as e:
+            raise WriterError(f"Proceso escritor no disponible: {str(e)}")
+
+        try:
+            conn.send(("run", tarea, args, kwargs))
+            estado, datos = conn.recv()
+        except Exception as e:
+            conn.close()
+            raise WriterError(f"Proceso escritor no disponible: {str(e)}")
+        self._devolver(conn)
+
+        if estado == "busy":
+            raise WriterBusyError("Proceso escritor saturado, reintentar más tarde")
+        if estado != "ok":
+            raise WriterError(f"Error del proceso escritor en {tarea}: {datos}")
+        return datos
+
+    # ---------- Suscripción a eventos ----------
+
+    def start_subscription(self, db, timeout: float = 5.0) -> bool:
+        """
+        Aplicar en db los eventos confirmados por el escritor (hilo en segundo plano)
+
+        Espera hasta timeout segundos a la primera suscripción; devuelve si se
+        ha conseguido. Tras cada (re)conexión se llama a db.resync() para
+        recuperar los eventos que se hayan podido perder.
+        """
+        threading.Thread(target=self._bucle_suscripcion, args=(db,), daemon=True).start()
+        return self._suscrito.wait(timeout)
+
+    def _bucle_suscripcion(self, db):
+        espera = 0.5
+        while True:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+                conn.send(("subscribe", None))
+                conn.recv()
+                db.resync()
+                self._suscrito.set()
+                espera = 0.5
+                while True:
+                    tipo, eventos = conn.recv()
+                    if tipo == "resync":
+                        # Tarea de mantenimiento (borrado, restauración...) en el escritor
+                        db.resync()
+                        continue
+                    for evento in eventos:
+                        db.apply_committed(evento)
+            except Exception as e:
+                logger.warning(f"⚠️ Suscripción al escritor perdida ({str(e)}), reintentando en {espera}s")
+            time.sleep(espera)
+            espera = min(espera * 2, 10)
+
+
+def get_writer() -> Optional[RemoteFeedbackWriter]:
+    """Cliente del escritor si FEEDBACK_WRITER_ADDRESS está definido"""
+    if not FEEDBACK_WRITER_ADDRESS:
+        return None
+    return RemoteFeedbackWriter()
+
+
+if __name__ == "__main__":
+    import logs
+    import quota
+    from database import FeedbackDatabase, SCHEMA_AUTO_MIGRATE
+
+    logs.setup()
+    db = FeedbackDatabase("feedback_analytics.db")
+    servidor = FeedbackWriterServer(db, address=os.getenv("FEEDBACK_WRITER_ADDRESS"))
+    if quota.QUOTA_SERVER_ADDRESS:
+        # El escritor también sirve las cuotas de Google a todos los procesos
+        servidor_cuotas = quota.QuotaServer(quota.QuotaScheduler())
+        servidor_cuotas.start()
+        threading.Thread(target=servidor_cuotas.serve_forever, daemon=True).start()
+    if SCHEMA_AUTO_MIGRATE:
+        # Migración en línea al esquema codificado
+        threading.Thread(target=db.migrate_schema, daemon=True).start()
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        servidor.close()